@@ -0,0 +1,505 @@
+# bench_hotpaths.py
+# Benchmark suite for the firmware's per-message hot paths.
+#
+# Each case runs the nodes' own code (pulled out of main.py by firmware.py,
+# or imported where it lives in a module) and reports:
+#   ops/s      calls per second
+#   alloc B    heap allocated per call, mean over the sampled calls
+#   peak B     the most any single sampled call allocated
+# On MicroPython the heap figures are gc.mem_alloc() deltas with the GC
+# held off; on CPython they come from tracemalloc (the peak each call
+# reaches, since CPython frees as it goes).
+#
+#   python3 bench_hotpaths.py [--save] [--quick] [case ...]
+#   micropython bench_hotpaths.py [--save] [--quick] [case ...]
+#
+# Every run is compared with the newest result stored for this Python
+# implementation under an earlier commit (results/<implementation>.jsonl);
+# --save appends this run there. Exits with status 1 if a case got more
+# than SLOWER_LIMIT slower or allocates more per call than before.
+import sys
+import time
+import gc
+import json
+
+HERE = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+sys.path.insert(0, HERE + "/../common")
+sys.path.insert(0, HERE + "/../esp32_sensor")
+sys.path.insert(0, HERE + "/../esp32_data")
+sys.path.insert(0, HERE)
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+import firmware
+import telemetry
+import tanks
+from state_codec import StatePublisher
+from latency import LatencyStats
+from umqtt.simple import MQTTClient
+import sht4x
+import log
+
+# time as the firmware sees it (ticks_us() and friends on CPython too)
+device_time = firmware.time_module()
+ticks_us = device_time.ticks_us
+ticks_diff = device_time.ticks_diff
+
+# As in production: entries are kept in the ring, nothing is printed
+log.configure(log.INFO, log.OFF)
+
+try:
+    mem_alloc = gc.mem_alloc
+    tracemalloc = None
+except AttributeError:
+    import tracemalloc
+
+IMPLEMENTATION = sys.implementation.name
+RESULTS = HERE + "/results"
+
+TIME_TARGET_US = 300000     # time each case for at least this long
+ALLOC_SAMPLES = 200         # calls bracketed individually for the heap figures
+SLOWER_LIMIT = 0.25         # fraction of ops/s a case may lose (timings are noisy)
+ALLOC_SLACK = 16            # bytes/call (one MicroPython GC block) of noise allowed
+
+MQTT_PORT = 18830
+MQTT_TOPIC = b"environment/wiredin/data"
+CONTROL_TOPIC = b"environment/wiredin/control"
+
+# Readings that walk the control law through every branch
+READINGS = ((19.2, 30.1, 5.2), (21.5, 45.0, 12.0), (26.3, 66.4, 30.0),
+            (22.8, 50.2, 7.9), (18.0, 70.0, 45.5), (23.1, 34.0, 9.1))
+
+
+def make_tank():
+    return tanks.Tank("wiredin", tanks.mac_from_str("24:6f:28:5a:10:01"),
+                      tanks.mac_from_str("14:2b:2f:af:79:c4"), (20.0, 25.0, 35.0, 65.0, 8.0))
+
+
+# ----- controller -----
+def case_reading_frame():
+    """on_reading_frame(): decode a binary sensor frame and its latency trailer"""
+    tank = make_tank()
+    env = firmware.load("esp32_data", ("on_reading_frame", "queue_frame_reading"), {
+        "time": device_time, "telemetry": telemetry, "log": log,
+        "sensor_tank": lambda host: tank, "queue_reading": firmware.sink,
+        "latency": LatencyStats(),
+    })
+    frame = bytearray(telemetry.READING_SIZE + telemetry.LATENCY_SIZE)
+    telemetry.encode_reading(frame, 17, 123456, 23.45, 51.2, 12.3,
+                             telemetry.FLAG_TEMP_HUMID | telemetry.FLAG_DISTANCE)
+    telemetry.encode_latency(frame, telemetry.READING_SIZE, 20350)
+    on_reading_frame = env["on_reading_frame"]
+    host = tank.sensor_mac
+    msg = bytes(frame)
+    return lambda: on_reading_frame(host, msg)
+
+
+def case_text_reading():
+    """parse_text_reading(): the legacy "Temp: ..°C, Humidity: ..%" message"""
+    parse = firmware.load("esp32_data", ("parse_text_reading",), {})["parse_text_reading"]
+    message = "Temp: 23.45°C, Humidity: 51.20% | Distance: 12.30cm"
+    return lambda: parse(message)
+
+
+def case_update_actuators():
+    """update_actuators(): the threshold control law, changing state on most calls"""
+    tank = make_tank()
+    sent = [0]
+
+    def send_command(tank):
+        sent[0] += 1
+    env = firmware.load("esp32_data", ("set_actuator", "update_actuators"), {
+        "tanks": tanks, "log": log, "send_command": send_command,
+    })
+    update = env["update_actuators"]
+    state = [0]
+
+    def step():
+        i = state[0]
+        state[0] = i + 1 if i + 1 < len(READINGS) else 0
+        t, h, d = READINGS[i]
+        update(tank, t, h, d)
+    return step
+
+
+class AckingClient:
+    """mqtt_client stand-in that accepts every publish and acknowledges it at once"""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, msg, retain=False, qos=0, on_ack=None):
+        self.published += 1
+        if on_ack is not None:
+            on_ack()
+        return True
+
+
+def case_publish_data():
+    """publish_data(): state dict, delta against the last ack, JSON encoding"""
+    tank = make_tank()
+    tank.publishers = [StatePublisher(tank.topic_data, "json", 60)]
+    env = firmware.load("esp32_data", ("publish_data",), {
+        "tanks": tanks, "time": device_time, "log": log,
+        "mqtt_connected": True, "mqtt_client": AckingClient(),
+    })
+    publish_data = env["publish_data"]
+    state = [0]
+
+    def step():
+        i = state[0]
+        state[0] = i + 1 if i + 1 < len(READINGS) else 0
+        t, h, d = READINGS[i]
+        tank.actuators[tanks.HEAT] = i & 1
+        publish_data(tank, t, h, d)
+    return step
+
+
+# ----- MQTT over a loopback TCP connection -----
+class StreamSocket:
+    """write()/readinto()/setblocking() on a CPython socket, as MicroPython's have"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.readinto = sock.recv_into
+        self.setblocking = sock.setblocking
+        self.close = sock.close
+
+    def write(self, buf, n=None):
+        if n is not None:
+            buf = memoryview(buf)[:n]
+        self.sock.sendall(buf)
+        return len(buf)
+
+
+# Sockets opened by the case being run, closed once it is done
+open_sockets = []
+
+
+def loopback():
+    """(client, broker) ends of a TCP connection on 127.0.0.1"""
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    for port in range(MQTT_PORT, MQTT_PORT + 20):
+        try:
+            server.bind(socket.getaddrinfo("127.0.0.1", port)[0][-1])
+            break
+        except OSError:
+            pass
+    server.listen(1)
+    client = socket.socket()
+    client.connect(socket.getaddrinfo("127.0.0.1", port)[0][-1])
+    broker = server.accept()[0]
+    server.close()
+    if not hasattr(client, "readinto"):
+        client = StreamSocket(client)
+        broker = StreamSocket(broker)
+    open_sockets.append(client)
+    open_sockets.append(broker)
+    return client, broker
+
+
+def publish_packet(topic, msg):
+    body = bytes((len(topic) >> 8, len(topic) & 0xFF)) + topic + msg
+    return bytes((0x30, len(body))) + body
+
+
+STATE = (b'{"heat_lamp": false, "fan": true, "humidifier": false, "servo": false, '
+         b'"take_over": false, "timestamp": 1745000000, "temperature": 23.4, '
+         b'"humidity": 51.2, "distance": 12.3}')
+DRAIN_EVERY = 32
+
+
+def case_mqtt_publish():
+    """MQTTClient.publish() of a state payload, QoS 0, into a loopback socket"""
+    sock, broker = loopback()
+    client = MQTTClient("bench", "127.0.0.1")
+    client.sock = sock
+    drain = bytearray(4096)
+    count = [0]
+
+    def step():
+        client.publish(MQTT_TOPIC, STATE)
+        count[0] += 1
+        if count[0] == DRAIN_EVERY:
+            count[0] = 0
+            # Keep the socket buffers from filling; the broker end is blocking
+            left = DRAIN_EVERY * (len(STATE) + len(MQTT_TOPIC) + 5)
+            while left > 0:
+                left -= broker.readinto(drain)
+    return step
+
+
+def case_mqtt_wait_msg():
+    """MQTTClient.wait_msg() delivering a control message from a loopback socket"""
+    sock, broker = loopback()
+    client = MQTTClient("bench", "127.0.0.1")
+    client.sock = sock
+    client.set_callback(lambda topic, msg: None)
+    burst = publish_packet(CONTROL_TOPIC, b'{"temp_upper": 26.5}') * DRAIN_EVERY
+    count = [0]
+
+    def step():
+        if count[0] == 0:
+            count[0] = DRAIN_EVERY
+            broker.write(burst)
+        count[0] -= 1
+        client.wait_msg()
+    return step
+
+
+# ----- sensor -----
+class SHT4xBus:
+    """I2C stand-in holding one SHT4x measurement (23.45 C, 51.2 %RH)"""
+
+    def writeto(self, addr, buf):
+        return 1
+
+    def readfrom_into(self, addr, buf):
+        buf[:] = b"\x64\x22\xb3\x75\x25\xbe"
+
+
+class NoSleep:
+    """time for the driver with the conversion waits taken out"""
+
+    def sleep(self, seconds):
+        pass
+
+    def sleep_ms(self, ms):
+        pass
+
+    def sleep_us(self, us):
+        pass
+
+
+def case_sht4x_measure():
+    """SHT4x.measure(): command, read, CRC check and raw -> C/%RH (waits removed)"""
+    sht4x.time = NoSleep()
+    sensor = sht4x.SHT4x(SHT4xBus())
+    return sensor.measure
+
+
+# ----- actuator -----
+class Relay:
+
+    def on(self):
+        pass
+
+    def off(self):
+        pass
+
+
+class Servo:
+
+    def duty(self, value):
+        pass
+
+
+def case_actuator_command():
+    """Actuator command frame: decode, apply to the relays, encode the ACK"""
+    env = firmware.load("esp32_actuator", ("set_servo_angle", "set_actuator", "ACTUATOR_DEVICES",
+                                           "state_bits", "apply_command"), {
+        "telemetry": telemetry, "log": log, "servo_pin": Servo(),
+        "heat_lamp_relay": Relay(), "fan_relay": Relay(), "humidifier_relay": Relay(),
+        "heat_lamp_state": False, "fan_state": False, "humidifier_state": False,
+        "servo_state": False,
+    })
+    apply_command = env["apply_command"]
+    frames = []
+    for seq in range(4):
+        frame = bytearray(telemetry.COMMAND_SIZE)
+        telemetry.encode_command(frame, seq, telemetry.ACT_ALL, 0x05 if seq & 1 else 0x0A)
+        frames.append(bytes(frame))
+    ack_buf = bytearray(telemetry.COMMAND_ACK_SIZE + telemetry.LATENCY_SIZE)
+    state = [0]
+
+    def step():
+        msg = frames[state[0]]
+        state[0] = (state[0] + 1) & 3
+        # The binary branch of the actuator's receive loop
+        received_us = ticks_us()
+        if telemetry.is_binary(msg) and msg[1] == telemetry.MSG_COMMAND:
+            seq, mask, states = telemetry.decode_command(msg)
+            applied = apply_command(mask, states)
+            telemetry.encode_command_ack(ack_buf, seq, applied)
+            telemetry.encode_latency(ack_buf, telemetry.COMMAND_ACK_SIZE,
+                                     ticks_diff(ticks_us(), received_us))
+    return step
+
+
+CASES = (
+    ("reading_frame", case_reading_frame),
+    ("text_reading", case_text_reading),
+    ("update_actuators", case_update_actuators),
+    ("publish_data", case_publish_data),
+    ("mqtt_publish", case_mqtt_publish),
+    ("mqtt_wait_msg", case_mqtt_wait_msg),
+    ("sht4x_measure", case_sht4x_measure),
+    ("actuator_command", case_actuator_command),
+)
+
+
+# ----- measurement -----
+def time_case(step, target_us):
+    """Calls per second, doubling the batch until it runs for target_us"""
+    n = 16
+    while True:
+        start = ticks_us()
+        for _ in range(n):
+            step()
+        elapsed = ticks_diff(ticks_us(), start)
+        if elapsed >= target_us or n >= 1 << 22:
+            return n * 1000000 / max(elapsed, 1)
+        n *= 2
+
+
+def heap_case(step, samples):
+    """(mean, max) bytes allocated by one call"""
+    total = 0
+    peak = 0
+    if tracemalloc is None:
+        gc.collect()
+        gc.disable()
+        try:
+            for i in range(samples):
+                if i & 31 == 0:
+                    gc.collect()
+                before = mem_alloc()
+                step()
+                used = mem_alloc() - before
+                total += used
+                if used > peak:
+                    peak = used
+        finally:
+            gc.enable()
+    else:
+        tracemalloc.start()
+        try:
+            for _ in range(samples):
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                step()
+                used = tracemalloc.get_traced_memory()[1] - before
+                total += used
+                if used > peak:
+                    peak = used
+        finally:
+            tracemalloc.stop()
+    return total / samples, peak
+
+
+def current_commit():
+    """The checked-out commit, read straight from .git (no git needed on the device)"""
+    root = HERE + "/../../.git"
+    try:
+        with open(root + "/HEAD") as f:
+            head = f.read().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[5:]
+        try:
+            with open(root + "/" + ref) as f:
+                return f.read().strip()
+        except OSError:
+            with open(root + "/packed-refs") as f:
+                for line in f:
+                    if line.rstrip().endswith(" " + ref):
+                        return line.split(" ", 1)[0]
+    except OSError:
+        pass
+    return None
+
+
+def load_baseline(commit):
+    """Newest stored run for this implementation from a different commit"""
+    baseline = None
+    try:
+        with open(RESULTS + "/" + IMPLEMENTATION + ".jsonl") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                run = json.loads(line)
+                if run.get("commit") != commit or commit is None:
+                    baseline = run
+    except OSError:
+        pass
+    return baseline
+
+
+def save(run):
+    try:
+        import os
+        try:
+            os.mkdir(RESULTS)
+        except OSError:
+            pass  # already there
+    except ImportError:
+        pass
+    with open(RESULTS + "/" + IMPLEMENTATION + ".jsonl", "a") as f:
+        f.write(json.dumps(run) + "\n")
+
+
+def compare(name, result, before):
+    """Regression messages for one case against its stored result"""
+    problems = []
+    if result["ops"] < before["ops"] * (1 - SLOWER_LIMIT):
+        problems.append("{}: {:.0f} ops/s, was {:.0f}".format(name, result["ops"], before["ops"]))
+    if result["alloc"] > before["alloc"] + ALLOC_SLACK:
+        problems.append("{}: allocates {:.0f} B/call, was {:.0f}".format(
+            name, result["alloc"], before["alloc"]))
+    return problems
+
+
+def main():
+    args = sys.argv[1:]
+    store = "--save" in args
+    target_us = TIME_TARGET_US // 10 if "--quick" in args else TIME_TARGET_US
+    wanted = [arg for arg in args if not arg.startswith("--")]
+    for name in wanted:
+        if name not in [case[0] for case in CASES]:
+            print("unknown case {}; cases: {}".format(name, " ".join(case[0] for case in CASES)))
+            sys.exit(2)
+
+    commit = current_commit()
+    baseline = load_baseline(commit)
+    print("{} {} @ {}".format(IMPLEMENTATION, sys.version.split()[0], (commit or "?")[:10]))
+    if baseline is not None:
+        print("comparing with {}".format((baseline.get("commit") or "?")[:10]))
+    print("{:<18} {:>12} {:>10} {:>10} {:>8}".format("case", "ops/s", "alloc B", "peak B", "vs base"))
+
+    results = {}
+    problems = []
+    for name, make in CASES:
+        if wanted and name not in wanted:
+            continue
+        step = make()
+        try:
+            step()  # warm up: first-call imports, dict growth, socket buffers
+            ops = time_case(step, target_us)
+            alloc, peak = heap_case(step, ALLOC_SAMPLES)
+        finally:
+            while open_sockets:
+                open_sockets.pop().close()
+        result = {"ops": ops, "alloc": alloc, "peak": peak}
+        results[name] = result
+        before = baseline["cases"].get(name) if baseline is not None else None
+        change = "{:+.0f}%".format(100 * (ops / before["ops"] - 1)) if before else ""
+        print("{:<18} {:>12.0f} {:>10.0f} {:>10} {:>8}".format(name, ops, alloc, peak, change))
+        if before:
+            problems.extend(compare(name, result, before))
+        gc.collect()
+
+    if store:
+        save({"commit": commit, "implementation": IMPLEMENTATION,
+              "version": sys.version.split()[0], "time": time.time(), "cases": results})
+    if problems:
+        for problem in problems:
+            print("REGRESSION " + problem)
+        sys.exit(1)
+
+
+main()
@@ -0,0 +1,191 @@
+# bench_publish.py
+# Host-side benchmark for the controller's umqtt PUBLISH path (umqtt.aio).
+#
+# Queues messages with MQTTClient.publish() and lets the client's own writer
+# task send them to an in-memory stream that counts write() calls and bytes,
+# so a change that splits packets into several writes (and therefore several
+# TCP segments on lwIP) shows up immediately. QoS1 cases are acknowledged
+# through the client's packet handler, as the reader task would, lagging
+# so the whole in-flight window stays in use. "new/pub" counts packet
+# buffers the client allocated per publish once warm (after its first
+# WINDOW publishes): QoS0 packets should come from its shared buffer and
+# QoS1 ones from its slot pool, so both should show 0.00.
+#
+#   python3 bench_publish.py            (CPython)
+#   micropython bench_publish.py        (MicroPython unix port)
+#
+# Also checks the async client's CONNECT packet byte for byte against
+# known-good packets (MQTT 3.1.1, section 3.1), since a malformed one is
+# only noticed when every broker refuses the connection.
+#
+# Exits with status 1 if any publish needs more than one write, a warm
+# publish allocates its packet, or a CONNECT packet differs.
+import sys
+
+HERE = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+sys.path.insert(0, HERE + "/../esp32_data")
+sys.path.insert(0, HERE)
+
+import firmware
+from umqtt import aio
+
+# time as the client sees it (ticks_ms() and friends on CPython too)
+device_time = firmware.time_module()
+aio.time = device_time
+ticks_us = device_time.ticks_us
+ticks_diff = device_time.ticks_diff
+asyncio = aio.asyncio
+
+ITERATIONS = 2000
+WINDOW = 4      # QoS1 publishes in flight
+
+TOPIC = b"environment/wiredin/data"
+# Typical controller state payload
+STATE = (b'{"heat_lamp": false, "fan": true, "humidifier": false, "servo": false, '
+         b'"take_over": false, "timestamp": 1745000000, "temperature": 23.4, '
+         b'"humidity": 51.2, "distance": 12.3}')
+
+
+class CountingWriter:
+    """Stands in for the broker stream: counts writes and bytes"""
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, buf):
+        self.writes += 1
+        self.bytes += len(buf)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+async def puback(client, pid):
+    """Deliver a PUBACK for pid as the reader task would"""
+    client._rx.space(2)[:2] = bytes((pid >> 8, pid & 0xFF))
+    client._rx.commit(2)
+    await client._handle_packet(0x40, 2)
+
+
+def new_buffers(client, seen):
+    """Packet buffers the client holds that are not in seen yet (then adds them).
+
+    seen keeps the buffers alive, so a new one cannot reuse an old one's id.
+    """
+    new = 0
+    bufs = [client._pkt_buf] + client._slots + [entry[3] for entry in client._inflight.values()]
+    for buf in bufs:
+        if id(buf) not in seen:
+            seen[id(buf)] = buf
+            new += 1
+    return new
+
+
+async def publish_all(client, payload, qos):
+    """Returns the buffers allocated by the publishes after the first WINDOW"""
+    writer = client._writer
+    unacked = []
+    seen = {}
+    new = 0
+    for i in range(ITERATIONS):
+        client.publish(TOPIC, payload, qos=qos)
+        written = writer.writes
+        while writer.writes == written:
+            await asyncio.sleep(0)
+        if qos:
+            unacked.append(client.pid)
+            if len(unacked) == WINDOW:
+                await puback(client, unacked.pop(0))
+        if i < WINDOW:
+            new_buffers(client, seen)
+        else:
+            new += new_buffers(client, seen)
+    return new
+
+
+def run(name, payload, qos):
+    writer = CountingWriter()
+    client = aio.MQTTClient("bench", "localhost", queue_size=1, inflight_window=WINDOW)
+    client._writer = writer
+    client.connected = True
+
+    async def main():
+        task = asyncio.create_task(client._writer_task())
+        start = ticks_us()
+        new = await publish_all(client, payload, qos)
+        elapsed = ticks_diff(ticks_us(), start)
+        task.cancel()
+        return elapsed, new
+
+    elapsed, new = asyncio.run(main())
+    writes = writer.writes / ITERATIONS
+    new = new / (ITERATIONS - WINDOW)
+    print("{:<22} {:>6} {:>10.2f} {:>8.2f} {:>12.1f} {:>10.1f}".format(
+        name, len(payload), writes, new, writer.bytes / ITERATIONS, elapsed / ITERATIONS))
+    return writes, new
+
+
+# (client id, clean session, keepalive, user, password, last will) -> packet
+CONNECT_CASES = (
+    ("bench", True, 0, None, None, None,
+     b"\x10\x11\x00\x04MQTT\x04\x02\x00\x00\x00\x05bench"),
+    ("terrarium_controller", False, 30, "u", "p", None,
+     b"\x10\x26\x00\x04MQTT\x04\xc0\x00\x1e\x00\x14terrarium_controller"
+     b"\x00\x01u\x00\x01p"),
+    ("bench", True, 60, None, None, (b"environment/controller/status", b"offline", True, 1),
+     b"\x10\x39\x00\x04MQTT\x04\x2e\x00\x3c\x00\x05bench"
+     b"\x00\x1denvironment/controller/status\x00\x07offline"),
+)
+
+
+def check_connect():
+    """Number of CONNECT cases whose packet differs from the known-good one"""
+    failed = 0
+    for client_id, clean, keepalive, user, password, will, expected in CONNECT_CASES:
+        client = aio.MQTTClient(client_id, "localhost", user=user, password=password,
+                                keepalive=keepalive)
+        if will is not None:
+            topic, msg, retain, qos = will
+            client.set_last_will(topic, msg, retain, qos)
+        packet = bytes(client._connect_packet(clean))
+        if packet != expected:
+            print("FAIL: CONNECT for {}: got {} expected {}".format(
+                client_id, packet.hex(), expected.hex()))
+            failed += 1
+    return failed
+
+
+def main():
+    print("{:<22} {:>6} {:>10} {:>8} {:>12} {:>10}".format(
+        "case", "len", "writes/pub", "new/pub", "bytes/pub", "us/pub"))
+    worst = 0
+    allocating = False
+    for name, payload, qos in (
+        ("state qos0", STATE, 0),
+        ("state qos1", STATE, 1),
+        ("small qos0", b'{"fan": true}', 0),
+        ("large qos0", STATE * 8, 0),
+        ("large qos1", STATE * 8, 1),
+    ):
+        writes, new = run(name, payload, qos)
+        worst = max(worst, writes)
+        if new:
+            allocating = True
+    failed = False
+    if worst > 1:
+        print("FAIL: publish needs more than one write per packet")
+        failed = True
+    if allocating:
+        print("FAIL: a warm publish allocated its packet buffer")
+        failed = True
+    if check_connect():
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+main()
@@ -0,0 +1,83 @@
+# bench_recv.py
+# Host-side benchmark for the umqtt incoming PUBLISH path.
+#
+# Feeds a burst of control messages (as an app slider streaming threshold
+# updates would) through MQTTClient.check_msg() from an in-memory socket and
+# reports socket reads and time per delivered message.
+#
+#   python3 bench_recv.py            (CPython)
+#   micropython bench_recv.py        (MicroPython unix port)
+import sys
+import time
+
+HERE = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+sys.path.insert(0, HERE + "/../esp32_data")
+from umqtt.simple import MQTTClient
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    ticks_us = lambda: int(time.perf_counter() * 1000000)
+    ticks_diff = lambda a, b: a - b
+
+MESSAGES = 2000
+TOPIC = b"environment/wiredin/control"
+
+
+class ReplaySocket:
+    """Returns the queued bytes in chunks of at most `chunk`, like a TCP stream"""
+
+    def __init__(self, data, chunk):
+        self._data = memoryview(data)
+        self._pos = 0
+        self._chunk = chunk
+        self.reads = 0
+
+    def readinto(self, buf):
+        self.reads += 1
+        n = min(len(buf), self._chunk, len(self._data) - self._pos)
+        if n == 0:
+            return None
+        buf[:n] = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def setblocking(self, flag):
+        pass
+
+    def write(self, buf, n=None):
+        return len(buf) if n is None else n
+
+
+def publish_packet(topic, msg):
+    body = bytes((len(topic) >> 8, len(topic) & 0xFF)) + topic + msg
+    return bytes((0x30, len(body))) + body
+
+
+def run(chunk):
+    stream = b"".join(publish_packet(TOPIC, b'{"temp_upper": %d.5}' % (20 + i % 10))
+                      for i in range(MESSAGES))
+    sock = ReplaySocket(stream, chunk)
+    client = MQTTClient("bench", "localhost")
+    client.sock = sock
+    delivered = [0]
+
+    def cb(topic, msg):
+        delivered[0] += 1
+
+    client.set_callback(cb)
+    start = ticks_us()
+    while delivered[0] < MESSAGES:
+        client.check_msg()
+    elapsed = ticks_diff(ticks_us(), start)
+    print("{:>8} {:>12.2f} {:>10.1f}".format(chunk, sock.reads / MESSAGES, elapsed / MESSAGES))
+
+
+def main():
+    print("{:>8} {:>12} {:>10}".format("chunk", "reads/msg", "us/msg"))
+    for chunk in (1460, 256, 64):
+        run(chunk)
+
+
+main()
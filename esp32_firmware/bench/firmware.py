@@ -0,0 +1,80 @@
+# firmware.py
+# Pulls individual functions out of a node's main.py for the benchmarks.
+#
+# The node scripts open radios and loop forever at import time, so they
+# cannot simply be imported. load() execs only the named top-level
+# definitions (functions, constants) into a namespace the caller seeds with
+# whatever those definitions refer to: real modules where they run on the
+# host (telemetry, tanks, state_codec), in-memory stand-ins for the rest.
+# The code being timed is the firmware's own, line for line.
+HERE = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+FIRMWARE = HERE + "/.."
+
+
+def _blocks(source):
+    """Top-level statements of source as (name, text) pairs"""
+    blocks = []
+    name = None
+    lines = []
+    for line in source.split("\n"):
+        if line and line[0] not in " \t#)]}":
+            if name is not None:
+                blocks.append((name, "\n".join(lines)))
+            name = None
+            lines = []
+            if line.startswith("def ") or line.startswith("async def "):
+                name = line.split("def ", 1)[1].split("(", 1)[0].strip()
+            elif " = " in line:
+                name = line.split(" = ", 1)[0].strip()
+        if name is not None:
+            lines.append(line)
+    if name is not None:
+        blocks.append((name, "\n".join(lines)))
+    return blocks
+
+
+def load(node, names, env):
+    """Exec the definitions of names from <node>/main.py into env and return it"""
+    with open(FIRMWARE + "/" + node + "/main.py") as f:
+        source = f.read()
+    found = {}
+    for name, text in _blocks(source):
+        if name in names:
+            found[name] = text
+    for name in names:
+        if name not in found:
+            raise KeyError("{} not defined in {}/main.py".format(name, node))
+        exec(found[name], env)
+    return env
+
+
+def sink(*args, **kwargs):
+    """print() replacement: the f-strings are still built, nothing is written"""
+
+
+class HostTime:
+    """MicroPython's time functions on CPython, for code that calls time.ticks_us()"""
+
+    def __init__(self):
+        import time
+        self._time = time
+        self.time = time.time
+        self.sleep = time.sleep
+
+    def ticks_us(self):
+        return int(self._time.perf_counter() * 1000000) & 0x3FFFFFFF
+
+    def ticks_ms(self):
+        return int(self._time.perf_counter() * 1000) & 0x3FFFFFFF
+
+    def ticks_diff(self, a, b):
+        return ((a - b + 0x20000000) & 0x3FFFFFFF) - 0x20000000
+
+    def ticks_add(self, a, b):
+        return (a + b) & 0x3FFFFFFF
+
+
+def time_module():
+    """The time module firmware code expects, on either implementation"""
+    import time
+    return time if hasattr(time, "ticks_us") else HostTime()
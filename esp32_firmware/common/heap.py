@@ -0,0 +1,134 @@
+# heap.py
+# Heap and garbage collector telemetry, and an allocation-driven GC policy.
+#
+#   start = heap.begin()
+#   ...one iteration of a loop...
+#   heap.end("receive", start)
+#   heap.maybe_collect()
+#
+# end() records the bytes a loop iteration allocated (gc.mem_alloc() before
+# and after; iterations the VM collected in are skipped). maybe_collect()
+# runs gc.collect() at that safe point once the allocation since the last
+# collection passes the threshold, instead of on a fixed counter or timer,
+# and times the pause. After each collection the threshold is re-derived
+# from the free heap (1/fraction of it, at least min_threshold), so a
+# fuller heap is collected sooner. gc.threshold() is set to twice that as a
+# backstop, in case a burst allocates faster than the safe points come.
+#
+# The policy only looks at the MicroPython heap, through gc.mem_alloc() and
+# gc.mem_free(). summary() also reports idf_largest_free, the largest free
+# block in ESP-IDF's C heap (sockets, WiFi and TLS buffers, and the room the
+# GC heap can grow into). That is a different heap, so it is informational
+# only: MicroPython has no call for the GC heap's largest free block.
+#
+# summary() is what the nodes publish in their diagnostics; reset() starts a
+# new interval (collections and their pauses, per-iteration allocation).
+import gc
+import time
+from array import array
+try:
+    import esp32
+except ImportError:
+    esp32 = None
+
+
+def idf_largest_free_block():
+    """Largest free block in ESP-IDF's data heap (not the GC heap), or None
+    where that cannot be asked for"""
+    if esp32 is None:
+        return None
+    try:
+        return max(region[2] for region in esp32.idf_heap_info(esp32.HEAP_DATA))
+    except (AttributeError, ValueError):
+        return None
+
+
+class HeapMonitor:
+
+    def __init__(self, loops=("loop",), min_threshold=8192, fraction=4):
+        self.min_threshold = min_threshold
+        self.fraction = fraction
+        # Per loop: iterations, bytes allocated, most in one iteration
+        self._loops = {name: array("i", [0, 0, 0]) for name in loops}
+        self.collections = 0
+        self.pause_total_us = 0
+        self.pause_max_us = 0
+        self.min_free = gc.mem_free()
+        self.threshold = min_threshold
+        self._alloc_after_gc = gc.mem_alloc()
+        self._set_threshold()
+
+    def _set_threshold(self):
+        self.threshold = max(self.min_threshold, gc.mem_free() // self.fraction)
+        gc.threshold(2 * self.threshold)
+
+    def begin(self):
+        """Allocation counter to pass to end()"""
+        return gc.mem_alloc()
+
+    def end(self, loop, start):
+        """Record one iteration of loop, started when begin() returned start"""
+        allocated = gc.mem_alloc() - start
+        if allocated < 0:
+            return  # The VM collected during the iteration
+        stats = self._loops[loop]
+        stats[0] += 1
+        stats[1] += allocated
+        if allocated > stats[2]:
+            stats[2] = allocated
+
+    def maybe_collect(self):
+        """Collect if enough has been allocated since the last collection"""
+        if gc.mem_alloc() - self._alloc_after_gc < self.threshold:
+            return False
+        self.collect()
+        return True
+
+    def collect(self):
+        start = time.ticks_us()
+        gc.collect()
+        pause = time.ticks_diff(time.ticks_us(), start)
+        self.collections += 1
+        self.pause_total_us += pause
+        if pause > self.pause_max_us:
+            self.pause_max_us = pause
+        self._alloc_after_gc = gc.mem_alloc()
+        free = gc.mem_free()
+        if free < self.min_free:
+            self.min_free = free
+        self._set_threshold()
+
+    def summary(self):
+        free = gc.mem_free()
+        if free < self.min_free:
+            self.min_free = free
+        out = {
+            "free": free,
+            "alloc": gc.mem_alloc(),
+            "min_free": self.min_free,
+            "threshold": self.threshold,
+            "collections": self.collections,
+        }
+        largest = idf_largest_free_block()
+        if largest is not None:
+            out["idf_largest_free"] = largest
+        if self.collections:
+            out["pause_us"] = {"mean": self.pause_total_us // self.collections,
+                               "max": self.pause_max_us}
+        per_iteration = {}
+        for name, stats in self._loops.items():
+            if stats[0]:
+                per_iteration[name] = {"n": stats[0], "mean": stats[1] // stats[0], "max": stats[2]}
+        if per_iteration:
+            out["alloc_per_iter"] = per_iteration
+        return out
+
+    def reset(self):
+        self.collections = 0
+        self.pause_total_us = 0
+        self.pause_max_us = 0
+        self.min_free = gc.mem_free()
+        for stats in self._loops.values():
+            stats[0] = 0
+            stats[1] = 0
+            stats[2] = 0
@@ -0,0 +1,115 @@
+# log.py
+# Levelled logging for the firmware's hot loops. Copy this file onto every
+# board next to main.py.
+#
+#   log.info("Command #{} acknowledged by {}", seq, tank.name)
+#   if __debug__:
+#       log.debug("Received frame #{} (flags 0x{:02x})", seq, flags)
+#
+# A call takes a str.format() template and up to four arguments. If its
+# level is recorded, the template and the argument references go into a
+# preallocated ring of the last RING_SIZE entries: nothing is formatted and
+# nothing is allocated. Only entries at or above the echo level are also
+# formatted and printed, so with echo at WARN or above the normal path never
+# builds a string or waits on the UART. lines() formats the ring on demand
+# (the controller publishes it over MQTT).
+#
+# Arguments are kept by reference until the entry is overwritten: pass
+# values, not buffers that are about to be reused.
+#
+# Release builds: debug calls sit inside `if __debug__:`, which MicroPython
+# compiles away entirely at optimisation level 1 or above (RELEASE in
+# boot.py, or mpy-cross -O1). That level also strips assert statements.
+from array import array
+try:
+    from time import ticks_ms
+except ImportError:
+    # CPython (host tools, benchmarks): same 30-bit wrapping counter
+    import time
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000) & 0x3FFFFFFF
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+OFF = 100
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARN: "WARN", ERROR: "ERROR"}
+
+RING_SIZE = 64
+ARGS = 4  # arguments kept per entry
+
+_level = INFO
+_echo = INFO
+_next = 0
+_count = 0
+_ticks = array("i", [0] * RING_SIZE)
+_levels = bytearray(RING_SIZE)
+_templates = [None] * RING_SIZE
+_args = [None] * (RING_SIZE * ARGS)
+
+
+def configure(level=INFO, echo=INFO):
+    """Record entries at level and above; also print those at echo and above"""
+    global _level, _echo
+    _level = level
+    _echo = echo
+
+
+def _log(level, template, a, b, c, d):
+    global _next, _count
+    if level >= _level:
+        i = _next
+        _ticks[i] = ticks_ms()
+        _levels[i] = level
+        _templates[i] = template
+        j = i * ARGS
+        _args[j] = a
+        _args[j + 1] = b
+        _args[j + 2] = c
+        _args[j + 3] = d
+        _next = i + 1 if i + 1 < RING_SIZE else 0
+        if _count < RING_SIZE:
+            _count += 1
+    if level >= _echo:
+        # str.format() ignores the unused trailing arguments
+        print(template.format(a, b, c, d))
+
+
+def debug(template, a=None, b=None, c=None, d=None):
+    _log(DEBUG, template, a, b, c, d)
+
+
+def info(template, a=None, b=None, c=None, d=None):
+    _log(INFO, template, a, b, c, d)
+
+
+def warn(template, a=None, b=None, c=None, d=None):
+    _log(WARN, template, a, b, c, d)
+
+
+def error(template, a=None, b=None, c=None, d=None):
+    _log(ERROR, template, a, b, c, d)
+
+
+def lines():
+    """The ring's entries, oldest first, each as "<ticks_ms> <LEVEL> <message>\""""
+    out = []
+    for n in range(_count):
+        i = (_next - _count + n) % RING_SIZE
+        j = i * ARGS
+        try:
+            message = _templates[i].format(_args[j], _args[j + 1], _args[j + 2], _args[j + 3])
+        except Exception as err:
+            message = "{} (format error: {})".format(_templates[i], err)
+        out.append("{} {} {}".format(_ticks[i], LEVEL_NAMES.get(_levels[i], _levels[i]), message))
+    return out
+
+
+def clear():
+    global _next, _count
+    _next = 0
+    _count = 0
+    for i in range(RING_SIZE * ARGS):
+        _args[i] = None
@@ -0,0 +1,308 @@
+# telemetry.py
+# Binary ESP-NOW frames shared by the sensor node, the master controller and
+# the actuator node. Copy this file onto every board next to main.py.
+import struct
+
+# Every binary frame starts with the version byte. Text messages always start
+# with a printable ASCII character, so a first byte below 0x20 tells the
+# receiver it is looking at a binary frame.
+FRAME_VERSION = 1
+
+# Message types (second byte of the frame)
+MSG_READING = 0x01
+MSG_AGGREGATE = 0x02
+MSG_CONFIG = 0x03
+MSG_COMMAND = 0x04
+MSG_COMMAND_ACK = 0x05
+MSG_ZONES = 0x06
+
+# Sensor node reporting modes (carried in MSG_CONFIG)
+MODE_RAW = 0          # one reading per measurement interval
+MODE_AGGREGATE = 1    # one aggregate per window, sampled at a higher rate
+MODE_DELTA = 2        # sampled per measurement interval, sent on change or heartbeat
+
+# Status flags
+FLAG_TEMP_HUMID = 0x01   # temperature/humidity fields are valid
+FLAG_DISTANCE = 0x02     # distance field is valid
+FLAG_SHT_ERROR = 0x04    # SHT4x missing or failed to read
+FLAG_DIST_ERROR = 0x08   # HC-SR04 missing, failed or out of range
+
+# Actuator bits in command frames (1 = on; for the servo, 1 = closed)
+ACT_HEAT = 0x01
+ACT_FAN = 0x02
+ACT_HUMID = 0x04
+ACT_SERVO = 0x08
+ACT_ALL = 0x0F
+
+# version, type, seq, timestamp (ms), temp (0.01 C), humidity (0.01 %),
+# distance (mm), flags
+READING_FORMAT = "<BBHIhHHB"
+READING_SIZE = struct.calcsize(READING_FORMAT)  # 15 bytes
+
+# A reading from a node with several SHT4x probes: a reading frame's layout
+# (temperature/humidity being the weighted mean over the zones), then the
+# zone count and per zone temp (0.01 C), humidity (0.01 %) and zone flags.
+# Latency trailers follow the last zone.
+ZONES_FORMAT = "<BBHIhHHBB"
+ZONES_SIZE = struct.calcsize(ZONES_FORMAT)  # 16 bytes
+ZONE_FORMAT = "<hHB"
+ZONE_SIZE = struct.calcsize(ZONE_FORMAT)  # 5 bytes
+ZONE_VALID = 0x01
+
+# version, type, seq, timestamp (ms), window length (ms),
+# SHT sample count, temp min/max/mean/last (0.01 C),
+# humidity min/max/mean/last (0.01 %),
+# distance sample count, distance min/max/mean/last/median (mm), flags
+# The sample counts saturate at 255; the statistics still cover every
+# sample in the window (the median a uniform sample of up to 255 of them).
+AGGREGATE_FORMAT = "<BBHII" + "Bhhhh" + "HHHH" + "BHHHHH" + "B"
+AGGREGATE_SIZE = struct.calcsize(AGGREGATE_FORMAT)  # 41 bytes
+
+# version, type, mode, window (ms), SHT interval (ms), distance interval (ms)
+# In MODE_RAW the window is the measurement interval and the sample
+# intervals are ignored. A zero field leaves that setting unchanged.
+CONFIG_FORMAT = "<BBBIHH"
+CONFIG_SIZE = struct.calcsize(CONFIG_FORMAT)  # 11 bytes
+
+# Optional trailer after a config frame, for MODE_DELTA: temperature
+# deadband (0.01 C), humidity deadband (0.01 %), distance deadband (mm),
+# heartbeat (s), fast reporting (s from now, every sample is sent). Zero
+# fields leave the setting unchanged, as in the frame itself.
+DELTA_CONFIG_FORMAT = "<HHHHH"
+DELTA_CONFIG_SIZE = struct.calcsize(DELTA_CONFIG_FORMAT)  # 10 bytes
+
+# version, type, seq, mask (actuators to set), target states
+COMMAND_FORMAT = "<BBHBB"
+COMMAND_SIZE = struct.calcsize(COMMAND_FORMAT)  # 6 bytes
+
+# version, type, seq of the command, actuator states after applying it
+COMMAND_ACK_FORMAT = "<BBHB"
+COMMAND_ACK_SIZE = struct.calcsize(COMMAND_ACK_FORMAT)  # 5 bytes
+
+# Optional trailer after a reading frame or a command ACK: a stage duration
+# in microseconds timed on the sending node (sample -> send on the sensor,
+# command received -> relays switched on the actuator). Receivers that do
+# not know it only unpack the fixed-size prefix and never see it. A sensor
+# node waking from light sleep appends a second one to its reading frames,
+# at READING_SIZE + LATENCY_SIZE: wake -> send.
+LATENCY_FORMAT = "<I"
+LATENCY_SIZE = struct.calcsize(LATENCY_FORMAT)  # 4 bytes
+
+
+def is_binary(msg):
+    """Return True if msg looks like a binary frame rather than a text message"""
+    return len(msg) >= 2 and msg[0] == FRAME_VERSION
+
+
+def encode_reading(buf, seq, timestamp_ms, temperature, humidity, distance, flags=0):
+    """Pack a sensor reading into buf (a bytearray of at least READING_SIZE).
+
+    temperature/humidity are in C and %, distance in cm. Pass None for any
+    value that is not available; the matching valid flag is set automatically.
+    """
+    temp_fixed = 0
+    humid_fixed = 0
+    dist_fixed = 0
+    if temperature is not None and humidity is not None:
+        temp_fixed = int(round(temperature * 100))
+        humid_fixed = int(round(humidity * 100))
+        flags |= FLAG_TEMP_HUMID
+    if distance is not None:
+        dist_fixed = int(round(distance * 10))
+        flags |= FLAG_DISTANCE
+    struct.pack_into(READING_FORMAT, buf, 0,
+                     FRAME_VERSION, MSG_READING,
+                     seq & 0xFFFF, timestamp_ms & 0xFFFFFFFF,
+                     temp_fixed, humid_fixed, dist_fixed, flags)
+    return buf
+
+
+def decode_reading(msg):
+    """Unpack a reading frame straight from the received buffer.
+
+    Returns (seq, timestamp_ms, temperature, humidity, distance, flags) with
+    None for values whose valid flag is not set.
+    """
+    _, _, seq, timestamp_ms, temp_fixed, humid_fixed, dist_fixed, flags = \
+        struct.unpack_from(READING_FORMAT, msg, 0)
+    if flags & FLAG_TEMP_HUMID:
+        temperature = temp_fixed / 100
+        humidity = humid_fixed / 100
+    else:
+        temperature = None
+        humidity = None
+    distance = dist_fixed / 10 if flags & FLAG_DISTANCE else None
+    return seq, timestamp_ms, temperature, humidity, distance, flags
+
+
+def zones_size(count):
+    """Length of a zones frame with count zones, without trailers"""
+    return ZONES_SIZE + count * ZONE_SIZE
+
+
+def encode_zones(buf, seq, timestamp_ms, temperature, humidity, distance, flags,
+                 temperatures, humidities, valid):
+    """Pack a multi-zone reading into buf (at least zones_size(len(valid)) bytes).
+
+    temperature/humidity are the weighted means (None if no zone read);
+    temperatures/humidities/valid hold one entry per zone, valid being
+    non-zero for the zones that read this time.
+    """
+    encode_reading(buf, seq, timestamp_ms, temperature, humidity, distance, flags)
+    buf[1] = MSG_ZONES
+    count = len(valid)
+    buf[ZONES_SIZE - 1] = count
+    offset = ZONES_SIZE
+    for i in range(count):
+        if valid[i]:
+            struct.pack_into(ZONE_FORMAT, buf, offset, int(round(temperatures[i] * 100)),
+                             int(round(humidities[i] * 100)), ZONE_VALID)
+        else:
+            struct.pack_into(ZONE_FORMAT, buf, offset, 0, 0, 0)
+        offset += ZONE_SIZE
+    return offset
+
+
+def decode_zones(msg):
+    """Unpack a zones frame.
+
+    Returns (seq, timestamp_ms, temperature, humidity, distance, flags,
+    zones) like decode_reading(), zones being a list of (temperature,
+    humidity) tuples, None for a zone that did not read.
+    """
+    seq, timestamp_ms, temperature, humidity, distance, flags = decode_reading(msg)
+    zones = []
+    offset = ZONES_SIZE
+    for _ in range(msg[ZONES_SIZE - 1]):
+        temp_fixed, humid_fixed, zone_flags = struct.unpack_from(ZONE_FORMAT, msg, offset)
+        zones.append((temp_fixed / 100, humid_fixed / 100) if zone_flags & ZONE_VALID else None)
+        offset += ZONE_SIZE
+    return seq, timestamp_ms, temperature, humidity, distance, flags, zones
+
+
+def _fixed(value, scale):
+    return int(round(value * scale)) if value is not None else 0
+
+
+def encode_aggregate(buf, seq, timestamp_ms, window_ms, temp, humid, dist, flags=0):
+    """Pack one aggregation window into buf (at least AGGREGATE_SIZE bytes).
+
+    temp/humid/dist are window objects exposing count, min, max, last and
+    mean(); dist must also provide median(). Channels with no samples are sent
+    with a zero count and their valid flag cleared.
+    """
+    sht_count = min(temp.count, 255)
+    dist_count = min(dist.count, 255)
+    if sht_count:
+        flags |= FLAG_TEMP_HUMID
+    if dist_count:
+        flags |= FLAG_DISTANCE
+    struct.pack_into(AGGREGATE_FORMAT, buf, 0,
+                     FRAME_VERSION, MSG_AGGREGATE,
+                     seq & 0xFFFF, timestamp_ms & 0xFFFFFFFF, window_ms,
+                     sht_count,
+                     _fixed(temp.min, 100), _fixed(temp.max, 100),
+                     _fixed(temp.mean(), 100), _fixed(temp.last, 100),
+                     _fixed(humid.min, 100), _fixed(humid.max, 100),
+                     _fixed(humid.mean(), 100), _fixed(humid.last, 100),
+                     dist_count,
+                     _fixed(dist.min, 10), _fixed(dist.max, 10),
+                     _fixed(dist.mean(), 10), _fixed(dist.last, 10),
+                     _fixed(dist.median(), 10),
+                     flags)
+    return buf
+
+
+def decode_aggregate(msg):
+    """Unpack an aggregate frame.
+
+    Returns (seq, timestamp_ms, window_ms, temp, humid, dist, flags) where
+    temp/humid are (count, min, max, mean, last) tuples in C/%, dist is
+    (count, min, max, mean, last, median) in cm, or None when the channel
+    had no samples.
+    """
+    f = struct.unpack_from(AGGREGATE_FORMAT, msg, 0)
+    flags = f[20]
+    temp = None
+    humid = None
+    dist = None
+    if flags & FLAG_TEMP_HUMID:
+        temp = (f[5], f[6] / 100, f[7] / 100, f[8] / 100, f[9] / 100)
+        humid = (f[5], f[10] / 100, f[11] / 100, f[12] / 100, f[13] / 100)
+    if flags & FLAG_DISTANCE:
+        dist = (f[14], f[15] / 10, f[16] / 10, f[17] / 10, f[18] / 10, f[19] / 10)
+    return f[2], f[3], f[4], temp, humid, dist, flags
+
+
+def encode_config(mode, window_ms, sht_interval_ms, distance_interval_ms, delta=None):
+    """Build a controller -> sensor node configuration frame.
+
+    delta, if given, is (temp deadband C, humidity deadband %, distance
+    deadband cm, heartbeat s, fast reporting s) for the MODE_DELTA trailer.
+    """
+    frame = struct.pack(CONFIG_FORMAT, FRAME_VERSION, MSG_CONFIG, mode,
+                        window_ms, sht_interval_ms, distance_interval_ms)
+    if delta is not None:
+        temp_deadband, humid_deadband, distance_deadband, heartbeat_s, fast_s = delta
+        frame += struct.pack(DELTA_CONFIG_FORMAT, round(temp_deadband * 100),
+                             round(humid_deadband * 100), round(distance_deadband * 10),
+                             heartbeat_s, fast_s)
+    return frame
+
+
+def decode_config(msg):
+    """Returns (mode, window_ms, sht_interval_ms, distance_interval_ms)"""
+    _, _, mode, window_ms, sht_interval_ms, distance_interval_ms = \
+        struct.unpack_from(CONFIG_FORMAT, msg, 0)
+    return mode, window_ms, sht_interval_ms, distance_interval_ms
+
+
+def decode_delta_config(msg):
+    """Returns the MODE_DELTA trailer as encode_config() takes it, or None if absent"""
+    if len(msg) < CONFIG_SIZE + DELTA_CONFIG_SIZE:
+        return None
+    temp, humid, distance, heartbeat_s, fast_s = struct.unpack_from(DELTA_CONFIG_FORMAT, msg, CONFIG_SIZE)
+    return temp / 100, humid / 100, distance / 10, heartbeat_s, fast_s
+
+
+def encode_latency(buf, offset, duration_us):
+    """Write the latency trailer at offset (READING_SIZE or COMMAND_ACK_SIZE)"""
+    struct.pack_into(LATENCY_FORMAT, buf, offset, duration_us & 0xFFFFFFFF)
+    return buf
+
+
+def decode_latency(msg, offset):
+    """Latency trailer in microseconds, or None if the frame has none"""
+    if len(msg) < offset + LATENCY_SIZE:
+        return None
+    return struct.unpack_from(LATENCY_FORMAT, msg, offset)[0]
+
+
+def encode_command(buf, seq, mask, states):
+    """Pack a controller -> actuator command into buf (at least COMMAND_SIZE).
+
+    Every actuator whose bit is set in mask is switched to its bit in states;
+    the others are left alone.
+    """
+    struct.pack_into(COMMAND_FORMAT, buf, 0, FRAME_VERSION, MSG_COMMAND,
+                     seq & 0xFFFF, mask, states)
+    return buf
+
+
+def decode_command(msg):
+    """Returns (seq, mask, states)"""
+    _, _, seq, mask, states = struct.unpack_from(COMMAND_FORMAT, msg, 0)
+    return seq, mask, states
+
+
+def encode_command_ack(buf, seq, states):
+    """Pack the actuator's reply to command seq (buf at least COMMAND_ACK_SIZE)"""
+    struct.pack_into(COMMAND_ACK_FORMAT, buf, 0, FRAME_VERSION, MSG_COMMAND_ACK,
+                     seq & 0xFFFF, states)
+    return buf
+
+
+def decode_command_ack(msg):
+    """Returns (seq, states)"""
+    _, _, seq, states = struct.unpack_from(COMMAND_ACK_FORMAT, msg, 0)
+    return seq, states
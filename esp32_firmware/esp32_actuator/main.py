@@ -2,10 +2,19 @@ import network
 import espnow
 from machine import Pin, PWM
 import time
-import gc
+import json
 import machine
+import telemetry
+import log
+from heap import HeapMonitor
 
 # === CONFIGURATION ===
+# Logging (see log.py): levels recorded in the RAM ring (log.lines() from
+# the REPL) and printed on the console; log.WARN for production
+LOG_LEVEL = log.INFO
+LOG_ECHO_LEVEL = log.INFO
+log.configure(LOG_LEVEL, LOG_ECHO_LEVEL)
+
 # Reset WiFi
 sta = network.WLAN(network.STA_IF)
 sta.active(False)
@@ -68,6 +77,8 @@ except:
 last_received = time.time()
 last_heartbeat = time.time()
 connection_timeout = 30  # seconds
+last_heap_report = time.time()
+heap_report_interval = 60  # seconds; the controller publishes it with its diagnostics
 
 # === FUNCTIONS ===
 def set_actuator(device, state):
@@ -78,43 +89,76 @@ def set_actuator(device, state):
         heat_lamp_state = state
         if state:
             heat_lamp_relay.on()  # Active LOW - off() turns relay ON
-            print("Heat lamp set to ON")
+            log.info("Heat lamp set to ON")
         else:
             heat_lamp_relay.off()   # Active LOW - on() turns relay OFF
-            print("Heat lamp set to OFF")
+            log.info("Heat lamp set to OFF")
             
     elif device == "fan":
         fan_state = state
         if state:
             fan_relay.on()  # Active LOW - off() turns relay ON
-            print("Fan set to ON")
+            log.info("Fan set to ON")
         else:
             fan_relay.off()   # Active LOW - on() turns relay OFF
-            print("Fan set to OFF")
+            log.info("Fan set to OFF")
             
     elif device == "humid":
         humidifier_state = state
         if state:
             humidifier_relay.on()  # Active LOW - off() turns relay ON
-            print("Humidifier set to ON")
+            log.info("Humidifier set to ON")
         else:
             humidifier_relay.off()   # Active LOW - on() turns relay OFF
-            print("Humidifier set to OFF")
+            log.info("Humidifier set to OFF")
             
     elif device == "servo":
         servo_state = state
         if state:
             set_servo_angle(200)
-            print("Servo set to OPEN")
+            log.info("Servo set to OPEN")
         else:
             set_servo_angle(90)
-            print("Servo set to CLOSED")
+            log.info("Servo set to CLOSED")
             
     else:
         return False
     
     return True
 
+# Command frame bit i switches ACTUATOR_DEVICES[i] (telemetry.ACT_HEAT, ...)
+ACTUATOR_DEVICES = ("heat", "fan", "humid", "servo")
+
+def state_bits():
+    """Current actuator states as command-frame bits"""
+    bits = 0
+    if heat_lamp_state:
+        bits |= telemetry.ACT_HEAT
+    if fan_state:
+        bits |= telemetry.ACT_FAN
+    if humidifier_state:
+        bits |= telemetry.ACT_HUMID
+    if servo_state:
+        bits |= telemetry.ACT_SERVO
+    return bits
+
+def apply_command(mask, states):
+    """Switch every actuator in mask to its bit in states in one pass; returns the new state bits"""
+    for i in range(len(ACTUATOR_DEVICES)):
+        bit = 1 << i
+        if mask & bit:
+            set_actuator(ACTUATOR_DEVICES[i], bool(states & bit))
+    return state_bits()
+
+def send_heap_report():
+    """Send the heap statistics of the last interval to the controller and start a new one"""
+    # One loop's summary stays under the 250-byte ESP-NOW payload
+    try:
+        e.send(sender_mac, "HEAP:" + json.dumps(heap.summary()))
+        heap.reset()
+    except Exception as err:
+        log.error("Heap report failed: {}", err)
+
 def send_status():
     """Send current actuator status to the controller"""
     try:
@@ -131,15 +175,18 @@ except:
     pass
 
 # === MAIN LOOP ===
-iteration_counter = 0
+heap = HeapMonitor()
+start = None
+ack_buf = bytearray(telemetry.COMMAND_ACK_SIZE + telemetry.LATENCY_SIZE)
+last_command_seq = None  # a retransmitted command is acknowledged again, not re-applied
 
 while True:
     try:
-        # Periodic garbage collection
-        iteration_counter += 1
-        if iteration_counter >= 500:
-            gc.collect()
-            iteration_counter = 0
+        # Account the last iteration's allocation; collect once enough has built up
+        if start is not None:
+            heap.end("loop", start)
+            heap.maybe_collect()
+        start = heap.begin()
         
         current_time = time.time()
         
@@ -148,6 +195,10 @@ while True:
             last_heartbeat = current_time
             send_status()
         
+        if current_time - last_heap_report >= heap_report_interval:
+            last_heap_report = current_time
+            send_heap_report()
+        
         # Check for connection timeout
         if current_time - last_received > connection_timeout:
             # Try to refresh the connection
@@ -163,11 +214,29 @@ while True:
         host, msg = e.irecv(100)  # 100ms timeout
         
         if msg:
+            received_us = time.ticks_us()
             last_received = current_time
             
             try:
-                # Print raw message for debugging
-                print(f"Received message: {msg}")
+                # Raw message for debugging (copied: irecv reuses its buffer)
+                if __debug__:
+                    log.debug("Received message: {}", bytes(msg))
+                
+                # Binary command frame: all actuators at once, one acknowledgment
+                if telemetry.is_binary(msg) and msg[1] == telemetry.MSG_COMMAND:
+                    seq, mask, states = telemetry.decode_command(msg)
+                    if seq == last_command_seq:
+                        # Our ACK was lost and the controller resent the command
+                        applied = state_bits()
+                    else:
+                        applied = apply_command(mask, states)
+                        last_command_seq = seq
+                    telemetry.encode_command_ack(ack_buf, seq, applied)
+                    # Receive -> relays switched, for the controller's latency histograms
+                    telemetry.encode_latency(ack_buf, telemetry.COMMAND_ACK_SIZE,
+                                             time.ticks_diff(time.ticks_us(), received_us))
+                    e.send(host, ack_buf)
+                    continue
                 
                 # Try to decode the message
                 try:
@@ -200,14 +269,13 @@ while True:
                         
                 except UnicodeError as decode_err:
                     # If UTF-8 decoding fails, try to interpret as bytes
-                    print(f"Unicode decode error: {decode_err}")
-                    print(f"Message as bytes: {[hex(b) for b in msg]}")
+                    log.warn("Unicode decode error: {} (message {})", decode_err, bytes(msg))
                     
             except Exception as err:
-                print(f"Error processing message: {err}")
+                log.error("Error processing message: {}", err)
     
     except Exception as err:
-        print(f"Main loop error: {err}")
+        log.error("Main loop error: {}", err)
     
     # Small delay
     time.sleep(0.05)
\ No newline at end of file
@@ -8,6 +8,13 @@ import struct
 
 print('Board Reset and Running Boot')
 
+# Release build: main.py is compiled at optimisation level 1, which drops
+# the `if __debug__:` debug logging (see log.py) and asserts entirely
+RELEASE = False
+if RELEASE:
+    import micropython
+    micropython.opt_level(1)
+
 # WiFi credentials
 SSID = ""
 PASSWORD = ""
@@ -0,0 +1,94 @@
+# command_link.py
+# Acknowledged delivery of command frames to the actuator nodes.
+#
+# Commands carry the full actuator state, so only the newest one per
+# actuator matters: submit() replaces whatever was still pending for that
+# MAC. run() retransmits the pending frame whenever its timer expires,
+# doubling the timeout from min_timeout_ms up to max_timeout_ms, until the
+# MSG_COMMAND_ACK with the same sequence number is passed to ack(). Sends
+# are fire-and-forget (no waiting for the radio's link-layer ack) and
+# nothing here ever sleeps outside run()'s timer wait, so the receive and
+# control tasks are never blocked.
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+import time
+import log
+
+
+class CommandLink:
+
+    def __init__(self, send, min_timeout_ms=100, max_timeout_ms=2000,
+                 stall_attempts=6, on_stall=None):
+        """send(mac, frame) transmits a frame without blocking.
+
+        on_stall(mac) is called every stall_attempts unanswered transmissions
+        (e.g. to re-add the peer); retransmission carries on regardless.
+        """
+        self._send = send
+        self.min_timeout_ms = min_timeout_ms
+        self.max_timeout_ms = max_timeout_ms
+        self.stall_attempts = stall_attempts
+        self.on_stall = on_stall
+        self._pending = {}   # mac -> [seq, frame, deadline, timeout, attempts]
+        self._wake = asyncio.Event()
+        self.retransmits = 0
+
+    def submit(self, mac, seq, frame):
+        """Send frame now and keep resending it until ack(mac, seq)"""
+        frame = bytes(frame)
+        self._transmit(mac, frame)
+        self._pending[mac] = [seq, frame,
+                              time.ticks_add(time.ticks_ms(), self.min_timeout_ms),
+                              self.min_timeout_ms, 1]
+        self._wake.set()
+
+    def ack(self, mac, seq):
+        """Match an acknowledgment; returns True if it completed the pending command"""
+        entry = self._pending.get(mac)
+        if entry is None or entry[0] != seq:
+            return False  # Stale ack for a superseded command, or a duplicate
+        del self._pending[mac]
+        return True
+
+    def pending(self, mac):
+        return mac in self._pending
+
+    def _transmit(self, mac, frame):
+        try:
+            self._send(mac, frame)
+        except OSError as err:
+            # The retransmit timer covers this too
+            log.error("Command send error: {}", err)
+
+    def _service(self):
+        """Retransmit everything that is due; returns ms until the next deadline"""
+        now = time.ticks_ms()
+        wait = None
+        for mac, entry in list(self._pending.items()):
+            remaining = time.ticks_diff(entry[2], now)
+            if remaining <= 0:
+                entry[3] = min(entry[3] * 2, self.max_timeout_ms)
+                entry[2] = time.ticks_add(now, entry[3])
+                entry[4] += 1
+                self.retransmits += 1
+                if self.on_stall and entry[4] % self.stall_attempts == 0:
+                    self.on_stall(mac)
+                self._transmit(mac, entry[1])
+                remaining = entry[3]
+            if wait is None or remaining < wait:
+                wait = remaining
+        return wait
+
+    async def run(self):
+        while True:
+            wait = self._service()
+            self._wake.clear()
+            if wait is None:
+                await self._wake.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait / 1000)
+            except asyncio.TimeoutError:
+                pass
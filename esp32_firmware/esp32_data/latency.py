@@ -0,0 +1,104 @@
+# latency.py
+# Streaming latency histograms for the sensor -> relay control path.
+#
+# Each stage keeps a fixed log-scale histogram (four buckets per power of
+# two, so a reported value is at most ~25% above the true one) of
+# microsecond durations. Recording is allocation-free; percentiles are read
+# off the cumulative counts when the summary is published.
+#
+# Stages:
+#   wake     sensor: woke from light sleep -> frame sent (LOW_POWER nodes,
+#            reported in the frame's second trailer)
+#   sample   sensor: SHT4x sample started -> frame sent (reported in the frame)
+#   receive  controller: frame received -> control decision started
+#   decide   controller: decision started -> command frame sent
+#   command  controller: command sent -> actuator ACK received (round trip)
+#   actuate  actuator: command received -> relays switched (reported in the ACK)
+#   total    sample + receive + decide + command, i.e. sample -> ACK back at
+#            the controller; the ACK's return hop stands in for the
+#            (unmeasurable, unsynchronised) sensor -> controller hop
+from array import array
+
+STAGES = ("wake", "sample", "receive", "decide", "command", "actuate", "total")
+
+SUB_BUCKETS = 4
+BUCKETS = SUB_BUCKETS + 30 * SUB_BUCKETS   # durations up to ~2^32 us
+
+
+def bucket_index(us):
+    if us < SUB_BUCKETS:
+        return us
+    shift = 0
+    while (us >> shift) >= 2 * SUB_BUCKETS:
+        shift += 1
+    index = SUB_BUCKETS + shift * SUB_BUCKETS + (us >> shift) - SUB_BUCKETS
+    return index if index < BUCKETS else BUCKETS - 1
+
+
+def bucket_upper(index):
+    """Largest duration that falls into bucket index"""
+    if index < SUB_BUCKETS:
+        return index
+    shift, sub = divmod(index - SUB_BUCKETS, SUB_BUCKETS)
+    return ((SUB_BUCKETS + sub + 1) << shift) - 1
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = array("I", [0] * BUCKETS)
+        self.count = 0
+        self.max = 0
+
+    def record(self, us):
+        if us < 0:
+            us = 0
+        self.counts[bucket_index(us)] += 1
+        self.count += 1
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        target = (self.count * p + 99) // 100
+        seen = 0
+        for i in range(BUCKETS):
+            seen += self.counts[i]
+            if seen >= target:
+                return min(bucket_upper(i), self.max)
+        return self.max
+
+    def reset(self):
+        for i in range(BUCKETS):
+            self.counts[i] = 0
+        self.count = 0
+        self.max = 0
+
+
+class LatencyStats:
+    """One histogram per stage"""
+
+    def __init__(self, stages=STAGES):
+        self.histograms = {stage: Histogram() for stage in stages}
+
+    def record(self, stage, us):
+        self.histograms[stage].record(us)
+
+    def summary(self):
+        """{stage: {"n", "p50", "p95", "p99", "max"}} for stages with samples"""
+        out = {}
+        for stage, histogram in self.histograms.items():
+            if histogram.count:
+                out[stage] = {
+                    "n": histogram.count,
+                    "p50": histogram.percentile(50),
+                    "p95": histogram.percentile(95),
+                    "p99": histogram.percentile(99),
+                    "max": histogram.max,
+                }
+        return out
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
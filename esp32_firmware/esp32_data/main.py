@@ -1,10 +1,22 @@
 import network
-import espnow
+import aioespnow
+import uasyncio as asyncio
 from machine import Pin
 import time
 import json
-import gc
-from umqtt.simple import MQTTClient
+import telemetry
+from router import MessageRouter
+from umqtt.aio import MQTTClient
+from umqtt.reconnect import ReconnectManager
+from state_codec import StatePublisher
+import store_forward
+import os
+import tanks
+from tanks import Tank, TankTable, mac_from_str
+from command_link import CommandLink
+from latency import LatencyStats
+from heap import HeapMonitor
+import log
 
 # ===== CONFIGURATION =====
 # Global variables
@@ -16,32 +28,82 @@ mqtt_connected = False
 SSID = "Berkeley-IoT"
 PASSWORD = "r8S&g9KH"
 
-# Thresholds
+# Default thresholds for every tank (each tank's own copy can be changed from the app)
 TEMP_LOWER = 20.0    # Below this temperature, heat lamp ON
 TEMP_UPPER = 25.0    # Above this temperature, fan ON
 HUMID_LOWER = 35.0   # Below this humidity, humidifier ON
 HUMID_UPPER = 65.0   # Above this humidity, fan ON
 DISTANCE_THRESHOLD = 8.0  # Below this distance (in cm), close servo; above, open servo
 
+# A send-on-delta sensor node (telemetry.MODE_DELTA) is asked for every
+# sample for FAST_REPORT_S while a reading is this close to a threshold
+NEAR_TEMP = 0.5      # C
+NEAR_HUMID = 2.0     # %
+NEAR_DISTANCE = 2.0  # cm
+FAST_REPORT_S = 120
+
 # MQTT Broker settings
 MQTT_SERVER = "broker.hivemq.com"
 MQTT_PORT = 1883
 MQTT_CLIENT_ID = "esp32_environment_monitor"
 MQTT_USERNAME = ""
 MQTT_PASSWORD = ""
+MQTT_KEEPALIVE = 30  # seconds; PINGREQ every 15s, reconnect if no PINGRESP
+
+# Terrariums run by this controller: (name, sensor node MAC, actuator node MAC).
+# Each tank publishes and listens under its own MQTT namespace:
+#   environment/<name>/data, .../control, .../data/batch
+# A sensor MAC of None is learned from the first frame an unknown node
+# sends, which only works while exactly one tank is still missing its
+# sensor. ESP-NOW allows 20 peers, so up to 10 tanks per controller.
+TANKS = (
+    ("wiredin", None, "14:2b:2f:af:79:c4"),
+)
+
+# State publishes carry only the fields that changed since the last
+# acknowledged snapshot, plus a full keyframe every STATE_KEYFRAME_INTERVAL
+# seconds. One (topic suffix, encoding) entry per topic under each tank's
+# namespace; encoding is "json" or "struct" (compact binary, see
+# state_codec.py). Add ("data/bin", "struct") for consumers that decode the
+# binary form.
+STATE_TOPICS = (("data", "json"),)
+STATE_KEYFRAME_INTERVAL = 60
 
-# MQTT Topics
-TOPIC_DATA = b"environment/wiredin/data"
-TOPIC_CONTROL = b"environment/wiredin/control"
+# Controller diagnostics (control path latency histograms, see latency.py,
+# and the heap of this node and of each actuator, see heap.py), published
+# every DIAGNOSTICS_INTERVAL seconds and then reset
+TOPIC_DIAGNOSTICS = b"environment/controller/diagnostics"
+DIAGNOSTICS_INTERVAL = 60
 
-# Actuator state tracking
-heat_lamp_state = False
-fan_state = False
-humidifier_state = False
-servo_state = False  # False = open, True = closed
+# Logging (see log.py): levels recorded in the RAM ring and printed on the
+# console. Production: LOG_ECHO_LEVEL = log.WARN, so the loops only store
+# references, plus RELEASE in boot.py to compile debug calls out. Any
+# message on TOPIC_LOG_DUMP publishes the ring to TOPIC_LOG as text lines.
+LOG_LEVEL = log.INFO
+LOG_ECHO_LEVEL = log.INFO
+TOPIC_LOG_DUMP = b"environment/controller/log/dump"
+TOPIC_LOG = b"environment/controller/log"
+log.configure(LOG_LEVEL, LOG_ECHO_LEVEL)
 
-# Take over mode tracking
-take_over_mode = False
+# Store-and-forward: while MQTT is down, readings and actuator changes are
+# logged to flash (one log per tank) and sent to the tank's data/batch topic
+# (see store_forward.py) once the broker is back, one batch at a time so
+# live publishes go first.
+OFFLINE_LOG_DIR = "/offline"
+OFFLINE_LOG_SEGMENT_BYTES = 4096
+OFFLINE_LOG_MAX_SEGMENTS = 16     # ~64 KB of flash, ~5400 records
+OFFLINE_DRAIN_RECORDS = 40        # records per batch publish
+OFFLINE_DRAIN_INTERVAL_MS = 250   # pause between batch publishes
+
+# Per-tank thresholds, actuator states, take over mode and sensor reporting
+# mode live in the tank table (see tanks.py)
+tank_table = TankTable()
+for tank_name, tank_sensor, tank_actuator in TANKS:
+    tank_table.add(Tank(tank_name,
+                        mac_from_str(tank_sensor) if tank_sensor else None,
+                        mac_from_str(tank_actuator),
+                        (TEMP_LOWER, TEMP_UPPER, HUMID_LOWER, HUMID_UPPER, DISTANCE_THRESHOLD),
+                        telemetry.MODE_DELTA))
 
 # Function to format MAC addresses consistently
 def format_mac(mac_bytes):
@@ -60,140 +122,178 @@ def setup_espnow():
         print(f"Changing WiFi channel from {current_channel} to 1")
         sta.config(channel=1)
     
-    # Initialize ESP-NOW
-    e = espnow.ESPNow()
+    # Initialize ESP-NOW (asyncio-aware subclass of espnow.ESPNow)
+    e = aioespnow.AIOESPNow()
     e.active(True)
     
-    # Set up the actuator controller's MAC address
-    actuator_mac_str = "14:2b:2f:af:79:c4"  # MAC for device controlling appliances
-    
-    # Convert string MAC to bytes
-    actuator_mac_parts = actuator_mac_str.split(':')
-    actuator_mac = bytes([int(actuator_mac_parts[i], 16) for i in range(6)])
-    
-    # Add the actuator as a peer
-    try:
-        # First try to remove if it exists
-        try:
-            e.del_peer(actuator_mac)
-        except:
-            pass
-            
-        # Try different methods to add peer
+    # Add every tank's actuator controller as a peer
+    for tank in tank_table:
+        actuator_mac = tank.actuator_mac
         try:
-            e.add_peer(actuator_mac)
-            print("Peer added successfully")
-        except:
+            # First try to remove if it exists
             try:
-                e.add_peer(actuator_mac, channel=1)
-                print("Peer added with channel specified")
+                e.del_peer(actuator_mac)
             except:
-                e.add_peer(actuator_mac, lmk=b'\0'*16, channel=1)
-                print("Peer added with extended parameters")
-    except Exception as err:
-        print(f"Failed to add actuator peer: {err}")
-    
-    return actuator_mac
+                pass
+                
+            # Try different methods to add peer
+            try:
+                e.add_peer(actuator_mac)
+                print(f"Peer added successfully ({tank.name})")
+            except:
+                try:
+                    e.add_peer(actuator_mac, channel=1)
+                    print(f"Peer added with channel specified ({tank.name})")
+                except:
+                    e.add_peer(actuator_mac, lmk=b'\0'*16, channel=1)
+                    print(f"Peer added with extended parameters ({tank.name})")
+        except Exception as err:
+            print(f"Failed to add actuator peer for {tank.name}: {err}")
 
 # Initialize ESP-NOW
-actuator_mac = setup_espnow()
+setup_espnow()
 
-# Send a startup message to the peer
-try:
-    e.send(actuator_mac, "Controller starting...")
-    print("Sent startup message")
-except Exception as err:
-    print(f"Failed to send startup message: {err}")
+# Send a startup message to the peers
+for tank in tank_table:
+    try:
+        e.send(tank.actuator_mac, "Controller starting...")
+        print(f"Sent startup message ({tank.name})")
+    except Exception as err:
+        print(f"Failed to send startup message to {tank.name}: {err}")
 
 # ===== MQTT FUNCTIONS =====
-def connect_mqtt():
-    global mqtt_client, mqtt_connected
-    try:
-        mqtt_client = MQTTClient(MQTT_CLIENT_ID, MQTT_SERVER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD)
-        mqtt_client.set_callback(on_mqtt_message)
-        mqtt_client.connect(clean_session=True)
-        mqtt_client.subscribe(TOPIC_CONTROL)
-        print("MQTT connected")
-        mqtt_connected = True
-        return True
-    except Exception as e:
-        print(f"MQTT connect failed: {e}")
-        mqtt_connected = False
-        return False
+def on_mqtt_state(connected):
+    """Called by the reconnect manager on every connect/disconnect"""
+    global mqtt_connected
+    mqtt_connected = connected
+    if connected:
+        log.info("MQTT connected")
+    else:
+        log.warn("MQTT disconnected")
 
-def on_mqtt_message(topic, msg):
-    global TEMP_LOWER, TEMP_UPPER, HUMID_LOWER, HUMID_UPPER, DISTANCE_THRESHOLD, take_over_mode
-    global heat_lamp_state, fan_state, humidifier_state, servo_state
+# Control message keys that set a threshold
+THRESHOLD_KEYS = (("temp_lower", tanks.TEMP_LOWER), ("temp_upper", tanks.TEMP_UPPER),
+                  ("humid_lower", tanks.HUMID_LOWER), ("humid_upper", tanks.HUMID_UPPER),
+                  ("distance_threshold", tanks.DISTANCE_THRESHOLD))
 
-    print(f"MQTT msg: {topic}, {msg}")
+# Control message keys for direct actuator control
+ACTUATOR_KEYS = (("heat", tanks.HEAT), ("fan", tanks.FAN),
+                 ("humid", tanks.HUMID), ("servo", tanks.SERVO))
+
+def on_mqtt_message(topic, msg):
+    topic = bytes(topic)
+    if __debug__:
+        # msg is a view into the client's receive buffer: log its size, not a copy
+        log.debug("MQTT msg: {} ({} bytes)", topic, len(msg))
+    if topic == TOPIC_LOG_DUMP:
+        publish_log()
+        return
+    tank = tank_table.by_topic(topic)
+    if tank is None:
+        log.warn("No tank for topic {}", topic)
+        return
     try:
         data = json.loads(msg)
         
         # Handle threshold updates
-        if "temp_lower" in data: TEMP_LOWER = float(data["temp_lower"])
-        if "temp_upper" in data: TEMP_UPPER = float(data["temp_upper"])
-        if "humid_lower" in data: HUMID_LOWER = float(data["humid_lower"])
-        if "humid_upper" in data: HUMID_UPPER = float(data["humid_upper"])
-        if "distance_threshold" in data: DISTANCE_THRESHOLD = float(data["distance_threshold"])
+        for key, index in THRESHOLD_KEYS:
+            if key in data:
+                tank.thresholds[index] = float(data[key])
+        
+        # Handle sensor node reporting configuration
+        delta = None
+        if ("sensor_temp_deadband" in data or "sensor_humid_deadband" in data or
+                "sensor_distance_deadband" in data or "sensor_heartbeat_s" in data):
+            delta = (float(data.get("sensor_temp_deadband", 0)),
+                     float(data.get("sensor_humid_deadband", 0)),
+                     float(data.get("sensor_distance_deadband", 0)),
+                     int(data.get("sensor_heartbeat_s", 0)), 0)
+        if ("sensor_mode" in data or "sensor_window_ms" in data or
+                "sensor_sht_interval_ms" in data or "sensor_distance_interval_ms" in data or
+                delta is not None):
+            send_sensor_config(
+                tank,
+                data.get("sensor_mode"),
+                int(data.get("sensor_window_ms", 0)),
+                int(data.get("sensor_sht_interval_ms", 0)),
+                int(data.get("sensor_distance_interval_ms", 0)),
+                delta
+            )
         
         # Handle take over mode
         if "take_over" in data: 
-            take_over_mode = bool(data["take_over"])
-            print(f"Take over mode: {'ON' if take_over_mode else 'OFF'}")
+            tank.take_over = bool(data["take_over"])
+            log.info("Take over mode ({}): {}", tank.name, "ON" if tank.take_over else "OFF")
         
         # Handle direct actuator controls when in take over mode
-        if take_over_mode or "take_over" in data:
+        if tank.take_over or "take_over" in data:
             changes_made = False
             
-            if "heat" in data:
-                new_state = bool(data["heat"])
-                if new_state != heat_lamp_state:
-                    heat_lamp_state = new_state
-                    send_command("heat", new_state)
-                    changes_made = True
-                    
-            if "fan" in data:
-                new_state = bool(data["fan"])
-                if new_state != fan_state:
-                    fan_state = new_state
-                    send_command("fan", new_state)
-                    changes_made = True
-                    
-            if "humid" in data:
-                new_state = bool(data["humid"])
-                if new_state != humidifier_state:
-                    humidifier_state = new_state
-                    send_command("humid", new_state)
-                    changes_made = True
-                    
-            if "servo" in data:
-                new_state = bool(data["servo"])
-                if new_state != servo_state:
-                    servo_state = new_state
-                    send_command("servo", new_state)
-                    changes_made = True
+            for key, index in ACTUATOR_KEYS:
+                if key in data:
+                    changes_made |= set_actuator(tank, index, bool(data[key]))
             
-            # Immediately publish updated state if changes were made
+            # One command frame for everything that changed, then publish the new state
             if changes_made:
-                publish_data(None, None, None)
+                send_command(tank)
+                publish_data(tank, None, None, None)
     except Exception as err:
-        print(f"MQTT msg parse error: {err}")
+        log.error("MQTT msg parse error: {}", err)
 
-def publish_data(temperature, humidity, distance):
-    global mqtt_connected, mqtt_client, heat_lamp_state, fan_state, humidifier_state, servo_state
-    
+# Persistent session with a stable client ID: the broker keeps our QoS1
+# subscription and queues control messages while we are disconnected
+mqtt_client = MQTTClient(MQTT_CLIENT_ID, MQTT_SERVER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD,
+                         keepalive=MQTT_KEEPALIVE)
+mqtt_client.set_callback(on_mqtt_message)
+mqtt_manager = ReconnectManager(mqtt_client,
+                                subscriptions=[(tank.topic_control, 1) for tank in tank_table] +
+                                              [(TOPIC_LOG_DUMP, 0)],
+                                on_state=on_mqtt_state)
+
+try:
+    os.mkdir(OFFLINE_LOG_DIR)
+except OSError:
+    pass  # Already there
+for tank in tank_table:
+    tank.publishers = [StatePublisher(tank.topic(suffix), encoding, STATE_KEYFRAME_INTERVAL)
+                       for suffix, encoding in STATE_TOPICS]
+    tank.offline_log = store_forward.RingLog(OFFLINE_LOG_DIR + "/" + tank.name,
+                                             OFFLINE_LOG_SEGMENT_BYTES, OFFLINE_LOG_MAX_SEGMENTS)
+
+def actuator_bits(tank):
+    # tanks.HEAT..SERVO map onto store_forward.ACT_HEAT_LAMP..ACT_SERVO
+    bits = 0
+    for index in range(len(tanks.DEVICES)):
+        if tank.actuators[index]:
+            bits |= 1 << index
+    if tank.take_over:
+        bits |= store_forward.ACT_TAKE_OVER
+    return bits
+
+def log_offline(tank, temperature, humidity, distance):
+    """Keep a reading taken while MQTT is down for the batch topic"""
+    bits = actuator_bits(tank)
+    transition = tank.last_logged_actuators is not None and bits != tank.last_logged_actuators
+    tank.last_logged_actuators = bits
+    try:
+        tank.offline_log.append(time.time(), temperature, humidity, distance, bits, transition)
+    except OSError as err:
+        log.error("Offline log write failed ({}): {}", tank.name, err)
+
+def publish_data(tank, temperature, humidity, distance):
     if not mqtt_connected:
+        log_offline(tank, temperature, humidity, distance)
         return
         
     # Create data payload for MQTT
     try:
+        actuators = tank.actuators
         data = {
-            "heat_lamp": heat_lamp_state,
-            "fan": fan_state,
-            "humidifier": humidifier_state,
-            "servo": servo_state,
-            "take_over": take_over_mode,
-            "timestamp": time.time()
+            "heat_lamp": bool(actuators[tanks.HEAT]),
+            "fan": bool(actuators[tanks.FAN]),
+            "humidifier": bool(actuators[tanks.HUMID]),
+            "servo": bool(actuators[tanks.SERVO]),
+            "take_over": tank.take_over
         }
         
         # Add sensor data if available
@@ -203,361 +303,732 @@ def publish_data(temperature, humidity, distance):
             data["humidity"] = humidity
         if distance is not None:
             data["distance"] = distance
+        if tank.zones is not None and temperature is not None:
+            for zone in range(len(tank.zones)):
+                if tank.zones[zone] is not None:
+                    data[f"zone{zone}_temperature"], data[f"zone{zone}_humidity"] = tank.zones[zone]
             
-        mqtt_client.publish(TOPIC_DATA, json.dumps(data))
-        print("Data published to MQTT")
+        # Queued for the MQTT task; QoS1 so the client retransmits until PUBACK,
+        # which also moves the publisher's delta baseline forward
+        now = time.time()
+        for publisher in tank.publishers:
+            payload, on_ack = publisher.build(data, now)
+            if payload is None:
+                continue  # Nothing changed beyond the deadbands
+            if mqtt_client.publish(publisher.topic, payload, qos=1, on_ack=on_ack):
+                if __debug__:
+                    log.debug("Data published to MQTT ({} bytes)", len(payload))
+            else:
+                log.warn("MQTT outbound queue full - data dropped")
     except Exception as e:
-        print(f"MQTT publish error: {e}")
-        mqtt_connected = False
+        log.error("MQTT publish error: {}", e)
 
 # ===== ESP-NOW FUNCTIONS =====
-def send_command(device, state):
-    """Send command to the actuator controller"""
-    global e, actuator_mac
-    
-    # Create a simple command format
-    command = f"{device}:{1 if state else 0}"
-    print(f"Sending command: {command}")
-    
-    # Try to send the command a few times
-    for attempt in range(3):
-        try:
-            result = e.send(actuator_mac, command)
-            print(f"Send result: {result}")
-            if result:
-                return True
-            time.sleep(0.1)
-        except Exception as err:
-            print(f"Send error (attempt {attempt+1}): {err}")
-            time.sleep(0.1)
+command_buf = bytearray(telemetry.COMMAND_SIZE)
+
+def send_command(tank):
+    """Send the tank's full actuator state to its actuator controller in one frame.
+
+    Returns immediately; command_link resends the frame with backoff until
+    the actuator acknowledges this sequence number.
+    """
+    # Every actuator in one command frame, applied together and acknowledged once
+    tank.command_seq = (tank.command_seq + 1) & 0xFFFF
+    now_us = time.ticks_us()
+    tank.command_sent_us = now_us
+    tank.command_trace = tank.trace
+    if tank.trace is not None:
+        latency.record("decide", time.ticks_diff(now_us, tank.trace[2]))
+        tank.trace = None  # Only the first command of a decision is traced
+    states = actuator_bits(tank) & telemetry.ACT_ALL
+    command = telemetry.encode_command(command_buf, tank.command_seq, telemetry.ACT_ALL, states)
+    if __debug__:
+        log.debug("Sending command #{} ({}): states 0x{:02x}", tank.command_seq, tank.name, states)
+    command_link.submit(tank.actuator_mac, tank.command_seq, command)
+
+def send_nowait(mac, frame):
+    """Queue a frame for the radio without waiting for its link-layer ack"""
+    e.send(mac, frame, False)
+
+def on_command_stall(mac):
+    """An actuator has not answered several retransmissions - re-add its peer"""
+    log.warn("No command ACK from {} - refreshing peer", format_mac(mac))
+    try:
+        e.del_peer(mac)
+        e.add_peer(mac, channel=1)
+    except OSError as err:
+        log.error("Peer refresh error: {}", err)
+
+command_link = CommandLink(send_nowait, on_stall=on_command_stall)
+
+def send_sensor_config(tank, mode, window_ms, sht_interval_ms, distance_interval_ms, delta=None):
+    """Push a reporting configuration to the tank's sensor node.
+
+    mode is "raw", "aggregate" or "delta" (None keeps the current mode); zero
+    intervals leave the node's setting unchanged. delta is the send-on-delta
+    trailer (see telemetry.encode_config), None to leave it out.
+    """
+    if tank.sensor_mac is None:
+        log.warn("Sensor node of {} not seen yet - cannot send config", tank.name)
+        return False
+    if mode == "aggregate":
+        tank.sensor_mode = telemetry.MODE_AGGREGATE
+    elif mode == "raw":
+        tank.sensor_mode = telemetry.MODE_RAW
+    elif mode == "delta":
+        tank.sensor_mode = telemetry.MODE_DELTA
     
-    # If all attempts failed, try to refresh the connection
     try:
-        print("Refreshing ESP-NOW connection")
-        e.del_peer(actuator_mac)
-        time.sleep(0.2)
-        e.add_peer(actuator_mac, channel=1)
-        print("Connection refreshed")
-        
-        # Try one more time after refreshing
         try:
-            result = e.send(actuator_mac, command)
-            print(f"Post-refresh send result: {result}")
-            return result
-        except Exception as err:
-            print(f"Post-refresh send error: {err}")
-            return False
+            e.add_peer(tank.sensor_mac, channel=1)
+        except OSError:
+            pass  # Already a peer
+        result = e.send(tank.sensor_mac, telemetry.encode_config(
+            tank.sensor_mode, window_ms, sht_interval_ms, distance_interval_ms, delta))
+        log.info("Sensor config sent ({}): mode {}, window {}ms - result {}",
+                 tank.name, tank.sensor_mode, window_ms, result)
+        return result
     except Exception as err:
-        print(f"Connection refresh error: {err}")
+        log.error("Sensor config send error: {}", err)
         return False
 
-def update_actuators(temperature, humidity, distance):
-    """Update actuator states based on sensor readings"""
-    global heat_lamp_state, fan_state, humidifier_state, servo_state, take_over_mode
+def near_threshold(tank, temperature, humidity, distance):
+    """True if any reading (None = not in this reading) is close to its thresholds"""
+    thresholds = tank.thresholds
+    if temperature is not None and (
+            abs(temperature - thresholds[tanks.TEMP_LOWER]) <= NEAR_TEMP or
+            abs(temperature - thresholds[tanks.TEMP_UPPER]) <= NEAR_TEMP):
+        return True
+    if humidity is not None and (
+            abs(humidity - thresholds[tanks.HUMID_LOWER]) <= NEAR_HUMID or
+            abs(humidity - thresholds[tanks.HUMID_UPPER]) <= NEAR_HUMID):
+        return True
+    return distance is not None and abs(distance - thresholds[tanks.DISTANCE_THRESHOLD]) <= NEAR_DISTANCE
+
+def request_fast_reporting(tank, temperature, humidity, distance, current_time):
+    """Near a control boundary, ask a send-on-delta sensor node for every sample.
+
+    The request is renewed halfway through FAST_REPORT_S while the readings
+    stay close, and simply runs out on the node once they move away.
+    """
+    if tank.sensor_mode != telemetry.MODE_DELTA or tank.sensor_mac is None:
+        return
+    if current_time < tank.fast_until - FAST_REPORT_S // 2:
+        return
+    if not near_threshold(tank, temperature, humidity, distance):
+        return
+    if send_sensor_config(tank, None, 0, 0, 0, (0, 0, 0, 0, FAST_REPORT_S)):
+        tank.fast_until = current_time + FAST_REPORT_S
+
+def set_actuator(tank, index, state):
+    """Record a new actuator state; returns True if it changed.
+
+    Nothing is sent here - callers send one command frame (send_command)
+    once all of a decision's changes are recorded.
+    """
+    if tank.actuators[index] == state:
+        return False
+    tank.actuators[index] = state
+    return True
+
+def update_actuators(tank, temperature, humidity, distance):
+    """Update the tank's actuator states based on sensor readings"""
     states_changed = False
+    thresholds = tank.thresholds
+    actuators = tank.actuators
     
     # Skip automatic control if in take over mode
-    if take_over_mode:
-        print("In take over mode - skipping automatic control")
+    if tank.take_over:
+        if __debug__:
+            log.debug("{} in take over mode - skipping automatic control", tank.name)
         return False
     
-    print(f"Checking thresholds - T:{temperature}°C, H:{humidity}%, D:{distance}cm")
+    if __debug__:
+        log.debug("Checking thresholds ({}) - T:{}°C, H:{}%, D:{}cm", tank.name, temperature, humidity, distance)
     
     # Check temperature against thresholds
-    if temperature < TEMP_LOWER:
+    if temperature < thresholds[tanks.TEMP_LOWER]:
         # Too cold - turn on heat lamp
-        if not heat_lamp_state:
-            print("Temperature too low - turning ON heat lamp")
-            heat_lamp_state = True
-            send_command("heat", True)
-            states_changed = True
+        if not actuators[tanks.HEAT]:
+            log.info("Temperature too low - turning ON heat lamp")
+            states_changed |= set_actuator(tank, tanks.HEAT, True)
     else:
         # Temperature above lower threshold - turn off heat lamp
-        if heat_lamp_state:
-            print("Temperature OK - turning OFF heat lamp")
-            heat_lamp_state = False
-            send_command("heat", False)
-            states_changed = True
+        if actuators[tanks.HEAT]:
+            log.info("Temperature OK - turning OFF heat lamp")
+            states_changed |= set_actuator(tank, tanks.HEAT, False)
     
     # Check if fan should be on (high temperature OR high humidity)
-    fan_needed = temperature > TEMP_UPPER or humidity > HUMID_UPPER
+    fan_needed = temperature > thresholds[tanks.TEMP_UPPER] or humidity > thresholds[tanks.HUMID_UPPER]
     if fan_needed:
         # Too hot or too humid - turn on fan
-        if not fan_state:
-            print("Temperature too high or humidity too high - turning ON fan")
-            fan_state = True
-            send_command("fan", True)
-            states_changed = True
+        if not actuators[tanks.FAN]:
+            log.info("Temperature too high or humidity too high - turning ON fan")
+            states_changed |= set_actuator(tank, tanks.FAN, True)
     else:
         # Temperature and humidity OK - turn off fan
-        if fan_state:
-            print("Temperature and humidity OK - turning OFF fan")
-            fan_state = False
-            send_command("fan", False)
-            states_changed = True
+        if actuators[tanks.FAN]:
+            log.info("Temperature and humidity OK - turning OFF fan")
+            states_changed |= set_actuator(tank, tanks.FAN, False)
     
     # Check humidity against lower threshold
-    if humidity < HUMID_LOWER:
+    if humidity < thresholds[tanks.HUMID_LOWER]:
         # Too dry - turn on humidifier
-        if not humidifier_state:
-            print("Humidity too low - turning ON humidifier")
-            humidifier_state = True
-            send_command("humid", True)
-            states_changed = True
+        if not actuators[tanks.HUMID]:
+            log.info("Humidity too low - turning ON humidifier")
+            states_changed |= set_actuator(tank, tanks.HUMID, True)
     else:
         # Humidity above lower threshold - turn off humidifier
-        if humidifier_state:
-            print("Humidity OK - turning OFF humidifier")
-            humidifier_state = False
-            send_command("humid", False)
-            states_changed = True
+        if actuators[tanks.HUMID]:
+            log.info("Humidity OK - turning OFF humidifier")
+            states_changed |= set_actuator(tank, tanks.HUMID, False)
     
     # Check distance against threshold for servo control
-    if distance < DISTANCE_THRESHOLD:
+    distance_threshold = thresholds[tanks.DISTANCE_THRESHOLD]
+    if distance < distance_threshold:
         # Object detected close - close servo
-        if not servo_state:
-            print(f"Object detected (distance {distance}cm < threshold {DISTANCE_THRESHOLD}cm) - CLOSING servo")
-            servo_state = True
-            send_command("servo", True)
-            states_changed = True
+        if not actuators[tanks.SERVO]:
+            log.info("Object detected (distance {}cm < threshold {}cm) - CLOSING servo", distance, distance_threshold)
+            states_changed |= set_actuator(tank, tanks.SERVO, True)
     else:
         # No close object - open servo
-        if servo_state:
-            print(f"No object detected (distance {distance}cm > threshold {DISTANCE_THRESHOLD}cm) - OPENING servo")
-            servo_state = False
-            send_command("servo", False)
-            states_changed = True
+        if actuators[tanks.SERVO]:
+            log.info("No object detected (distance {}cm > threshold {}cm) - OPENING servo", distance, distance_threshold)
+            states_changed |= set_actuator(tank, tanks.SERVO, False)
     
+    if states_changed:
+        send_command(tank)
     return states_changed
 
-# ===== MAIN LOOP =====
-# Check if WiFi is connected from boot.py
-wifi_connected = network.WLAN(network.STA_IF).isconnected()
-print(f"WiFi status: {'Connected' if wifi_connected else 'Disconnected'}")
+# ===== SENSOR MESSAGE HANDLING =====
+def parse_text_reading(message_str):
+    """Extract temperature, humidity and distance from a legacy text message"""
+    # Extract temperature value
+    temp_start = message_str.find("Temp:") + 5
+    temp_end = message_str.find("°C", temp_start)
+    if temp_end == -1:  # If not found with degree symbol
+        temp_end = message_str.find(",", temp_start)
+    temperature = float(message_str[temp_start:temp_end].strip())
+    
+    # Extract humidity value
+    humid_start = message_str.find("Humidity:") + 9
+    humid_end = message_str.find("%", humid_start)
+    if humid_end == -1:  # If not found with percent symbol
+        humid_end = message_str.find(",", humid_start)
+        if humid_end == -1:  # If not found with comma
+            humid_end = message_str.find("|", humid_start)
+            if humid_end == -1:  # If not found with pipe
+                humid_end = len(message_str)
+    humidity = float(message_str[humid_start:humid_end].strip())
+    
+    # Extract distance if available
+    distance = None
+    if "Distance:" in message_str:
+        dist_start = message_str.find("Distance:") + 9
+        dist_end = message_str.find("cm", dist_start)
+        if dist_end == -1:  # If not found with cm
+            dist_end = message_str.find("|", dist_start)
+            if dist_end == -1:  # If not found with pipe
+                dist_end = len(message_str)
+        distance = float(message_str[dist_start:dist_end].strip())
+    
+    return temperature, humidity, distance
 
-# Initialize MQTT if WiFi is connected
-if wifi_connected:
-    mqtt_connected = connect_mqtt()
-else:
-    mqtt_connected = False
+def handle_sensor_reading(tank, temperature, humidity, distance, current_time):
+    """Run the control law on a full sensor reading and publish it"""
+    # Update last known values
+    tank.last_temperature = temperature
+    tank.last_humidity = humidity
+    if distance is not None:
+        tank.last_distance = distance
     
-print(f"MQTT status: {'Connected' if mqtt_connected else 'Disconnected'}")
-print("Ready to receive sensor data and control actuators...")
+    if __debug__:
+        log.debug("Parsed data ({}) - Temp: {}°C, Humidity: {}%, Distance: {}cm", tank.name, temperature, humidity, distance)
+    
+    # Decide actuator states based on thresholds
+    states_changed = update_actuators(
+        tank,
+        temperature, 
+        humidity, 
+        tank.last_distance if tank.last_distance is not None else 100
+    )
+    
+    request_fast_reporting(tank, temperature, humidity, distance, current_time)
+    
+    # Publish to MQTT if states changed or it's time for regular update
+    if states_changed or (current_time - tank.last_publish > publish_interval):
+        publish_data(tank, temperature, humidity, distance)
+        tank.last_publish = current_time
+
+def handle_distance_reading(tank, distance, current_time):
+    """Drive the servo from a distance-only reading and publish it"""
+    # Update last known value
+    tank.last_distance = distance
+    if __debug__:
+        log.debug("Parsed Distance ({}): {}cm", tank.name, distance)
+    
+    # Update servo based on distance threshold
+    if distance < tank.thresholds[tanks.DISTANCE_THRESHOLD]:
+        # Object detected - close servo
+        if not tank.actuators[tanks.SERVO]:
+            log.info("Object detected - CLOSING servo")
+            set_actuator(tank, tanks.SERVO, True)
+            send_command(tank)
+    else:
+        # No object - open servo
+        if tank.actuators[tanks.SERVO]:
+            log.info("No object detected - OPENING servo")
+            set_actuator(tank, tanks.SERVO, False)
+            send_command(tank)
+    
+    request_fast_reporting(tank, None, None, distance, current_time)
+    
+    # Publish the distance data
+    publish_data(tank, None, None, distance)
+    tank.last_publish = current_time
+
+def queue_reading(tank, temperature, humidity, distance, received_us=None, sample_age_us=None):
+    """Hand a reading to the control task (a newer reading replaces an unprocessed one)"""
+    if tank.pending is None:
+        pending_tanks.append(tank)
+    tank.pending = (temperature, humidity, distance)
+    tank.pending_trace = (received_us, sample_age_us) if received_us is not None else None
+    reading_event.set()
+
+def parse_text_distance(message_str):
+    """Extract the distance from a legacy text message"""
+    dist_start = message_str.find("Distance:") + 9
+    dist_end = message_str.find("cm", dist_start)
+    if dist_end == -1:  # If not found with cm
+        dist_end = len(message_str)
+    return float(message_str[dist_start:dist_end].strip())
 
-# Track timers
-last_publish = time.time()
-last_wifi_check = time.time()
-last_peer_refresh = time.time()
+def parse_status(message_str):
+    """Parse "STATUS:heat:1,fan:0,humid:0,servo:1" into a {device: state} dict"""
+    reported = {}
+    for field in message_str[7:].split(","):
+        parts = field.split(":")
+        if len(parts) == 2:
+            reported[parts[0].strip()] = parts[1].strip() == "1"
+    return reported
+
+def reconcile_actuators(tank, reported):
+    """Re-send the command if any actuator's relay disagrees with our state"""
+    if command_link.pending(tank.actuator_mac):
+        return 0  # A command is still on its way; the heartbeat may predate it
+    resent = 0
+    for index in range(len(tanks.DEVICES)):
+        device = tanks.DEVICES[index]
+        state = bool(tank.actuators[index])
+        if device in reported and reported[device] != state:
+            log.warn("Actuator {} ({}) reports {}, expected {} - resending", device, tank.name,
+                     "ON" if reported[device] else "OFF", "ON" if state else "OFF")
+            resent += 1
+    if resent:
+        send_command(tank)
+    return resent
+
+# ===== MESSAGE HANDLERS =====
+def sensor_tank(host):
+    """Tank whose sensor node sent this frame, learning its MAC if needed"""
+    tank = tank_table.by_mac(host)
+    if tank is None:
+        tank = tank_table.learn_sensor(host)
+        if tank is None:
+            log.warn("Frame from unknown node {} - ignored", format_mac(host))
+        else:
+            log.info("Sensor node {} assigned to {}", format_mac(host), tank.name)
+    return tank
+
+def on_reading_frame(host, msg):
+    """Binary reading frame - decode straight from the receive buffer"""
+    received_us = time.ticks_us()
+    tank = sensor_tank(host)
+    if tank is None:
+        return
+    seq, source_ms, temperature, humidity, distance, flags = telemetry.decode_reading(msg)
+    if __debug__:
+        log.debug("Received frame #{} from {} (flags 0x{:02x})", seq, tank.name, flags)
+    queue_frame_reading(tank, msg, telemetry.READING_SIZE, received_us,
+                        temperature, humidity, distance, flags)
+
+def on_zones_frame(host, msg):
+    """Reading from a node with several SHT4x zones - control on their weighted mean"""
+    received_us = time.ticks_us()
+    tank = sensor_tank(host)
+    if tank is None:
+        return
+    seq, source_ms, temperature, humidity, distance, flags, zones = telemetry.decode_zones(msg)
+    if __debug__:
+        log.debug("Received zones frame #{} from {}: {} zones (flags 0x{:02x})", seq, tank.name, len(zones), flags)
+    tank.zones = zones
+    queue_frame_reading(tank, msg, telemetry.zones_size(len(zones)), received_us,
+                        temperature, humidity, distance, flags)
+
+def queue_frame_reading(tank, msg, size, received_us, temperature, humidity, distance, flags):
+    """Queue a frame's reading with the latency trailers that follow its first size bytes"""
+    wake_us = telemetry.decode_latency(msg, size + telemetry.LATENCY_SIZE)
+    if wake_us is not None:
+        latency.record("wake", wake_us)
+    if temperature is not None or distance is not None:
+        queue_reading(tank, temperature, humidity, distance, received_us,
+                      telemetry.decode_latency(msg, size))
+    else:
+        log.warn("Sensor node reported no valid readings (flags 0x{:02x})", flags)
+
+def on_aggregate_frame(host, msg):
+    """Windowed aggregate - control on the mean climate and median distance"""
+    tank = sensor_tank(host)
+    if tank is None:
+        return
+    seq, source_ms, window_ms, temp, humid, dist, flags = telemetry.decode_aggregate(msg)
+    if __debug__:
+        log.debug("Received aggregate #{} from {} over {}ms (flags 0x{:02x})", seq, tank.name, window_ms, flags)
+    distance = dist[5] if dist is not None else None
+    if temp is not None:
+        queue_reading(tank, temp[3], humid[3], distance)
+    elif distance is not None:
+        queue_reading(tank, None, None, distance)
+    else:
+        log.warn("Sensor node reported no valid samples (flags 0x{:02x})", flags)
+
+def on_text_reading(host, msg):
+    """Legacy "Temp: ..°C, Humidity: ..% | Distance: ..cm" message"""
+    message_str = msg.decode('utf-8')
+    if __debug__:
+        log.debug("Received: {}", message_str)
+    if "Humidity:" not in message_str:
+        log.warn("Unknown message format: {}", message_str)
+        return
+    tank = sensor_tank(host)
+    if tank is None:
+        return
+    try:
+        temperature, humidity, distance = parse_text_reading(message_str)
+        queue_reading(tank, temperature, humidity, distance)
+    except Exception as err:
+        log.error("Error parsing sensor values: {}", err)
+
+def on_text_distance(host, msg):
+    """Legacy distance-only message (temperature/humidity unavailable)"""
+    message_str = msg.decode('utf-8')
+    if __debug__:
+        log.debug("Received: {}", message_str)
+    if "Distance:" not in message_str:
+        log.warn("Unknown message format: {}", message_str)
+        return
+    tank = sensor_tank(host)
+    if tank is None:
+        return
+    try:
+        queue_reading(tank, None, None, parse_text_distance(message_str))
+    except Exception as err:
+        log.error("Error parsing distance: {}", err)
+
+def on_status(host, msg):
+    """Actuator heartbeat - reconcile relay states against the controller"""
+    message_str = msg.decode('utf-8')
+    if __debug__:
+        log.debug("Received: {}", message_str)
+    tank = tank_table.by_mac(host)
+    if tank is None or host != tank.actuator_mac:
+        log.warn("Status from unknown actuator {} - ignored", format_mac(host))
+        return
+    reconcile_actuators(tank, parse_status(message_str))
+
+def on_heap(host, msg):
+    """Actuator heap report, "HEAP:{json}", kept for the next diagnostics publish"""
+    tank = tank_table.by_mac(host)
+    if tank is None or host != tank.actuator_mac:
+        log.warn("Heap report from unknown actuator {} - ignored", format_mac(host))
+        return
+    try:
+        tank.actuator_heap = json.loads(bytes(msg[5:]))
+    except ValueError as err:
+        log.error("Bad heap report from {}: {}", tank.name, err)
+
+def on_command_ack(host, msg):
+    """Actuator applied a command frame and reports its resulting states"""
+    tank = tank_table.by_mac(host)
+    now_us = time.ticks_us()
+    seq, states = telemetry.decode_command_ack(msg)
+    if tank is None or not command_link.ack(tank.actuator_mac, seq):
+        return  # Duplicate, or an ACK for a command that has been superseded
+    if __debug__:
+        log.debug("Command #{} acknowledged by {} (states 0x{:02x})", seq, tank.name, states)
+    round_trip = time.ticks_diff(now_us, tank.command_sent_us)
+    latency.record("command", round_trip)
+    actuate = telemetry.decode_latency(msg, telemetry.COMMAND_ACK_SIZE)
+    if actuate is not None:
+        latency.record("actuate", actuate)
+    trace = tank.command_trace
+    tank.command_trace = None
+    if trace is not None and trace[1] is not None:
+        latency.record("total", trace[1] + time.ticks_diff(now_us, trace[0]))
+    if states != actuator_bits(tank) & telemetry.ACT_ALL:
+        # e.g. the actuator took this seq for a duplicate after we restarted
+        send_command(tank)
+
+def on_ignored(host, msg):
+    """Acknowledgments and test messages, nothing to do"""
+    pass
+
+def on_error(host, msg):
+    log.error("Error message received: {}", msg.decode('utf-8'))
+
+def on_unknown(host, msg):
+    if telemetry.is_binary(msg):
+        log.warn("Unknown frame type: {}", msg[1])
+    else:
+        log.warn("Unknown message format: {}", msg.decode('utf-8'))
+
+router = MessageRouter()
+router.register_binary(telemetry.MSG_READING, on_reading_frame)
+router.register_binary(telemetry.MSG_AGGREGATE, on_aggregate_frame)
+router.register_binary(telemetry.MSG_ZONES, on_zones_frame)
+router.register_binary(telemetry.MSG_COMMAND_ACK, on_command_ack)
+router.register_text(b"Temp", on_text_reading)
+router.register_text(b"Temp/Humidity", on_text_distance)
+router.register_text(b"Distance", on_text_distance)
+router.register_text(b"STATUS", on_status)
+router.register_text(b"HEAP", on_heap)
+router.register_text(b"ACK", on_ignored)   # Replies to "TEST" and legacy text commands
+router.register_text(b"TEST", on_ignored)
+router.register_text(b"ERROR", on_error)
+router.set_default(on_unknown)
+
+# ===== TASKS =====
+# Track timers (each tank keeps its own last_publish)
 publish_interval = 5    # seconds
 wifi_check_interval = 60  # seconds
 peer_refresh_interval = 300  # seconds (5 minutes)
+log_flush_interval = 60  # seconds
 
-# Initialize variables to store latest sensor readings
-last_temperature = None
-last_humidity = None
-last_distance = None
+for tank in tank_table:
+    tank.last_publish = time.time()
 
-# Main loop counter for periodic garbage collection
-loop_counter = 0
+# Tanks with an unprocessed reading (tank.pending), handed from the receive
+# task to the control task
+pending_tanks = []
+latency = LatencyStats()
+heap = HeapMonitor(("receive", "control"))
+reading_event = asyncio.Event()
 
-while True:
-    try:
-        loop_counter += 1
-        if loop_counter >= 1000:
-            gc.collect()  # Run garbage collection periodically
-            loop_counter = 0
-            print("GC run")
-        
-        current_time = time.time()
-        
-        # Periodically check WiFi/MQTT connection
-        if current_time - last_wifi_check > wifi_check_interval:
-            last_wifi_check = current_time
-            
-            wifi_status = network.WLAN(network.STA_IF)
-            if not wifi_status.isconnected():
-                print("WiFi disconnected, attempting to reconnect...")
-                wifi_status.active(True)
+async def espnow_task():
+    """Receive ESP-NOW messages and route them as soon as they arrive"""
+    while True:
+        try:
+            async for host, msg in e:
+                start = heap.begin()
                 try:
-                    wifi_status.connect(SSID, PASSWORD)
-                    attempt_counter = 0
-                    while not wifi_status.isconnected() and attempt_counter < 10:
-                        time.sleep(1)
-                        attempt_counter += 1
-                        print(f"Reconnecting attempt {attempt_counter}...")
-                    
-                    if wifi_status.isconnected():
-                        print(f"WiFi reconnected! IP: {wifi_status.ifconfig()[0]}")
-                        wifi_connected = True
-                        # Reconnect MQTT after WiFi is back
-                        mqtt_connected = connect_mqtt()
-                    else:
-                        print("WiFi reconnection failed")
-                        wifi_connected = False
-                        mqtt_connected = False
+                    router.dispatch(host, msg)
                 except Exception as err:
-                    print(f"WiFi reconnection error: {err}")
-                    wifi_connected = False
-                    mqtt_connected = False
-            elif not mqtt_connected:
-                print("MQTT disconnected, attempting to reconnect...")
-                mqtt_connected = connect_mqtt()
-        
-        # Periodically refresh ESP-NOW peer to keep connection healthy
-        if current_time - last_peer_refresh > peer_refresh_interval:
-            last_peer_refresh = current_time
-            print("Refreshing ESP-NOW peer connection...")
+                    log.error("Error processing message: {}", err)
+                heap.end("receive", start)
+                heap.maybe_collect()
+        except Exception as recv_err:
+            log.error("Error in ESP-NOW receive: {}", recv_err)
+            await asyncio.sleep_ms(100)
+
+async def control_task():
+    """Run the control law whenever a new reading has been queued"""
+    while True:
+        await reading_event.wait()
+        reading_event.clear()
+        while pending_tanks:
+            tank = pending_tanks.pop(0)
+            reading = tank.pending
+            tank.pending = None
+            if reading is None:
+                continue
+            start = heap.begin()
+            temperature, humidity, distance = reading
+            trace = tank.pending_trace
+            if trace is not None:
+                start_us = time.ticks_us()
+                latency.record("receive", time.ticks_diff(start_us, trace[0]))
+                if trace[1] is not None:
+                    latency.record("sample", trace[1])
+                # send_command() picks this up if the decision switches anything
+                tank.trace = [trace[0], trace[1], start_us]
             try:
-                e.del_peer(actuator_mac)
-                time.sleep(0.2)
-                e.add_peer(actuator_mac, channel=1)
-                print("Peer refreshed")
-                
-                # Send a test message
-                try:
-                    e.send(actuator_mac, "TEST")
-                    print("Test message sent")
-                except Exception as err:
-                    print(f"Test message failed: {err}")
+                if temperature is not None:
+                    handle_sensor_reading(tank, temperature, humidity, distance, time.time())
+                else:
+                    handle_distance_reading(tank, distance, time.time())
             except Exception as err:
-                print(f"Peer refresh failed: {err}")
-        
-        # Check MQTT messages if connected
-        if mqtt_connected:
+                log.error("Error in control task ({}): {}", tank.name, err)
+            tank.trace = None
+            heap.end("control", start)
+            heap.maybe_collect()
+
+async def command_task():
+    """Retransmit unacknowledged actuator commands when their timers expire"""
+    await command_link.run()
+
+def publish_diagnostics():
+    """Publish the latency percentiles and heap statistics of the last interval and start a new one"""
+    if not mqtt_connected:
+        return  # Keep accumulating until the broker is back
+    actuators = {}
+    for tank in tank_table:
+        if tank.actuator_heap is not None:
+            actuators[tank.name] = tank.actuator_heap
+    data = {"window_s": DIAGNOSTICS_INTERVAL, "latency_us": latency.summary(),
+            "heap": {"controller": heap.summary(), "actuators": actuators}}
+    if mqtt_client.publish(TOPIC_DIAGNOSTICS, json.dumps(data)):
+        latency.reset()
+        heap.reset()
+
+def publish_log():
+    """Publish the log ring, oldest entry first, one per line"""
+    if mqtt_client.publish(TOPIC_LOG, "\n".join(log.lines())):
+        log.info("Log ring published to {}", TOPIC_LOG)
+
+async def mqtt_task():
+    """Keep MQTT connected and run the client (incoming messages, outbound queue, QoS1 retransmits)"""
+    await mqtt_manager.run()
+
+async def offline_drain_task():
+    """Send each tank's offline log to its data/batch topic, one acknowledged batch at a time"""
+    buf = bytearray(store_forward.BATCH_HEADER_SIZE +
+                    OFFLINE_DRAIN_RECORDS * store_forward.RECORD_SIZE)
+    acked = asyncio.Event()
+    while True:
+        # Only drain while live traffic is not waiting in the MQTT queue
+        waiting = [tank for tank in tank_table if tank.offline_log.pending()]
+        if not mqtt_connected or not waiting or mqtt_client.pending() > 1:
+            await asyncio.sleep(1)
+            continue
+        # Take turns so one long outage log does not hold up the other tanks
+        for tank in waiting:
+            offline_log = tank.offline_log
             try:
-                mqtt_client.check_msg()
-            except Exception as err:
-                print(f"MQTT check error: {err}")
-                mqtt_connected = False
+                offline_log.seal()
+                payload, mark = offline_log.read_batch(buf, OFFLINE_DRAIN_RECORDS)
+                if payload is None:
+                    continue
+                acked.clear()
+                if not mqtt_client.publish(tank.topic_batch, payload, qos=1, on_ack=acked.set):
+                    await asyncio.sleep(1)
+                    break
+                # buf is still referenced by the queued message, so wait for the
+                # PUBACK (retransmitted across reconnects) before reading more
+                await acked.wait()
+                offline_log.commit(mark)
+                log.info("Offline log ({}): sent {} records", tank.name,
+                         (len(payload) - store_forward.BATCH_HEADER_SIZE) // store_forward.RECORD_SIZE)
+            except OSError as err:
+                log.error("Offline log drain error ({}): {}", tank.name, err)
+                await asyncio.sleep(1)
+            await asyncio.sleep_ms(OFFLINE_DRAIN_INTERVAL_MS)
+
+async def reconnect_wifi():
+    """Reconnect WiFi (and then MQTT) without blocking the other tasks"""
+    global wifi_connected
+    wifi_status = network.WLAN(network.STA_IF)
+    print("WiFi disconnected, attempting to reconnect...")
+    wifi_status.active(True)
+    try:
+        wifi_status.connect(SSID, PASSWORD)
+        attempt_counter = 0
+        while not wifi_status.isconnected() and attempt_counter < 10:
+            await asyncio.sleep(1)
+            attempt_counter += 1
+            print(f"Reconnecting attempt {attempt_counter}...")
         
-        # Publish periodic updates even without new sensor data
-        if mqtt_connected and current_time - last_publish > publish_interval:
-            publish_data(last_temperature, last_humidity, last_distance)
-            last_publish = current_time
+        if wifi_status.isconnected():
+            print(f"WiFi reconnected! IP: {wifi_status.ifconfig()[0]}")
+            wifi_connected = True
+            # Reconnect MQTT right away instead of waiting out its backoff
+            mqtt_manager.kick()
+        else:
+            print("WiFi reconnection failed")
+            wifi_connected = False
+    except Exception as err:
+        print(f"WiFi reconnection error: {err}")
+        wifi_connected = False
+
+def refresh_peer(tank):
+    """Refresh a tank's actuator peer to keep the ESP-NOW link healthy"""
+    print(f"Refreshing ESP-NOW peer connection ({tank.name})...")
+    actuator_mac = tank.actuator_mac
+    try:
+        # Back to back, as in on_command_stall(): no other task may try to
+        # send to the actuator while it has no peer entry
+        e.del_peer(actuator_mac)
+        e.add_peer(actuator_mac, channel=1)
+        print("Peer refreshed")
         
-        # Wait for an ESP-NOW message with short timeout
+        # Send a test message
         try:
-            host, msg = e.irecv(100)  # 100ms timeout
+            e.send(actuator_mac, "TEST")
+            print("Test message sent")
+        except Exception as err:
+            print(f"Test message failed: {err}")
+    except Exception as err:
+        print(f"Peer refresh failed: {err}")
+
+async def maintenance_task():
+    """Periodic publish, WiFi/MQTT check, peer refresh and log flush, sleeping until the next one is due"""
+    now = time.time()
+    next_wifi_check = now + wifi_check_interval
+    next_peer_refresh = now + peer_refresh_interval
+    next_flush = now + log_flush_interval
+    next_diagnostics = now + DIAGNOSTICS_INTERVAL
+    while True:
+        current_time = time.time()
+        try:
+            # Publish periodic updates even without new sensor data
+            for tank in tank_table:
+                if mqtt_connected and current_time - tank.last_publish >= publish_interval:
+                    publish_data(tank, tank.last_temperature, tank.last_humidity, tank.last_distance)
+                    tank.last_publish = current_time
             
-            if msg:  # If we got a message
-                try:
-                    # Decode the message
-                    message_str = msg.decode('utf-8')
-                    print(f"Received: {message_str}")
-                    
-                    # Process based on message type
-                    if "ACK:" in message_str or "TEST" in message_str:
-                        # Just an acknowledgment or test message, nothing to do
-                        pass
-                    elif "Temp:" in message_str and "Humidity:" in message_str:
-                        # This is a sensor data message from the first ESP32
-                        try:
-                            # Extract temperature value
-                            temp_start = message_str.find("Temp:") + 5
-                            temp_end = message_str.find("°C", temp_start)
-                            if temp_end == -1:  # If not found with degree symbol
-                                temp_end = message_str.find(",", temp_start)
-                            temperature = float(message_str[temp_start:temp_end].strip())
-                            
-                            # Extract humidity value
-                            humid_start = message_str.find("Humidity:") + 9
-                            humid_end = message_str.find("%", humid_start)
-                            if humid_end == -1:  # If not found with percent symbol
-                                humid_end = message_str.find(",", humid_start)
-                                if humid_end == -1:  # If not found with comma
-                                    humid_end = message_str.find("|", humid_start)
-                                    if humid_end == -1:  # If not found with pipe
-                                        humid_end = len(message_str)
-                            humidity = float(message_str[humid_start:humid_end].strip())
-                            
-                            # Extract distance if available
-                            distance = None
-                            if "Distance:" in message_str:
-                                dist_start = message_str.find("Distance:") + 9
-                                dist_end = message_str.find("cm", dist_start)
-                                if dist_end == -1:  # If not found with cm
-                                    dist_end = message_str.find("|", dist_start)
-                                    if dist_end == -1:  # If not found with pipe
-                                        dist_end = len(message_str)
-                                distance = float(message_str[dist_start:dist_end].strip())
-                            
-                            # Update last known values
-                            last_temperature = temperature
-                            last_humidity = humidity
-                            if distance is not None:
-                                last_distance = distance
-                            
-                            print(f"Parsed data - Temp: {temperature}°C, Humidity: {humidity}%", end="")
-                            if distance is not None:
-                                print(f", Distance: {distance}cm")
-                            else:
-                                print("")
-                            
-                            # Decide actuator states based on thresholds
-                            states_changed = update_actuators(
-                                temperature, 
-                                humidity, 
-                                last_distance if last_distance is not None else 100
-                            )
-                            
-                            # Publish to MQTT if states changed or it's time for regular update
-                            if states_changed or (current_time - last_publish > publish_interval):
-                                publish_data(temperature, humidity, distance)
-                                last_publish = current_time
-                                
-                        except Exception as err:
-                            print(f"Error parsing sensor values: {err}")
-                    
-                    # Handle distance-only messages (possibly from first ESP32)
-                    elif "Distance:" in message_str:
-                        try:
-                            # Extract distance more carefully
-                            dist_start = message_str.find("Distance:") + 9
-                            dist_end = message_str.find("cm", dist_start)
-                            if dist_end == -1:  # If not found with cm
-                                dist_end = len(message_str)
-                            distance = float(message_str[dist_start:dist_end].strip())
-                            
-                            # Update last known value
-                            last_distance = distance
-                            print(f"Parsed Distance: {distance}cm")
-                            
-                            # Update servo based on distance threshold
-                            if distance < DISTANCE_THRESHOLD:
-                                # Object detected - close servo
-                                if not servo_state:
-                                    print(f"Object detected - CLOSING servo")
-                                    servo_state = True
-                                    send_command("servo", True)
-                            else:
-                                # No object - open servo
-                                if servo_state:
-                                    print(f"No object detected - OPENING servo")
-                                    servo_state = False
-                                    send_command("servo", False)
-                            
-                            # Publish the distance data
-                            publish_data(None, None, distance)
-                            last_publish = current_time
-                        except Exception as err:
-                            print(f"Error parsing distance: {err}")
-                    
-                    # Handle error messages
-                    elif "ERROR:" in message_str:
-                        print(f"Error message received: {message_str}")
-                    
-                    # Unknown message format
-                    else:
-                        print(f"Unknown message format: {message_str}")
-                        
-                except Exception as err:
-                    print(f"Error processing message: {err}")
+            # Periodically check WiFi/MQTT connection
+            if current_time >= next_wifi_check:
+                next_wifi_check = current_time + wifi_check_interval
+                if not network.WLAN(network.STA_IF).isconnected():
+                    await reconnect_wifi()
             
-        except Exception as recv_err:
-            print(f"Error in ESP-NOW receive: {recv_err}")
-    
-    except Exception as err:
-        print(f"Error in main loop: {err}")
+            # Periodically refresh ESP-NOW peer to keep connection healthy
+            if current_time >= next_peer_refresh:
+                next_peer_refresh = current_time + peer_refresh_interval
+                for tank in tank_table:
+                    refresh_peer(tank)
+            
+            if current_time >= next_diagnostics:
+                next_diagnostics = current_time + DIAGNOSTICS_INTERVAL
+                publish_diagnostics()
+            
+            if current_time >= next_flush:
+                next_flush = current_time + log_flush_interval
+                # Bound what a reset can lose from the offline log's RAM buffer
+                for tank in tank_table:
+                    tank.offline_log.flush()
+            # A safe point for the heap's GC when ESP-NOW and control are idle
+            heap.maybe_collect()
+        except Exception as err:
+            log.error("Error in maintenance task: {}", err)
+        
+        # Sleep until the next timer is due
+        next_publish = min(tank.last_publish for tank in tank_table) + publish_interval
+        next_due = min(next_publish, next_wifi_check, next_peer_refresh, next_flush, next_diagnostics)
+        await asyncio.sleep(max(next_due - time.time(), 1))
+
+async def main():
+    print("Ready to receive sensor data and control actuators...")
     
-    # Small delay to prevent CPU hogging
-    time.sleep(0.05)
\ No newline at end of file
+    asyncio.create_task(espnow_task())
+    asyncio.create_task(control_task())
+    asyncio.create_task(command_task())
+    asyncio.create_task(mqtt_task())
+    asyncio.create_task(offline_drain_task())
+    await maintenance_task()
+
+# ===== STARTUP =====
+# Check if WiFi is connected from boot.py
+wifi_connected = network.WLAN(network.STA_IF).isconnected()
+print(f"WiFi status: {'Connected' if wifi_connected else 'Disconnected'}")
+
+asyncio.run(main())
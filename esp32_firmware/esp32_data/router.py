@@ -0,0 +1,41 @@
+# router.py
+# Dispatches incoming ESP-NOW messages to handlers by message type.
+import telemetry
+
+
+class MessageRouter:
+    """Routes each message to a registered handler with a single dict lookup.
+
+    Binary frames (see telemetry.py) are keyed by their type byte. Legacy text
+    messages are keyed by the bytes before the first ':' (the whole message if
+    there is no ':'), e.g. b"STATUS" for "STATUS:heat:1,...".
+    Handlers are called as handler(host, msg) with the raw receive buffer.
+    """
+
+    def __init__(self):
+        self._binary_handlers = {}
+        self._text_handlers = {}
+        self._default_handler = None
+
+    def register_binary(self, msg_type, handler):
+        self._binary_handlers[msg_type] = handler
+
+    def register_text(self, key, handler):
+        self._text_handlers[key] = handler
+
+    def set_default(self, handler):
+        """Handler for messages that match no registered type"""
+        self._default_handler = handler
+
+    def dispatch(self, host, msg):
+        if telemetry.is_binary(msg):
+            handler = self._binary_handlers.get(msg[1])
+        else:
+            end = msg.find(b":")
+            handler = self._text_handlers.get(bytes(msg[:end]) if end >= 0 else bytes(msg))
+        if handler is None:
+            handler = self._default_handler
+        if handler is not None:
+            handler(host, msg)
+            return True
+        return False
@@ -0,0 +1,154 @@
+# state_codec.py
+# Delta/keyframe encoding of the controller state published over MQTT.
+#
+# A StatePublisher sends only the fields that changed since the last snapshot
+# the broker acknowledged (PUBACK), plus a full keyframe every
+# keyframe_interval seconds. Consumers rebuild the full state with
+# decode_state(); a keyframe replaces their state, a delta is merged into it.
+#
+# Two encodings, chosen per topic:
+#   "json"   - the existing JSON object; keyframes carry "full": true
+#   "struct" - a compact binary layout (see STRUCT_HEADER below)
+#
+# A multi-probe sensor node adds zone<i>_temperature/zone<i>_humidity
+# fields; they take the temperature/humidity deadbands and only the JSON
+# encoding carries them.
+import json
+import struct
+
+FIELDS = ("heat_lamp", "fan", "humidifier", "servo", "take_over",
+          "temperature", "humidity", "distance")
+BOOL_FIELD_COUNT = 5   # the first five FIELDS are booleans
+
+ENCODING_JSON = "json"
+ENCODING_STRUCT = "struct"
+
+# Binary layout: version, flags, present mask (bit i = FIELDS[i]), timestamp,
+# actuator bits (bit i = FIELDS[i] for the booleans), followed by
+# temperature (h, 0.01 C), humidity (H, 0.01 %) and distance (H, mm) for
+# whichever of them are present, in that order.
+STATE_VERSION = 1
+FLAG_KEYFRAME = 0x01
+STRUCT_HEADER = "<BBBIB"
+STRUCT_HEADER_SIZE = struct.calcsize(STRUCT_HEADER)
+_NUMERIC = (("temperature", "<h", 100), ("humidity", "<H", 100), ("distance", "<H", 10))
+
+# Smallest change in a reading that is worth a delta
+DEFAULT_DEADBANDS = {"temperature": 0.1, "humidity": 0.5, "distance": 0.5}
+
+
+def encode_struct(state, keyframe):
+    present = 0
+    actuators = 0
+    for i in range(len(FIELDS)):
+        name = FIELDS[i]
+        if name in state:
+            present |= 1 << i
+            if i < BOOL_FIELD_COUNT and state[name]:
+                actuators |= 1 << i
+    out = bytearray(struct.pack(STRUCT_HEADER, STATE_VERSION,
+                                FLAG_KEYFRAME if keyframe else 0, present,
+                                int(state.get("timestamp", 0)) & 0xFFFFFFFF, actuators))
+    for name, fmt, scale in _NUMERIC:
+        if name in state:
+            out += struct.pack(fmt, int(round(state[name] * scale)))
+    return out
+
+
+def decode_struct(payload):
+    """Returns (fields dict, keyframe flag)"""
+    version, flags, present, timestamp, actuators = struct.unpack_from(STRUCT_HEADER, payload, 0)
+    if version != STATE_VERSION:
+        raise ValueError("Unsupported state version {}".format(version))
+    fields = {"timestamp": timestamp}
+    for i in range(BOOL_FIELD_COUNT):
+        if present & (1 << i):
+            fields[FIELDS[i]] = bool(actuators & (1 << i))
+    pos = STRUCT_HEADER_SIZE
+    for i in range(len(_NUMERIC)):
+        if present & (1 << (BOOL_FIELD_COUNT + i)):
+            name, fmt, scale = _NUMERIC[i]
+            fields[name] = struct.unpack_from(fmt, payload, pos)[0] / scale
+            pos += 2
+    return fields, bool(flags & FLAG_KEYFRAME)
+
+
+def decode_state(payload, state=None, encoding=ENCODING_JSON):
+    """Apply one published message to state (a dict) and return it"""
+    if state is None:
+        state = {}
+    if encoding == ENCODING_STRUCT:
+        fields, keyframe = decode_struct(payload)
+    else:
+        fields = json.loads(payload)
+        keyframe = fields.pop("full", False)
+    if keyframe:
+        state.clear()
+    state.update(fields)
+    return state
+
+
+class StatePublisher:
+    """Builds delta/keyframe payloads for one topic"""
+
+    def __init__(self, topic, encoding=ENCODING_JSON, keyframe_interval=60,
+                 deadbands=DEFAULT_DEADBANDS):
+        self.topic = topic
+        self.encoding = encoding
+        self.keyframe_interval = keyframe_interval
+        self.deadbands = deadbands
+        self._latest = {}      # every field we know about, newest values
+        self._acked = {}       # snapshot the broker has acknowledged
+        self._acked_seq = 0
+        self._seq = 0
+        self._last_keyframe = None
+
+    def _changed(self, name):
+        if name not in self._acked:
+            return True
+        new = self._latest[name]
+        old = self._acked[name]
+        deadband = self.deadbands.get(name)
+        if deadband is None and name.startswith("zone"):
+            deadband = self.deadbands.get(name[name.find("_") + 1:])
+        if deadband is None:
+            return new != old
+        return abs(new - old) >= deadband
+
+    def build(self, state, now):
+        """Merge state into the latest snapshot and encode what needs sending.
+
+        Returns (payload, on_ack) or (None, None) when nothing changed. Call
+        on_ack() once the broker has acknowledged the payload.
+        """
+        self._latest.update(state)
+        keyframe = (self._last_keyframe is None or not self._acked or
+                    now - self._last_keyframe >= self.keyframe_interval)
+        if keyframe:
+            out = dict(self._latest)
+            self._last_keyframe = now
+        else:
+            out = {}
+            for name in self._latest:
+                if name == "timestamp" or (self.encoding == ENCODING_STRUCT and name not in FIELDS):
+                    continue
+                if self._changed(name):
+                    out[name] = self._latest[name]
+            if not out:
+                return None, None
+        out["timestamp"] = now
+        self._seq += 1
+        seq = self._seq
+        snapshot = dict(self._latest)
+
+        def on_ack():
+            # Acks can arrive out of order; only move the baseline forward
+            if seq > self._acked_seq:
+                self._acked_seq = seq
+                self._acked = snapshot
+
+        if self.encoding == ENCODING_STRUCT:
+            return encode_struct(out, keyframe), on_ack
+        if keyframe:
+            out["full"] = True
+        return json.dumps(out), on_ack
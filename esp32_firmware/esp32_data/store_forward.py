@@ -0,0 +1,196 @@
+# store_forward.py
+# Flash-backed ring log of readings taken while MQTT is unreachable.
+#
+# Records are fixed 12-byte structs. They are collected in a RAM buffer and
+# written to flash a whole buffer at a time (or when flush() is called), so a
+# reading costs one struct.pack_into while offline and flash sees a few
+# large appends instead of many small ones.
+#
+# On flash the log is a set of segment files <directory>/<n>.log. Appends go
+# to the newest segment; once it reaches segment_bytes a new one is started,
+# and when there are more than max_segments the oldest is deleted, so the log
+# never grows past roughly segment_bytes * max_segments.
+#
+# Draining reads the oldest sealed segment in chunks; a segment is deleted
+# once every chunk from it has been acknowledged. Delivery is at-least-once:
+# after a reset the partly drained segment is sent again from the start.
+try:
+    import uos as os
+except ImportError:
+    import os
+import struct
+import telemetry
+
+# timestamp (s), temp (0.01 C), humidity (0.01 %), distance (mm),
+# actuator bits, flags
+RECORD_FORMAT = "<IhHHBB"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)  # 12 bytes
+
+# Actuator bits
+ACT_HEAT_LAMP = 0x01
+ACT_FAN = 0x02
+ACT_HUMIDIFIER = 0x04
+ACT_SERVO = 0x08
+ACT_TAKE_OVER = 0x10
+
+# Flags (validity bits shared with telemetry)
+FLAG_TEMP_HUMID = telemetry.FLAG_TEMP_HUMID
+FLAG_DISTANCE = telemetry.FLAG_DISTANCE
+FLAG_TRANSITION = 0x10   # written because an actuator changed state
+
+# Batch payload: version, record size, record count, then the records
+BATCH_VERSION = 1
+BATCH_HEADER = "<BBH"
+BATCH_HEADER_SIZE = struct.calcsize(BATCH_HEADER)
+
+
+def decode_batch(payload):
+    """Yield (timestamp, temperature, humidity, distance, actuator bits, flags).
+
+    temperature/humidity/distance are None when their flag is not set.
+    """
+    version, size, count = struct.unpack_from(BATCH_HEADER, payload, 0)
+    if version != BATCH_VERSION:
+        raise ValueError("Unsupported batch version {}".format(version))
+    pos = BATCH_HEADER_SIZE
+    for _ in range(count):
+        ts, temp, humid, dist, actuators, flags = struct.unpack_from(RECORD_FORMAT, payload, pos)
+        pos += size
+        if flags & FLAG_TEMP_HUMID:
+            temp = temp / 100
+            humid = humid / 100
+        else:
+            temp = humid = None
+        dist = dist / 10 if flags & FLAG_DISTANCE else None
+        yield ts, temp, humid, dist, actuators, flags
+
+
+class RingLog:
+
+    def __init__(self, directory="/offline", segment_bytes=4096, max_segments=16,
+                 buffer_records=32):
+        self.directory = directory
+        self.segment_bytes = segment_bytes - segment_bytes % RECORD_SIZE
+        self.max_segments = max_segments
+        self._buf = bytearray(buffer_records * RECORD_SIZE)
+        self._buffered = 0
+        self.dropped = 0         # records lost to the size bound
+        self._drain_pos = 0      # bytes of the oldest segment already acknowledged
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass  # Already there
+        self._segments = sorted(int(name[:-4]) for name in os.listdir(directory)
+                                if name.endswith(".log"))
+        # Never append to a segment left over from before a reset; it may be
+        # partly drained already
+        self._sealed = len(self._segments)
+
+    def _path(self, n):
+        return "{}/{}.log".format(self.directory, n)
+
+    def _size(self, n):
+        try:
+            return os.stat(self._path(n))[6]
+        except OSError:
+            return 0
+
+    def append(self, timestamp, temperature, humidity, distance, actuators, transition=False):
+        """Record one reading (None for unknown values); flushed to flash in batches"""
+        flags = FLAG_TRANSITION if transition else 0
+        temp_fixed = humid_fixed = dist_fixed = 0
+        if temperature is not None and humidity is not None:
+            temp_fixed = int(round(temperature * 100))
+            humid_fixed = int(round(humidity * 100))
+            flags |= FLAG_TEMP_HUMID
+        if distance is not None:
+            dist_fixed = int(round(distance * 10))
+            flags |= FLAG_DISTANCE
+        struct.pack_into(RECORD_FORMAT, self._buf, self._buffered * RECORD_SIZE,
+                         int(timestamp) & 0xFFFFFFFF, temp_fixed, humid_fixed,
+                         dist_fixed, actuators, flags)
+        self._buffered += 1
+        if self._buffered * RECORD_SIZE == len(self._buf):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records to flash in one append"""
+        if not self._buffered:
+            return
+        n = self._buffered * RECORD_SIZE
+        new = (len(self._segments) == self._sealed or
+               self._size(self._segments[-1]) + n > self.segment_bytes)
+        if new:
+            segment = self._segments[-1] + 1 if self._segments else 0
+        else:
+            segment = self._segments[-1]
+        try:
+            with open(self._path(segment), "ab") as f:
+                f.write(memoryview(self._buf)[:n])
+        except OSError:
+            # A new segment only joins the log once it holds records
+            if new:
+                try:
+                    os.remove(self._path(segment))
+                except OSError:
+                    pass
+            raise
+        finally:
+            # On a write error (flash full) the batch is lost rather than retried forever
+            self._buffered = 0
+        if new:
+            self._segments.append(segment)
+        while len(self._segments) > self.max_segments:
+            self.dropped += self._size(self._segments[0]) // RECORD_SIZE
+            self._remove_oldest()
+
+    def seal(self):
+        """Flush and close the current segment so it can be drained"""
+        self.flush()
+        self._sealed = len(self._segments)
+
+    def _remove_oldest(self):
+        try:
+            os.remove(self._path(self._segments.pop(0)))
+        except OSError:
+            pass
+        self._sealed = max(self._sealed - 1, 0)
+        self._drain_pos = 0
+
+    def pending(self):
+        """True if anything is waiting to be drained (buffered or on flash)"""
+        return bool(self._segments) or self._buffered > 0
+
+    def read_batch(self, buf, max_records):
+        """Pack up to max_records of the oldest sealed segment into buf as a batch.
+
+        Returns (payload memoryview, mark to pass to commit()), or
+        (None, None) when nothing is sealed. buf must hold
+        BATCH_HEADER_SIZE + max_records * RECORD_SIZE bytes.
+        """
+        if not self._sealed:
+            return None, None
+        n = self._segments[0]
+        view = memoryview(buf)
+        try:
+            with open(self._path(n), "rb") as f:
+                f.seek(self._drain_pos)
+                got = f.readinto(view[BATCH_HEADER_SIZE:BATCH_HEADER_SIZE + max_records * RECORD_SIZE])
+        except OSError:
+            got = 0  # Missing or unreadable: drop it rather than fail every drain
+        got = (got or 0) - (got or 0) % RECORD_SIZE
+        if not got:
+            # Fully drained, empty or unreadable segment
+            self._remove_oldest()
+            return self.read_batch(buf, max_records)
+        struct.pack_into(BATCH_HEADER, buf, 0, BATCH_VERSION, RECORD_SIZE, got // RECORD_SIZE)
+        return view[:BATCH_HEADER_SIZE + got], (n, self._drain_pos + got)
+
+    def commit(self, mark):
+        """Mark a batch returned by read_batch() as delivered"""
+        n, end = mark
+        if not self._sealed or self._segments[0] != n:
+            return  # Segment was dropped by the size bound meanwhile
+        self._drain_pos = max(self._drain_pos, end)
+        if self._drain_pos >= self._size(n):
+            self._remove_oldest()
@@ -0,0 +1,116 @@
+# tanks.py
+# Per-terrarium state for a controller that runs several sensor/actuator
+# node pairs.
+#
+# Each tank is a slotted object whose thresholds and actuator states live in
+# small arrays, and the TankTable finds the tank for an incoming ESP-NOW
+# frame (by sender MAC) or MQTT message (by control topic) with one dict
+# lookup. Every tank gets its own topic namespace, environment/<name>/...
+from array import array
+
+TOPIC_PREFIX = "environment/"
+
+# Indices into Tank.thresholds
+TEMP_LOWER = 0           # Below this temperature, heat lamp ON
+TEMP_UPPER = 1           # Above this temperature, fan ON
+HUMID_LOWER = 2          # Below this humidity, humidifier ON
+HUMID_UPPER = 3          # Above this humidity, fan ON
+DISTANCE_THRESHOLD = 4   # Below this distance (cm), close servo
+
+# Indices into Tank.actuators; DEVICES are the names used in actuator commands
+HEAT = 0
+FAN = 1
+HUMID = 2
+SERVO = 3
+DEVICES = ("heat", "fan", "humid", "servo")
+
+
+def mac_from_str(mac_str):
+    """"aa:bb:cc:dd:ee:ff" -> 6 bytes"""
+    return bytes(int(part, 16) for part in mac_str.split(":"))
+
+
+class Tank:
+    __slots__ = ("name", "sensor_mac", "actuator_mac", "thresholds", "actuators",
+                 "take_over", "sensor_mode", "last_temperature", "last_humidity",
+                 "last_distance", "last_publish", "pending", "topic_data",
+                 "topic_control", "topic_batch", "publishers", "offline_log",
+                 "last_logged_actuators", "command_seq", "pending_trace", "trace",
+                 "command_sent_us", "command_trace", "fast_until", "zones",
+                 "actuator_heap")
+
+    def __init__(self, name, sensor_mac, actuator_mac, thresholds, sensor_mode=0):
+        self.name = name
+        self.sensor_mac = sensor_mac      # None until learned from its first frame
+        self.actuator_mac = actuator_mac
+        self.thresholds = array("f", thresholds)
+        self.actuators = bytearray(len(DEVICES))  # 1 = on (servo: closed)
+        self.take_over = False
+        self.sensor_mode = sensor_mode
+        self.last_temperature = None
+        self.last_humidity = None
+        self.last_distance = None
+        self.last_publish = 0
+        self.pending = None               # reading waiting for the control task
+        self.topic_data = self.topic("data")
+        self.topic_control = self.topic("control")
+        self.topic_batch = self.topic("data/batch")
+        self.publishers = ()
+        self.offline_log = None
+        self.last_logged_actuators = None
+        self.command_seq = 0
+        # Latency tracing (ticks_us): the pending reading's [received, sample
+        # age] and, while it is being handled, [received, sample age,
+        # decision start]; the in-flight command's send time and the trace of
+        # the reading that caused it
+        self.pending_trace = None
+        self.trace = None
+        self.command_sent_us = 0
+        self.command_trace = None
+        self.fast_until = 0               # time.time() the sensor's fast reporting runs out
+        self.zones = None                 # per-zone (temperature, humidity) of a multi-probe sensor
+        self.actuator_heap = None         # the actuator's last heap report (heap.py summary)
+
+    def topic(self, suffix):
+        return (TOPIC_PREFIX + self.name + "/" + suffix).encode()
+
+
+class TankTable:
+
+    def __init__(self):
+        self.tanks = []
+        self._by_mac = {}
+        self._by_topic = {}
+
+    def add(self, tank):
+        self.tanks.append(tank)
+        self._by_mac[tank.actuator_mac] = tank
+        if tank.sensor_mac is not None:
+            self._by_mac[tank.sensor_mac] = tank
+        self._by_topic[tank.topic_control] = tank
+        return tank
+
+    def by_mac(self, mac):
+        return self._by_mac.get(mac)
+
+    def by_topic(self, topic):
+        return self._by_topic.get(topic)
+
+    def learn_sensor(self, mac):
+        """Assign an unknown sender to the one tank still missing its sensor node.
+
+        Returns the tank, or None if that is ambiguous (or no tank needs one).
+        """
+        waiting = [tank for tank in self.tanks if tank.sensor_mac is None]
+        if len(waiting) != 1:
+            return None
+        tank = waiting[0]
+        tank.sensor_mac = bytes(mac)
+        self._by_mac[tank.sensor_mac] = tank
+        return tank
+
+    def __iter__(self):
+        return iter(self.tanks)
+
+    def __len__(self):
+        return len(self.tanks)
@@ -0,0 +1,345 @@
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+import time
+from .simple import MQTTException, RecvBuffer, publish_size, pack_publish
+
+# Asynchronous MQTT 3.1.1 client for uasyncio.
+#
+# publish() only queues the message and returns immediately. A writer task
+# drains the bounded outbound queue while keeping at most inflight_window QoS1
+# publishes unacknowledged; a retransmit task resends any of them whose
+# PUBACK has not arrived within retry_timeout_ms, with the DUP flag set.
+# With keepalive set, a pinger task sends PINGREQ every keepalive/2 seconds
+# and ends run() if the PINGRESP does not arrive within ping_timeout_ms.
+# SUBACKs are handled by the reader task like any other packet, so
+# subscribe() does not wait for the broker either. Incoming bytes are read
+# in bulk into one receive buffer and the callback gets topic and message as
+# memoryviews into it; copy them if they must outlive the call.
+#
+# Typical use:
+#     client = MQTTClient("id", "broker")
+#     client.set_callback(cb)
+#     await client.connect()
+#     await client.subscribe(b"topic")
+#     await client.run()        # returns/raises when the connection drops
+
+
+class MQTTClient:
+
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
+                 ssl=False, ssl_params={}, queue_size=16, inflight_window=4,
+                 retry_timeout_ms=5000, pkt_buf_size=256, rbuf_size=256, ping_timeout_ms=3000):
+        if port == 0:
+            port = 8883 if ssl else 1883
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.ssl_params = ssl_params
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+        self.lw_topic = None
+        self.lw_msg = None
+        self.lw_qos = 0
+        self.lw_retain = False
+        self.cb = None
+        self.pid = 0
+        self.queue_size = queue_size
+        self.inflight_window = inflight_window
+        self.retry_timeout_ms = retry_timeout_ms
+        self.ping_timeout_ms = ping_timeout_ms
+        self._reader = None
+        self._writer = None
+        # QoS0 PUBLISH packets are packed here, reused once drain() returns.
+        # Each QoS1 packet takes a slot of its own from _slots, one per
+        # in-flight window place, and keeps it for resending until its
+        # PUBACK gives it back. Buffers grow when a packet does not fit.
+        self._pkt_buf = bytearray(pkt_buf_size)
+        self._slots = [bytearray(pkt_buf_size) for _ in range(inflight_window)]
+        self._rx = RecvBuffer(rbuf_size)
+        self._queue = []        # (topic, msg, qos, retain, on_ack) waiting to be sent
+        self._inflight = {}     # pid -> [packet, resend deadline (ticks_ms), on_ack, slot]
+        self._pending_subs = {}  # pid -> topic awaiting SUBACK
+        self._wake = asyncio.Event()
+        self._pingresp = False
+        self._keepalive_expired = False
+        self._run_task = None
+        self.connected = False
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 2
+        assert topic
+        self.lw_topic = topic
+        self.lw_msg = msg
+        self.lw_qos = qos
+        self.lw_retain = retain
+
+    @staticmethod
+    def _str(s):
+        if isinstance(s, str):
+            s = s.encode()  # MicroPython would take str as a buffer, CPython does not
+        return len(s).to_bytes(2, "big") + s
+
+    @staticmethod
+    def _encode_len(sz):
+        out = bytearray()
+        while sz > 0x7f:
+            out.append((sz & 0x7f) | 0x80)
+            sz >>= 7
+        out.append(sz)
+        return out
+
+    def _next_pid(self):
+        while True:
+            self.pid = self.pid % 65535 + 1
+            if self.pid not in self._inflight and self.pid not in self._pending_subs:
+                return self.pid
+
+    def _connect_packet(self, clean_session):
+        """The whole CONNECT packet (MQTT 3.1.1)"""
+        # Variable header: protocol name "MQTT" (2-byte length), level 4,
+        # connect flags, keepalive
+        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+        msg[6] = clean_session << 1
+        if self.user is not None:
+            msg[6] |= 0xC0
+        if self.keepalive:
+            assert self.keepalive < 65536
+            msg[7] |= self.keepalive >> 8
+            msg[8] |= self.keepalive & 0x00FF
+        if self.lw_topic:
+            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            msg[6] |= self.lw_retain << 5
+        payload = self._str(self.client_id)
+        if self.lw_topic:
+            payload += self._str(self.lw_topic) + self._str(self.lw_msg)
+        if self.user is not None:
+            payload += self._str(self.user) + self._str(self.pswd)
+        body = b"\0" + msg + payload
+        return b"\x10" + self._encode_len(len(body)) + body
+
+    async def connect(self, clean_session=True, addr=None):
+        """Connect and return the CONNACK session-present flag.
+
+        addr is an already resolved broker IP to connect to instead of
+        looking up self.server again.
+        """
+        self._reader, self._writer = await asyncio.open_connection(
+            addr or self.server, self.port, ssl=self.ssl or None)
+        self._writer.write(self._connect_packet(clean_session))
+        await self._writer.drain()
+        resp = await self._reader.readexactly(4)
+        if resp[0] != 0x20 or resp[1] != 0x02:
+            raise MQTTException(-1)
+        if resp[3] != 0:
+            raise MQTTException(resp[3])
+        self._rx.reset()
+        self.connected = True
+        # Anything still unacknowledged from a previous connection goes out again
+        now = time.ticks_ms()
+        for entry in self._inflight.values():
+            entry[0][0] |= 0x08  # DUP
+            entry[1] = now
+        self._wake.set()
+        return resp[2] & 1
+
+    async def disconnect(self):
+        self.connected = False
+        try:
+            self._writer.write(b"\xe0\0")
+            await self._writer.drain()
+        finally:
+            self._writer.close()
+
+    async def ping(self):
+        self._writer.write(b"\xc0\0")
+        await self._writer.drain()
+
+    def publish(self, topic, msg, retain=False, qos=0, on_ack=None):
+        """Queue a message for sending. Returns False if the outbound queue is full.
+
+        on_ack() is called once the message is delivered: on PUBACK for QoS1,
+        after it has been written to the socket for QoS0.
+        """
+        assert qos in (0, 1), "Only QoS 0 and 1 are supported"
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        if len(self._queue) >= self.queue_size:
+            return False
+        self._queue.append((topic, msg, qos, retain, on_ack))
+        self._wake.set()
+        return True
+
+    async def subscribe(self, topic, qos=0):
+        """Send SUBSCRIBE; the SUBACK is processed later by run()"""
+        assert self.cb is not None, "Subscribe callback is not set"
+        pid = self._next_pid()
+        self._pending_subs[pid] = topic
+        body = pid.to_bytes(2, "big") + self._str(topic) + qos.to_bytes(1, "little")
+        self._writer.write(b"\x82" + self._encode_len(len(body)) + body)
+        await self._writer.drain()
+        return pid
+
+    def pending(self):
+        """Number of messages queued or awaiting PUBACK"""
+        return len(self._queue) + len(self._inflight)
+
+    def _build_publish(self, topic, msg, qos, retain, pid):
+        """Pack a PUBLISH packet; returns (packet view, buffer holding it).
+
+        QoS0 uses the shared buffer, QoS1 a slot from the pool.
+        """
+        size = publish_size(topic, msg, qos)
+        if qos:
+            buf = self._slots.pop() if self._slots else None
+        else:
+            buf = self._pkt_buf
+        if buf is None or size > len(buf):
+            buf = bytearray(size)
+            if not qos:
+                self._pkt_buf = buf
+        n = pack_publish(buf, topic, msg, retain, qos, pid)
+        return memoryview(buf)[:n], buf
+
+    async def _writer_task(self):
+        while True:
+            while self._queue and len(self._inflight) < self.inflight_window:
+                topic, msg, qos, retain, on_ack = self._queue.pop(0)
+                pid = self._next_pid() if qos else 0
+                pkt, buf = self._build_publish(topic, msg, qos, retain, pid)
+                if qos:
+                    self._inflight[pid] = [pkt, time.ticks_add(time.ticks_ms(), self.retry_timeout_ms),
+                                           on_ack, buf]
+                self._writer.write(pkt)
+                await self._writer.drain()
+                if not qos and on_ack:
+                    on_ack()
+            # Retransmissions after a reconnect are flagged with a deadline of now
+            self._wake.clear()
+            await self._retransmit()
+            await self._wake.wait()
+
+    async def _retransmit(self):
+        now = time.ticks_ms()
+        for entry in list(self._inflight.values()):
+            if time.ticks_diff(now, entry[1]) >= 0:
+                entry[0][0] |= 0x08  # DUP
+                entry[1] = time.ticks_add(now, self.retry_timeout_ms)
+                self._writer.write(entry[0])
+                await self._writer.drain()
+
+    async def _retransmit_task(self):
+        while True:
+            await asyncio.sleep_ms(self.retry_timeout_ms // 2 or 1)
+            await self._retransmit()
+
+    async def _fill(self, n):
+        """Read from the stream in bulk until at least n bytes are buffered"""
+        rx = self._rx
+        while rx.available() < n:
+            space = rx.space(n)
+            if hasattr(self._reader, "readinto"):
+                got = await self._reader.readinto(space)
+            else:
+                data = await self._reader.read(len(space))
+                got = len(data)
+                space[:got] = data
+            if not got:
+                raise OSError(-1)
+            rx.commit(got)
+
+    async def _read_packet(self):
+        """Buffer one whole packet; returns (op, body size)"""
+        await self._fill(2)
+        op = self._rx.byte()
+        sz = 0
+        sh = 0
+        while 1:
+            await self._fill(1)
+            b = self._rx.byte()
+            sz |= (b & 0x7f) << sh
+            if not b & 0x80:
+                break
+            sh += 7
+        await self._fill(sz)
+        return op, sz
+
+    async def _handle_packet(self, op, sz):
+        kind = op & 0xf0
+        rx = self._rx
+        if kind == 0x30:  # PUBLISH
+            qos = (op >> 1) & 3
+            if qos == 2:
+                raise MQTTException("QoS 2 not supported")
+            # topic and msg are memoryviews into the receive buffer
+            topic, pid, msg = rx.publish(op, sz)
+            self.cb(topic, msg)
+            if qos == 1:
+                self._writer.write(bytes((0x40, 0x02, pid >> 8, pid & 0xFF)))
+                await self._writer.drain()
+            return
+        body = rx.take(sz)
+        if kind == 0x40:  # PUBACK
+            pid = body[0] << 8 | body[1]
+            entry = self._inflight.pop(pid, None)
+            if entry is not None:
+                self._slots.append(entry[3])
+                self._wake.set()  # A slot in the in-flight window opened up
+                if entry[2]:
+                    entry[2]()
+        elif kind == 0x90:  # SUBACK
+            pid = body[0] << 8 | body[1]
+            self._pending_subs.pop(pid, None)
+            if body[2] == 0x80:
+                raise MQTTException(body[2])
+        elif kind == 0xd0:  # PINGRESP
+            self._pingresp = True
+        # Anything else needs no action
+
+    async def _keepalive_task(self):
+        interval = self.keepalive * 500
+        while True:
+            await asyncio.sleep_ms(interval)
+            self._pingresp = False
+            await self.ping()
+            await asyncio.sleep_ms(self.ping_timeout_ms)
+            if not self._pingresp:
+                # Broker unreachable: end run() now instead of waiting for TCP
+                self._keepalive_expired = True
+                self._run_task.cancel()
+                return
+
+    async def run(self):
+        """Process traffic until the connection drops (raises OSError/MQTTException)"""
+        self._run_task = asyncio.current_task()
+        self._keepalive_expired = False
+        tasks = [asyncio.create_task(self._writer_task()),
+                 asyncio.create_task(self._retransmit_task())]
+        if self.keepalive:
+            tasks.append(asyncio.create_task(self._keepalive_task()))
+        try:
+            while True:
+                op, sz = await self._read_packet()
+                await self._handle_packet(op, sz)
+        except EOFError:
+            raise OSError(-1)
+        except asyncio.CancelledError:
+            if self._keepalive_expired:
+                raise OSError("PINGRESP timeout")
+            raise
+        finally:
+            self.connected = False
+            for task in tasks:
+                task.cancel()
+            try:
+                self._writer.close()
+            except Exception:
+                pass
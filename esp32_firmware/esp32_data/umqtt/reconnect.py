@@ -0,0 +1,108 @@
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+try:
+    import usocket as socket
+except:
+    import socket
+import time
+import log
+
+# Keeps an umqtt.aio client connected.
+#
+# The broker address is resolved once and reused for dns_ttl_ms, so a
+# reconnect after a WiFi blip is a TCP connect plus CONNECT/CONNACK with no
+# DNS round trip. The session is persistent (clean_session=False): when the
+# broker reports the session as present, subscriptions are not redone and
+# QoS1 messages it queued while we were away are delivered on reconnect.
+# Failed attempts are retried after min_backoff_ms, doubling up to
+# max_backoff_ms; kick() cuts the current wait short (e.g. once WiFi is back).
+# Every failed connect and every dropped connection is logged with its cause.
+
+
+class ReconnectManager:
+
+    def __init__(self, client, subscriptions=(), dns_ttl_ms=3600000,
+                 min_backoff_ms=50, max_backoff_ms=5000, on_state=None):
+        """subscriptions: (topic, qos) pairs to subscribe when no session is present.
+        on_state(connected) is called on every connect/disconnect."""
+        self.client = client
+        self.subscriptions = subscriptions
+        self.dns_ttl_ms = dns_ttl_ms
+        self.min_backoff_ms = min_backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.on_state = on_state
+        self.connected = False
+        self.reconnects = 0
+        self.last_connect_ms = 0   # duration of the last successful connect
+        self._addr = None
+        self._resolved_at = 0
+        self._kick = asyncio.Event()
+
+    def _resolve(self):
+        """Broker IP, from cache while the TTL has not expired"""
+        now = time.ticks_ms()
+        if self._addr is None or time.ticks_diff(now, self._resolved_at) >= self.dns_ttl_ms:
+            try:
+                self._addr = socket.getaddrinfo(self.client.server, self.client.port)[0][-1][0]
+                self._resolved_at = now
+            except OSError:
+                if self._addr is None:
+                    raise
+                # Keep using the stale address rather than not connecting at all
+        return self._addr
+
+    def invalidate(self):
+        """Forget the cached address so the next attempt resolves again"""
+        self._addr = None
+
+    def kick(self):
+        """Retry immediately instead of waiting out the current backoff"""
+        self._kick.set()
+
+    def _set_state(self, connected):
+        self.connected = connected
+        if self.on_state:
+            self.on_state(connected)
+
+    async def connect(self):
+        start = time.ticks_ms()
+        addr = self._resolve()
+        try:
+            session_present = await self.client.connect(clean_session=False, addr=addr)
+        except OSError:
+            # The broker may have moved; look it up again next time
+            self.invalidate()
+            raise
+        if not session_present:
+            for topic, qos in self.subscriptions:
+                await self.client.subscribe(topic, qos)
+        self.last_connect_ms = time.ticks_diff(time.ticks_ms(), start)
+        self._set_state(True)
+
+    async def run(self):
+        """Connect, process traffic and reconnect, forever"""
+        backoff = self.min_backoff_ms
+        while True:
+            if not self.connected:
+                try:
+                    await self.connect()
+                    backoff = self.min_backoff_ms
+                except Exception as err:
+                    # e.g. MQTTException(5): the broker refused our credentials
+                    log.warn("MQTT connect failed: {}", err)
+                    self._kick.clear()
+                    try:
+                        await asyncio.wait_for(self._kick.wait(), backoff / 1000)
+                    except asyncio.TimeoutError:
+                        pass
+                    backoff = min(backoff * 2, self.max_backoff_ms)
+                    continue
+            try:
+                await self.client.run()
+            except Exception as err:
+                # PINGRESP timeout, EOF from the broker, MQTTException...
+                log.warn("MQTT connection lost: {}", err)
+            self.reconnects += 1
+            self._set_state(False)
@@ -2,16 +2,129 @@ try:
     import usocket as socket
 except:
     import socket
-import ustruct as struct
-from ubinascii import hexlify
+try:
+    import ustruct as struct
+except:
+    import struct
+try:
+    from ubinascii import hexlify
+except:
+    from binascii import hexlify
 
 class MQTTException(Exception):
     pass
 
+def publish_size(topic, msg, qos):
+    """Total size in bytes of a PUBLISH packet (fixed header included)"""
+    sz = 2 + len(topic) + len(msg)
+    if qos > 0:
+        sz += 2
+    assert sz < 2097152
+    n = 2
+    limit = 0x80
+    while sz >= limit:
+        n += 1
+        limit <<= 7
+    return n + sz
+
+def pack_publish(buf, topic, msg, retain, qos, pid):
+    """Assemble a whole PUBLISH packet into buf (a bytearray of at least
+    publish_size() bytes) and return its length."""
+    mv = memoryview(buf)
+    sz = 2 + len(topic) + len(msg)
+    if qos > 0:
+        sz += 2
+    buf[0] = 0x30 | qos << 1 | retain
+    i = 1
+    while sz > 0x7f:
+        buf[i] = (sz & 0x7f) | 0x80
+        sz >>= 7
+        i += 1
+    buf[i] = sz
+    i += 1
+    n = len(topic)
+    buf[i] = n >> 8
+    buf[i + 1] = n & 0xFF
+    i += 2
+    mv[i:i + n] = topic
+    i += n
+    if qos > 0:
+        buf[i] = pid >> 8
+        buf[i + 1] = pid & 0xFF
+        i += 2
+    n = len(msg)
+    mv[i:i + n] = msg
+    return i + n
+
+class RecvBuffer:
+    """Bulk receive buffer. Bytes are read from the socket in as large chunks
+    as it will give and parsed in place; buf[pos:end] is still unparsed."""
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.pos = 0
+        self.end = 0
+
+    def reset(self):
+        self.pos = 0
+        self.end = 0
+
+    def available(self):
+        return self.end - self.pos
+
+    def space(self, n):
+        """Free tail of the buffer to read into, with room for n unparsed bytes"""
+        if len(self.buf) - self.pos < n:
+            # Move the unparsed bytes to the front, growing the buffer for
+            # packets bigger than it
+            avail = self.end - self.pos
+            if n > len(self.buf):
+                buf = bytearray(n)
+                buf[:avail] = memoryview(self.buf)[self.pos:self.end]
+                self.buf = buf
+            else:
+                mv = memoryview(self.buf)
+                mv[:avail] = mv[self.pos:self.end]
+            self.pos = 0
+            self.end = avail
+        return memoryview(self.buf)[self.end:]
+
+    def commit(self, n):
+        self.end += n
+
+    def take(self, n):
+        """Consume n bytes; the memoryview is valid until the buffer is refilled"""
+        start = self.pos
+        self.pos += n
+        return memoryview(self.buf)[start:self.pos]
+
+    def byte(self):
+        self.pos += 1
+        return self.buf[self.pos - 1]
+
+    def publish(self, op, sz):
+        """Consume the sz byte body of a buffered PUBLISH.
+
+        Returns (topic, pid, msg) with topic/msg as memoryviews.
+        """
+        buf = self.buf
+        mv = memoryview(buf)
+        i = self.pos
+        end = i + sz
+        topic_len = (buf[i] << 8) | buf[i + 1]
+        topic = mv[i + 2:i + 2 + topic_len]
+        i += 2 + topic_len
+        pid = 0
+        if op & 6:
+            pid = buf[i] << 8 | buf[i + 1]
+            i += 2
+        self.pos = end
+        return topic, pid, mv[i:end]
+
 class MQTTClient:
 
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params={}):
+                 ssl=False, ssl_params={}, pkt_buf_size=256, rbuf_size=256):
         if port == 0:
             port = 8883 if ssl else 1883
         self.client_id = client_id
@@ -29,16 +142,42 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # Reused for every outgoing PUBLISH; grown if a packet does not fit
+        self._pkt_buf = bytearray(pkt_buf_size)
+        self._rx = RecvBuffer(rbuf_size)
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
         self.sock.write(s)
 
+    def _fill(self, n):
+        """Make sure at least n unparsed bytes are buffered.
+
+        Returns False only if the socket is non-blocking and has no data.
+        """
+        rx = self._rx
+        while rx.available() < n:
+            got = self.sock.readinto(rx.space(n))
+            if got is None:
+                return False
+            if got == 0:
+                raise OSError(-1)
+            rx.commit(got)
+        return True
+
+    def _read(self, n):
+        self._fill(n)
+        return self._rx.take(n)
+
+    def _read_byte(self):
+        self._fill(1)
+        return self._rx.byte()
+
     def _recv_len(self):
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            b = self._read_byte()
             n |= (b & 0x7f) << sh
             if not b & 0x80:
                 return n
@@ -57,6 +196,7 @@ class MQTTClient:
 
     def connect(self, clean_session=True):
         self.sock = socket.socket()
+        self._rx.reset()
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
         if self.ssl:
@@ -96,7 +236,7 @@ class MQTTClient:
         if self.user is not None:
             self._send_str(self.user)
             self._send_str(self.pswd)
-        resp = self.sock.read(4)
+        resp = self._read(4)
         assert resp[0] == 0x20 and resp[1] == 0x02
         if resp[3] != 0:
             raise MQTTException(resp[3])
@@ -110,34 +250,28 @@ class MQTTClient:
         self.sock.write(b"\xc0\0")
 
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
-        if qos > 0:
-            sz += 2
-        assert sz < 2097152
-        i = 1
-        while sz > 0x7f:
-            pkt[i] = (sz & 0x7f) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        pid = 0
         if qos > 0:
             self.pid += 1
             pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
+        size = publish_size(topic, msg, qos)
+        if size > len(self._pkt_buf):
+            self._pkt_buf = bytearray(size)
+        n = pack_publish(self._pkt_buf, topic, msg, retain, qos, pid)
+        #print(hex(n), hexlify(self._pkt_buf[:n], ":"))
+        # One write per packet, so it goes out in as few TCP segments as possible
+        self.sock.write(memoryview(self._pkt_buf)[:n])
         if qos == 1:
             while 1:
                 op = self.wait_msg()
                 if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
+                    sz = self._read_byte()
+                    assert sz == 2
+                    rcv_pid = self._read(2)
                     rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
                     if pid == rcv_pid:
                         return
@@ -156,7 +290,7 @@ class MQTTClient:
         while 1:
             op = self.wait_msg()
             if op == 0x90:
-                resp = self.sock.read(4)
+                resp = self._read(4)
                 #print(resp)
                 assert resp[1] == pkt[2] and resp[2] == pkt[3]
                 if resp[3] == 0x80:
@@ -167,30 +301,23 @@ class MQTTClient:
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
+    # The callback receives topic and message as memoryviews into the
+    # receive buffer; copy them (bytes(msg)) if they must outlive the call.
     def wait_msg(self):
-        res = self.sock.read(1)
+        res = self._fill(1)
         self.sock.setblocking(True)
-        if res is None:
+        if not res:
             return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
+        op = self._read_byte()
+        if op == 0xd0:  # PINGRESP
+            sz = self._read_byte()
             assert sz == 0
             return None
-        op = res[0]
         if op & 0xf0 != 0x30:
             return op
         sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
-        if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
+        self._fill(sz)
+        topic, pid, msg = self._rx.publish(op, sz)
         self.cb(topic, msg)
         if op & 6 == 2:
             pkt = bytearray(b"\x40\x02\0\0")
@@ -0,0 +1,102 @@
+# aggregate.py
+# Running window statistics for on-node aggregation of sensor samples.
+import random
+import struct
+from array import array
+
+# count, min, max, sum, last: what save()/restore() keep of a window
+STATE_FORMAT = "<Iffff"
+STATE_SIZE = struct.calcsize(STATE_FORMAT)  # 20 bytes
+
+
+class Window:
+    """Tracks count/min/max/mean/last for one channel over a reporting window.
+
+    If max_samples is given, up to that many samples are also kept (in a
+    preallocated array) so a median can be taken at the end of the window.
+    Once the array is full it is a reservoir sample: each later sample
+    replaces a random slot with probability max_samples / samples seen, so
+    the kept samples stay a uniform sample of the whole window however long
+    it runs.
+    """
+
+    def __init__(self, max_samples=0):
+        self._samples = array('f', [0] * max_samples) if max_samples else None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self._sum = 0.0
+        self._stored = 0
+        self._seen = 0      # samples offered to the reservoir
+
+    def add(self, value):
+        if self.count == 0:
+            self.min = value
+            self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        samples = self._samples
+        if samples is not None:
+            self._seen += 1
+            if self._stored < len(samples):
+                samples[self._stored] = value
+                self._stored += 1
+            else:
+                slot = random.getrandbits(30) % self._seen
+                if slot < self._stored:
+                    samples[slot] = value
+        self.count += 1
+        self._sum += value
+        self.last = value
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self._sum / self.count
+
+    def median(self):
+        """Median of the stored samples (None if nothing was stored).
+
+        Sorts them in place (insertion sort, once per window), which leaves
+        the reservoir a valid sample.
+        """
+        if self._samples is None or self._stored == 0:
+            return None
+        values = self._samples
+        n = self._stored
+        for i in range(1, n):
+            v = values[i]
+            j = i - 1
+            while j >= 0 and values[j] > v:
+                values[j + 1] = values[j]
+                j -= 1
+            values[j + 1] = v
+        mid = n // 2
+        if n % 2:
+            return values[mid]
+        return (values[mid - 1] + values[mid]) / 2
+
+    def save(self, buf, offset):
+        """Pack the running statistics (not the stored samples) into buf at offset"""
+        if self.count:
+            struct.pack_into(STATE_FORMAT, buf, offset, self.count, self.min, self.max,
+                             self._sum, self.last)
+        else:
+            struct.pack_into(STATE_FORMAT, buf, offset, 0, 0, 0, 0, 0)
+
+    def restore(self, buf, offset):
+        """Undo save(); the median then covers only samples added afterwards"""
+        self.reset()
+        count, lo, hi, total, last = struct.unpack_from(STATE_FORMAT, buf, offset)
+        if count:
+            self.count = count
+            self.min = lo
+            self.max = hi
+            self._sum = total
+            self.last = last
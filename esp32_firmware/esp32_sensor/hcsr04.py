@@ -1,5 +1,6 @@
 import machine, time
 from machine import Pin
+from array import array
 
 __version__ = '0.2.0'
 __author__ = 'Roberto Sanchez'
@@ -11,13 +12,27 @@ class HCSR04:
     The sensor range is between 2cm and 4m.
     The timeouts received listening to echo pin are converted to OSError('Out of range')
     """
+    # The datasheet's measurement cycle: an echo of one ping can still come
+    # back this long after it, so the next trigger waits for it
+    MIN_INTERVAL_MS = 60
+    # The sensor raises echo ~0.5 ms after the trigger; a ping that has
+    # produced nothing this long after echo_timeout_us is lost
+    ECHO_START_US = 1000
+    # Burst filter: samples further than MAD_LIMIT median absolute
+    # deviations (at least MIN_MAD_MM) from the median are dropped
+    MAD_LIMIT = 3
+    MIN_MAD_MM = 3
+
     # echo_timeout_us is based in chip range limit (400cm)
-    def __init__(self, trigger_pin, echo_pin, echo_timeout_us=500*2*30):
+    def __init__(self, trigger_pin, echo_pin, echo_timeout_us=500*2*30, use_irq=False, max_burst=9):
         """
         trigger_pin: Output pin to send pulses
         echo_pin: Readonly pin to measure the distance. The pin should be protected with 1k resistor
         echo_timeout_us: Timeout in microseconds to listen to echo pin. 
         By default is based in sensor limit range (4m)
+        use_irq: Timestamp the echo edges in a pin interrupt instead of
+        busy-waiting in time_pulse_us(), so the CPU is free while the sound is in flight
+        max_burst: Most pings burst_mm() takes
         """
         self.echo_timeout_us = echo_timeout_us
         # Init trigger pin (out)
@@ -27,17 +42,82 @@ class HCSR04:
         # Init echo pin (in)
         self.echo = Pin(echo_pin, mode=Pin.IN, pull=None)
 
-    def _send_pulse_and_wait(self):
-        """
-        Send the pulse to trigger and listen on echo pin.
-        We use the method `machine.time_pulse_us()` to get the microseconds until the echo is received.
-        """
+        # Echo edge timestamps (ticks_us, -1 = not yet), written by the ISR
+        self._rise = -1
+        self._fall = -1
+        self._pinged_at = time.ticks_us()
+        self._last_ping_ms = time.ticks_add(time.ticks_ms(), -self.MIN_INTERVAL_MS)
+        self._samples = array('i', [0] * max_burst)
+        self._deviations = array('i', [0] * max_burst)
+        self.use_irq = use_irq
+        if use_irq:
+            self.echo.irq(handler=self._echo_irq, trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING)
+
+    def _echo_irq(self, pin):
+        # Integer work only: this runs in interrupt context
+        if self._rise < 0:
+            self._rise = time.ticks_us()
+        elif self._fall < 0:
+            self._fall = time.ticks_us()
+
+    def _wait_cycle(self):
+        # Never trigger closer together than the measurement cycle
+        wait_ms = self.MIN_INTERVAL_MS - time.ticks_diff(time.ticks_ms(), self._last_ping_ms)
+        if wait_ms > 0:
+            time.sleep_ms(wait_ms)
+        self._last_ping_ms = time.ticks_ms()
+
+    def _trigger(self):
         self.trigger.value(0) # Stabilize the sensor
         time.sleep_us(5)
         self.trigger.value(1)
         # Send a 10us pulse.
         time.sleep_us(10)
         self.trigger.value(0)
+
+    def ping(self):
+        """Start a measurement in IRQ mode; poll pulse_us() for the result"""
+        self._wait_cycle()
+        self._rise = -1
+        self._fall = -1
+        self._pinged_at = time.ticks_us()
+        self._trigger()
+
+    def pulse_us(self):
+        """Echo pulse width of the last ping(), None while it is still in flight.
+
+        Raises OSError('Out of range') if the echo is longer than
+        echo_timeout_us or never came.
+        """
+        rise = self._rise
+        fall = self._fall
+        if fall >= 0:
+            width = time.ticks_diff(fall, rise)
+            if width > self.echo_timeout_us:
+                raise OSError('Out of range')
+            return width
+        if rise >= 0:
+            if time.ticks_diff(time.ticks_us(), rise) > self.echo_timeout_us:
+                raise OSError('Out of range')
+        elif time.ticks_diff(time.ticks_us(), self._pinged_at) > self.echo_timeout_us + self.ECHO_START_US:
+            raise OSError('Out of range')
+        return None
+
+    def _send_pulse_and_wait(self):
+        """
+        Send the pulse to trigger and listen on echo pin.
+        We use the method `machine.time_pulse_us()` to get the microseconds until the echo is received.
+        In IRQ mode the wait sleeps a millisecond at a time until the interrupt has both edges.
+        """
+        if self.use_irq:
+            self.ping()
+            while True:
+                pulse_time = self.pulse_us()
+                if pulse_time is not None:
+                    return pulse_time
+                time.sleep_ms(1)
+        self._wait_cycle()
+        self._trigger()
         try:
             pulse_time = machine.time_pulse_us(self.echo, 1, self.echo_timeout_us)
             return pulse_time
@@ -72,4 +152,50 @@ class HCSR04:
         # the sound speed on air (343.2 m/s), that It's equivalent to
         # 0.034320 cm/us that is 1cm each 29.1us
         cms = (pulse_time / 2) / 29.1
-        return cms
\ No newline at end of file
+        return cms
+
+    def burst_mm(self, count=5):
+        """
+        Median of count pings in millimetres, fired at the minimum re-trigger
+        interval, with outliers (more than MAD_LIMIT median absolute
+        deviations from the median) dropped first. Integer arithmetic only.
+        Returns None if fewer than half of the pings came back.
+        """
+        count = min(count, len(self._samples))
+        samples = self._samples
+        n = 0
+        for _ in range(count):
+            try:
+                pulse_time = self._send_pulse_and_wait()
+            except OSError:
+                continue
+            samples[n] = pulse_time * 100 // 582
+            n += 1
+        if n * 2 < count or n == 0:
+            return None
+        median = _median(samples, n)
+        deviations = self._deviations
+        for i in range(n):
+            deviations[i] = abs(samples[i] - median)
+        limit = max(_median(deviations, n), self.MIN_MAD_MM) * self.MAD_LIMIT
+        kept = 0
+        for i in range(n):
+            if abs(samples[i] - median) <= limit:
+                samples[kept] = samples[i]
+                kept += 1
+        return _median(samples, kept)
+
+
+def _median(values, n):
+    """Median of values[:n], sorting them in place (insertion sort: n is small)"""
+    for i in range(1, n):
+        v = values[i]
+        j = i - 1
+        while j >= 0 and values[j] > v:
+            values[j + 1] = values[j]
+            j -= 1
+        values[j + 1] = v
+    mid = n // 2
+    if n % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) // 2
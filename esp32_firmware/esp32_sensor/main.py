@@ -1,14 +1,26 @@
 import network
 import espnow
+import struct
 import time
-from machine import Pin, I2C
+from machine import Pin, I2C, RTC, lightsleep
 import sht4x
+from sht_bus import SHTBus
+import telemetry
+from aggregate import Window, STATE_SIZE as WINDOW_STATE_SIZE
 from hcsr04 import HCSR04
 
 # ========== Configuration ==========
 # Pins configuration
 SHT_SCL_PIN = 14
 SHT_SDA_PIN = 22
+# SHT4x buses as (I2C id, SCL pin, SDA pin). Every SHT4x found on them (at
+# 0x44/0x45, directly or behind a TCA9548A mux) is one zone, e.g. the hot
+# and the cool end of a large enclosure. Add (1, scl, sda) for a second bus.
+SHT_BUSES = ((0, SHT_SCL_PIN, SHT_SDA_PIN),)
+I2C_FREQ = 400000  # Fast mode
+# Weight of each zone, in discovery order, in the temperature/humidity the
+# controller acts on; None weighs them equally
+SHT_ZONE_WEIGHTS = None
 ULTRASONIC_TRIGGER_PIN = 32
 ULTRASONIC_ECHO_PIN = 33  # Changed to pin 33 to avoid conflict with SHT sensor
 
@@ -19,6 +31,46 @@ WIFI_CHANNEL = 1
 # Measurement interval (in seconds)
 MEASUREMENT_INTERVAL = 2
 
+# SHT4x repeatability: PRECISION_HIGH converts in 8.3 ms, MEDIUM in 4.5 ms,
+# LOW in 1.6 ms, each with more noise than the last
+SHT_PRECISION = sht4x.PRECISION_HIGH
+
+# Frame format sent to the controller: "binary" (telemetry.py frames) or
+# "text" (legacy human readable strings, kept during the migration window)
+FRAME_FORMAT = "binary"
+
+# Reporting mode: telemetry.MODE_RAW sends every reading, telemetry.MODE_AGGREGATE
+# samples at the rates below and sends one aggregate frame per window,
+# telemetry.MODE_DELTA samples like MODE_RAW but only sends a reading that
+# moved past a deadband (or after HEARTBEAT_S).
+# The controller can change all of these at runtime with a MSG_CONFIG frame.
+REPORT_MODE = telemetry.MODE_DELTA
+AGGREGATE_WINDOW_MS = 10000
+SHT_INTERVAL_MS = 1000       # 1 Hz
+DISTANCE_INTERVAL_MS = 100   # 10 Hz
+MAX_DISTANCE_SAMPLES = 255   # distance samples kept per window for the median (a
+                             # uniform sample of the window when it has more)
+# MODE_DELTA: change since the last frame sent that is worth a new one, and
+# the longest silence. The controller asks for every sample (fast reporting)
+# while a value is near one of its thresholds.
+TEMP_DEADBAND = 0.1       # C
+HUMID_DEADBAND = 0.5      # %RH
+DISTANCE_DEADBAND = 1.0   # cm
+HEARTBEAT_S = 60
+# Raw mode: pings per distance reading (60 ms apart), median/MAD filtered so
+# one stray echo cannot move the servo
+DISTANCE_BURST = 5
+
+# Battery operation: light-sleep with the radio off between samples instead
+# of listening for the controller. The sequence number and the aggregation
+# window live in RTC memory, and after each frame the node listens for
+# WAKE_LISTEN_MS for a config reply before going back to sleep. Waits
+# shorter than MIN_SLEEP_MS are not worth the radio restart and are slept
+# awake.
+LOW_POWER = False
+WAKE_LISTEN_MS = 50
+MIN_SLEEP_MS = 20
+
 # ========== Initialize WiFi and ESP-NOW ==========
 print("Initializing WiFi for ESP-NOW...")
 sta = network.WLAN(network.STA_IF)
@@ -42,6 +94,8 @@ mac_parts = RECEIVER_MAC.split(':')
 peer = bytes(int(mac_parts[i], 16) for i in range(len(mac_parts)))
 
 # Add the peer with comprehensive error handling
+# (peer_args remembers the form that worked, for re-arming after light sleep)
+peer_args = {}
 try:
     # Try different methods to add peer
     try:
@@ -49,10 +103,12 @@ try:
         print("Peer added successfully")
     except:
         try:
-            e.add_peer(peer, channel=WIFI_CHANNEL)
+            peer_args = {"channel": WIFI_CHANNEL}
+            e.add_peer(peer, **peer_args)
             print("Peer added with channel specification")
         except:
-            e.add_peer(peer, lmk=b'\0'*16, channel=WIFI_CHANNEL)
+            peer_args = {"lmk": b'\0'*16, "channel": WIFI_CHANNEL}
+            e.add_peer(peer, **peer_args)
             print("Peer added with extended parameters")
 except Exception as err:
     print(f"Failed to add peer: {err}")
@@ -61,23 +117,19 @@ except Exception as err:
 # ========== Initialize SHT Temperature/Humidity Sensor ==========
 print("Initializing SHT4x temperature/humidity sensor...")
 sht_sensor = None
-i2c = None
 
 # Initialize I2C
 try:
-    i2c = I2C(0, scl=Pin(SHT_SCL_PIN), sda=Pin(SHT_SDA_PIN), freq=10000)
+    # Fast mode: a 6 byte result takes ~0.15 ms instead of ~6 ms at 10 kHz
+    buses = [I2C(bus_id, scl=Pin(scl), sda=Pin(sda), freq=I2C_FREQ)
+             for bus_id, scl, sda in SHT_BUSES]
     
-    # Scan I2C bus
-    print("Scanning I2C bus...")
-    devices = i2c.scan()
-    if devices:
-        print(f"I2C devices found: {devices}")
-        print(f"In hex: {[hex(d) for d in devices]}")
-        
-        # Initialize SHT4x sensor
-        print("Initializing SHT4x sensor...")
-        sht_sensor = sht4x.SHT4x(i2c)
-        print("SHT4x sensor initialized")
+    # Find every SHT4x zone on the buses
+    print("Scanning I2C buses...")
+    sht_bus = SHTBus(buses, SHT_PRECISION, SHT_ZONE_WEIGHTS)
+    if sht_bus.count:
+        sht_sensor = sht_bus
+        print(f"SHT4x initialized: {sht_bus.count} zone(s)")
         
         # Test the sensor with a reading
         temperature, humidity = sht_sensor.measure()
@@ -93,7 +145,7 @@ try:
         else:
             print("SHT4x sensor returned None values during initialization")
     else:
-        print("No I2C devices found! Check connections and power.")
+        print("No SHT4x found! Check connections and power.")
 except Exception as e_sensor:
     error_msg = f"Failed to initialize SHT4x sensor: {e_sensor}"
     print(error_msg)
@@ -110,7 +162,8 @@ ultrasonic_sensor = None
 try:
     ultrasonic_sensor = HCSR04(trigger_pin=ULTRASONIC_TRIGGER_PIN, 
                             echo_pin=ULTRASONIC_ECHO_PIN, 
-                            echo_timeout_us=10000)
+                            echo_timeout_us=10000,
+                            use_irq=True)
     
     # Test the sensor with an initial reading
     distance = ultrasonic_sensor.distance_cm()
@@ -134,40 +187,334 @@ except Exception as e_ultrasonic:
 # Wait for everything to stabilize
 time.sleep(1)
 
+# ========== Functions ==========
+def send_message(message):
+    """Send a message to the controller, re-adding the peer after repeated failures.
+
+    Returns True if the controller acknowledged it.
+    """
+    global send_failure_count
+    send_result = False
+    try:
+        rearm_radio()
+        send_result = e.send(peer, message)
+        if send_result:
+            print("Message sent successfully")
+            send_failure_count = 0  # Reset failure counter on success
+        else:
+            print("Failed to send message (send returned False)")
+            send_failure_count += 1
+    except Exception as send_err:
+        print(f"Error sending message: {send_err}")
+        send_failure_count += 1
+        
+    # If too many consecutive failures, attempt to re-add the peer
+    if send_failure_count >= 3:
+        print("Multiple send failures. Attempting to re-add peer...")
+        try:
+            # Remove peer first if possible
+            try:
+                e.del_peer(peer)
+            except:
+                pass
+            
+            # Add peer again
+            e.add_peer(peer, channel=WIFI_CHANNEL)
+            print("Peer re-added")
+            send_failure_count = 0
+        except Exception as re_add_err:
+            print(f"Failed to re-add peer: {re_add_err}")
+    return bool(send_result)
+
+def apply_config(msg):
+    """Apply a MSG_CONFIG frame sent by the controller"""
+    global REPORT_MODE, MEASUREMENT_INTERVAL, AGGREGATE_WINDOW_MS, SHT_INTERVAL_MS, DISTANCE_INTERVAL_MS
+    global TEMP_DEADBAND, HUMID_DEADBAND, DISTANCE_DEADBAND, HEARTBEAT_S, fast_until
+    mode, window_ms, sht_interval_ms, distance_interval_ms = telemetry.decode_config(msg)
+    REPORT_MODE = mode
+    if mode != telemetry.MODE_AGGREGATE:
+        # In raw and delta mode the window is the measurement interval
+        if window_ms:
+            MEASUREMENT_INTERVAL = window_ms / 1000
+    else:
+        if window_ms:
+            AGGREGATE_WINDOW_MS = window_ms
+        if sht_interval_ms:
+            SHT_INTERVAL_MS = sht_interval_ms
+        if distance_interval_ms:
+            DISTANCE_INTERVAL_MS = distance_interval_ms
+    delta = telemetry.decode_delta_config(msg)
+    if delta is not None:
+        temp_deadband, humid_deadband, distance_deadband, heartbeat_s, fast_s = delta
+        if temp_deadband:
+            TEMP_DEADBAND = temp_deadband
+        if humid_deadband:
+            HUMID_DEADBAND = humid_deadband
+        if distance_deadband:
+            DISTANCE_DEADBAND = distance_deadband
+        if heartbeat_s:
+            HEARTBEAT_S = heartbeat_s
+        if fast_s:
+            fast_until = time.ticks_add(time.ticks_ms(), fast_s * 1000)
+            print(f"Fast reporting for {fast_s}s")
+    print(f"Config applied: mode {REPORT_MODE}, window {window_ms}ms, SHT every {SHT_INTERVAL_MS}ms, distance every {DISTANCE_INTERVAL_MS}ms")
+
+def moved(value, sent, deadband):
+    if value is None or sent is None:
+        return value is not sent
+    return abs(value - sent) >= deadband
+
+def worth_sending(temperature, humidity, distance, flags):
+    """Send-on-delta: does this reading differ enough from the last one sent?"""
+    global fast_until
+    if REPORT_MODE != telemetry.MODE_DELTA or last_sent_ms is None or flags != sent_flags:
+        return True
+    now = time.ticks_ms()
+    if fast_until is not None:
+        if time.ticks_diff(fast_until, now) > 0:
+            return True
+        fast_until = None
+    if time.ticks_diff(now, last_sent_ms) >= HEARTBEAT_S * 1000:
+        return True
+    return (moved(temperature, sent_temperature, TEMP_DEADBAND) or
+            moved(humidity, sent_humidity, HUMID_DEADBAND) or
+            moved(distance, sent_distance, DISTANCE_DEADBAND))
+
+def mark_sent(temperature, humidity, distance, flags):
+    global sent_temperature, sent_humidity, sent_distance, sent_flags, last_sent_ms
+    sent_temperature = temperature
+    sent_humidity = humidity
+    sent_distance = distance
+    sent_flags = flags
+    last_sent_ms = time.ticks_ms()
+
+def poll_controller(timeout_ms):
+    """Wait up to timeout_ms for controller messages.
+
+    Returns True as soon as a configuration frame has been applied.
+    """
+    deadline = time.ticks_add(time.ticks_ms(), timeout_ms)
+    while True:
+        remaining = time.ticks_diff(deadline, time.ticks_ms())
+        if remaining <= 0:
+            return False
+        try:
+            host, msg = e.irecv(remaining)
+        except Exception as recv_err:
+            print(f"ESP-NOW receive error: {recv_err}")
+            time.sleep_ms(remaining)
+            return False
+        if msg and telemetry.is_binary(msg) and msg[1] == telemetry.MSG_CONFIG:
+            apply_config(msg)
+            return True
+
+def radio_off():
+    """Shut ESP-NOW and the station interface down for light sleep"""
+    global radio_on
+    e.active(False)  # Forgets the peer too
+    sta.active(False)
+    radio_on = False
+
+def rearm_radio():
+    """Bring ESP-NOW back after light sleep, re-adding the peer the way startup managed to"""
+    global radio_on
+    if radio_on:
+        return
+    sta.active(True)
+    sta.config(channel=WIFI_CHANNEL)
+    e.active(True)
+    e.add_peer(peer, **peer_args)
+    radio_on = True
+
+def save_state():
+    """Keep the sequence number and aggregation window in RTC memory"""
+    struct.pack_into(RTC_HEADER_FORMAT, rtc_buf, 0, RTC_MAGIC, reading_count)
+    offset = RTC_HEADER_SIZE
+    for window in (temp_window, humid_window, dist_window):
+        window.save(rtc_buf, offset)
+        offset += WINDOW_STATE_SIZE
+    rtc.memory(rtc_buf)
+
+def restore_state():
+    """Pick up save_state()'s record after a reset; returns the sequence number"""
+    saved = rtc.memory()
+    if len(saved) != len(rtc_buf) or saved[0] != RTC_MAGIC:
+        return 0
+    seq = struct.unpack_from(RTC_HEADER_FORMAT, saved, 0)[1]
+    offset = RTC_HEADER_SIZE
+    for window in (temp_window, humid_window, dist_window):
+        window.restore(saved, offset)
+        offset += WINDOW_STATE_SIZE
+    print(f"Restored state from RTC memory: reading #{seq}, {dist_window.count} distance samples in window")
+    return seq
+
+def light_sleep(ms):
+    """Save state and light-sleep ms with the radio off"""
+    global woke_us
+    if radio_on:
+        radio_off()
+    save_state()
+    lightsleep(ms)
+    woke_us = time.ticks_us()
+
+def wait(ms):
+    """Pause between samples: light sleep in LOW_POWER mode, otherwise listen for config"""
+    if LOW_POWER and ms >= MIN_SLEEP_MS:
+        light_sleep(ms)
+    elif radio_on:
+        poll_controller(ms)
+    else:
+        time.sleep_ms(ms)
+
+def start_sht_sample():
+    """Start an SHT4x conversion; returns the ticks_ms its result is ready at, or None"""
+    if not sht_sensor:
+        return None
+    try:
+        return time.ticks_add(time.ticks_ms(), sht_sensor.start_measurement())
+    except Exception as temp_err:
+        print(f"Temperature sensor start error: {temp_err}")
+        return None
+
+def finish_sht_sample(ready_at):
+    """Result of the conversion started at ready_at (waiting out any remainder),
+    as (temperature, humidity), or (None, None) on failure"""
+    if ready_at is None:
+        return None, None
+    wait_ms = time.ticks_diff(ready_at, time.ticks_ms())
+    if wait_ms > 0:
+        time.sleep_ms(wait_ms)
+    try:
+        return sht_sensor.read_result()
+    except Exception as temp_err:
+        print(f"Temperature sensor read error: {temp_err}")
+        return None, None
+
+def read_distance_sample():
+    """One HC-SR04 sample in cm, or None if unavailable or out of range"""
+    if not ultrasonic_sensor:
+        return None
+    try:
+        distance = ultrasonic_sensor.distance_cm()
+    except Exception:
+        return None
+    if distance is not None and 2 <= distance <= 400:
+        return distance
+    return None
+
+def run_aggregate_window():
+    """Sample both sensors for one window and send a single aggregate frame"""
+    flags = 0
+    window_ms = AGGREGATE_WINDOW_MS
+    start = time.ticks_ms()
+    next_sht = start
+    next_dist = start
+    sht_ready_at = None  # conversion in progress
+    
+    while True:
+        now = time.ticks_ms()
+        if time.ticks_diff(now, start) >= window_ms:
+            break
+        
+        if sht_ready_at is not None and time.ticks_diff(now, sht_ready_at) >= 0:
+            temperature, humidity = finish_sht_sample(sht_ready_at)
+            sht_ready_at = None
+            if temperature is not None and humidity is not None:
+                temp_window.add(temperature)
+                humid_window.add(humidity)
+            else:
+                flags |= telemetry.FLAG_SHT_ERROR
+        
+        if time.ticks_diff(now, next_sht) >= 0:
+            next_sht = time.ticks_add(next_sht, SHT_INTERVAL_MS)
+            # The result is collected on a later pass, once it is ready
+            sht_ready_at = start_sht_sample()
+            if sht_ready_at is None:
+                flags |= telemetry.FLAG_SHT_ERROR
+        
+        if time.ticks_diff(now, next_dist) >= 0:
+            next_dist = time.ticks_add(next_dist, DISTANCE_INTERVAL_MS)
+            distance = read_distance_sample()
+            if distance is not None:
+                dist_window.add(distance)
+            else:
+                flags |= telemetry.FLAG_DIST_ERROR
+        
+        # Sleep (listening for config unless LOW_POWER) until the next sample is due
+        now = time.ticks_ms()
+        wait_ms = min(time.ticks_diff(next_sht, now),
+                      time.ticks_diff(next_dist, now),
+                      window_ms - time.ticks_diff(now, start))
+        if sht_ready_at is not None:
+            wait_ms = min(wait_ms, time.ticks_diff(sht_ready_at, now))
+        if wait_ms > 0:
+            wait(wait_ms)
+    
+    print(f"Window #{reading_count}: {temp_window.count} SHT samples, {dist_window.count} distance samples")
+    telemetry.encode_aggregate(aggregate_buf, reading_count, time.ticks_ms(), window_ms,
+                               temp_window, humid_window, dist_window, flags)
+    send_message(aggregate_buf)
+    # Reset after sending: a window restored from RTC memory carries on
+    temp_window.reset()
+    humid_window.reset()
+    dist_window.reset()
+
 # ========== Main Loop ==========
 print("Starting main loop to read and send data...")
-reading_count = 0
 send_failure_count = 0
+# Reading frame (a zones frame when there are several SHT4x zones) with its
+# sample latency trailer, plus a second trailer for the wake -> transmit
+# time when the node has been light-sleeping
+zone_count = sht_sensor.count if sht_sensor and sht_sensor.count > 1 else 0
+frame_size = telemetry.zones_size(zone_count) if zone_count else telemetry.READING_SIZE
+frame_buf = bytearray(frame_size + 2 * telemetry.LATENCY_SIZE)
+reading_frame = memoryview(frame_buf)[:frame_size + telemetry.LATENCY_SIZE]
+aggregate_buf = bytearray(telemetry.AGGREGATE_SIZE)
+temp_window = Window()
+humid_window = Window()
+dist_window = Window(MAX_DISTANCE_SAMPLES)
+# RTC memory record: magic, sequence number, then each window's state
+RTC_MAGIC = 0x5E
+RTC_HEADER_FORMAT = "<BI"
+RTC_HEADER_SIZE = struct.calcsize(RTC_HEADER_FORMAT)
+rtc = RTC()
+rtc_buf = bytearray(RTC_HEADER_SIZE + 3 * WINDOW_STATE_SIZE)
+reading_count = restore_state()
+radio_on = True
+woke_us = None  # ticks_us of the last wake from light sleep
+# Last reading sent, for MODE_DELTA
+sent_temperature = None
+sent_humidity = None
+sent_distance = None
+sent_flags = 0
+last_sent_ms = None
+fast_until = None  # ticks_ms the controller's fast reporting request runs out
 
 while True:
     try:
         reading_count += 1
+        if REPORT_MODE == telemetry.MODE_AGGREGATE:
+            run_aggregate_window()
+            continue
+        
         print(f"\nReading #{reading_count}...")
         
         # Read sensor values with validation
         message_parts = []
+        temperature = None
+        humidity = None
+        distance = None
+        flags = 0
         
-        # Read temperature and humidity
-        if sht_sensor:
-            try:
-                temperature, humidity = sht_sensor.measure()
-                if temperature is not None and humidity is not None:
-                    message_parts.append(f"Temp: {temperature:.1f}°C, Humidity: {humidity:.1f}%")
-                    print(f"Temperature: {temperature:.1f}°C, Humidity: {humidity:.1f}%")
-                else:
-                    print("SHT4x sensor returned None values")
-                    message_parts.append("Temp/Humidity: Sensor error")
-            except Exception as temp_err:
-                print(f"Temperature sensor read error: {temp_err}")
-                message_parts.append("Temp/Humidity: Read error")
-        else:
-            print("Temperature/humidity sensor not available")
-            message_parts.append("Temp/Humidity: No sensor")
+        # Start the temperature/humidity conversion
+        sample_us = time.ticks_us()
+        sht_ready_at = start_sht_sample()
         
-        # Read distance
+        # Read distance while the SHT4x converts
         if ultrasonic_sensor:
             try:
-                distance = ultrasonic_sensor.distance_cm()
+                distance_mm = ultrasonic_sensor.burst_mm(DISTANCE_BURST)
+                distance = distance_mm / 10 if distance_mm is not None else None
                 # Validate the distance reading (typical HC-SR04 range: 2-400cm)
                 if distance is not None and 2 <= distance <= 400:
                     message_parts.append(f"Distance: {distance:.1f}cm")
@@ -175,47 +522,65 @@ while True:
                 else:
                     print(f"Invalid distance reading: {distance}")
                     message_parts.append("Distance: Out of range")
+                    distance = None
+                    flags |= telemetry.FLAG_DIST_ERROR
             except Exception as dist_err:
                 print(f"Distance sensor read error: {dist_err}")
                 message_parts.append("Distance: Read error")
+                distance = None
+                flags |= telemetry.FLAG_DIST_ERROR
         else:
             print("Distance sensor not available")
             message_parts.append("Distance: No sensor")
+            flags |= telemetry.FLAG_DIST_ERROR
+        
+        # Collect temperature and humidity
+        if sht_sensor:
+            temperature, humidity = finish_sht_sample(sht_ready_at)
+            if temperature is not None and humidity is not None:
+                message_parts.insert(0, f"Temp: {temperature:.1f}°C, Humidity: {humidity:.1f}%")
+                print(f"Temperature: {temperature:.1f}°C, Humidity: {humidity:.1f}%")
+            else:
+                message_parts.insert(0, "Temp/Humidity: Read error")
+                flags |= telemetry.FLAG_SHT_ERROR
+        else:
+            print("Temperature/humidity sensor not available")
+            message_parts.insert(0, "Temp/Humidity: No sensor")
+            flags |= telemetry.FLAG_SHT_ERROR
         
         # Combine all parts into a single message
-        if message_parts:
-            message = " | ".join(message_parts)
-            print(f"Sending: {message}")
+        if not worth_sending(temperature, humidity, distance, flags):
+            print("Reading within deadbands - not sent")
+        elif message_parts:
+            if FRAME_FORMAT == "text":
+                message = " | ".join(message_parts)
+                print(f"Sending: {message}")
+            else:
+                if zone_count:
+                    telemetry.encode_zones(frame_buf, reading_count, time.ticks_ms(),
+                                           temperature, humidity, distance, flags,
+                                           sht_sensor.temperatures, sht_sensor.humidities,
+                                           sht_sensor.valid)
+                else:
+                    telemetry.encode_reading(frame_buf, reading_count, time.ticks_ms(),
+                                             temperature, humidity, distance, flags)
+                print(f"Sending binary frame #{reading_count}")
+                message = reading_frame
+                if woke_us is not None:
+                    # Radio up before the clock is read, so the restart is counted
+                    rearm_radio()
+                    wake_us = time.ticks_diff(time.ticks_us(), woke_us)
+                    telemetry.encode_latency(frame_buf, frame_size + telemetry.LATENCY_SIZE, wake_us)
+                    message = frame_buf
+                    print(f"Wake to transmit: {wake_us}us")
+                # Sample age at send time, for the controller's latency histograms
+                telemetry.encode_latency(frame_buf, frame_size,
+                                         time.ticks_diff(time.ticks_us(), sample_us))
             
             # Send the data via ESP-NOW
-            try:
-                send_result = e.send(peer, message)
-                if send_result:
-                    print("Message sent successfully")
-                    send_failure_count = 0  # Reset failure counter on success
-                else:
-                    print("Failed to send message (send returned False)")
-                    send_failure_count += 1
-            except Exception as send_err:
-                print(f"Error sending message: {send_err}")
-                send_failure_count += 1
-                
-            # If too many consecutive failures, attempt to re-add the peer
-            if send_failure_count >= 3:
-                print("Multiple send failures. Attempting to re-add peer...")
-                try:
-                    # Remove peer first if possible
-                    try:
-                        e.del_peer(peer)
-                    except:
-                        pass
-                    
-                    # Add peer again
-                    e.add_peer(peer, channel=WIFI_CHANNEL)
-                    print("Peer re-added")
-                    send_failure_count = 0
-                except Exception as re_add_err:
-                    print(f"Failed to re-add peer: {re_add_err}")
+            # An unacknowledged frame is not a baseline: the next sample retries
+            if send_message(message):
+                mark_sent(temperature, humidity, distance, flags)
         else:
             print("No sensor data available to send")
                 
@@ -227,6 +592,11 @@ while True:
         except:
             print("Failed to send error message")
     
-    # Wait between readings
+    # Wait between readings, picking up any config from the controller
     print(f"Waiting {MEASUREMENT_INTERVAL} seconds before next reading...")
-    time.sleep(MEASUREMENT_INTERVAL)
\ No newline at end of file
+    if LOW_POWER:
+        if radio_on:
+            poll_controller(WAKE_LISTEN_MS)
+        light_sleep(int(MEASUREMENT_INTERVAL * 1000))
+    else:
+        poll_controller(int(MEASUREMENT_INTERVAL * 1000))
\ No newline at end of file
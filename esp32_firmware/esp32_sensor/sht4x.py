@@ -1,26 +1,87 @@
 # sht4x.py
+# Sensirion SHT4x temperature/humidity sensor.
+#
+# Split-phase: start_measurement() sends the measure command and returns
+# how many ms the conversion takes; read_result() after that reads the six
+# result bytes into a preallocated buffer and checks both CRCs. The caller
+# can do other work (ping the HC-SR04) in between. measure() does both
+# with a sleep for callers that don't care.
 import time
 
+# Repeatability (noise) vs conversion time, datasheet table 4
+PRECISION_HIGH = 0
+PRECISION_MEDIUM = 1
+PRECISION_LOW = 2
+_COMMANDS = (b"\xFD", b"\xF6", b"\xE0")
+_CONVERSION_MS = (9, 5, 2)      # max 8.3 / 4.5 / 1.6 ms, rounded up
+_SOFT_RESET = b"\x94"
+
+
+def _crc_table():
+    # CRC-8, polynomial 0x31 (x^8 + x^5 + x^4 + 1), one byte at a time
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table[i] = crc
+    return bytes(table)
+
+
+_CRC8 = _crc_table()
+
+
+def crc8(data, start=0, end=None):
+    """SHT4x CRC (init 0xFF) over data[start:end]"""
+    crc = 0xFF
+    for i in range(start, len(data) if end is None else end):
+        crc = _CRC8[crc ^ data[i]]
+    return crc
+
+
 class SHT4x:
-    def __init__(self, i2c, addr=0x44):
+    def __init__(self, i2c, addr=0x44, precision=PRECISION_HIGH):
         self.i2c = i2c
         self.addr = addr
+        self.precision = precision
+        self._buf = bytearray(6)
         self.reset()
 
     def reset(self):
-        self.i2c.writeto(self.addr, b'\x94')
+        self.i2c.writeto(self.addr, _SOFT_RESET)
         time.sleep(0.001)
 
-    def measure(self):
-        # High precision measurement command
-        self.i2c.writeto(self.addr, b'\xFD')
-        time.sleep(0.01)
+    def start_measurement(self, precision=None):
+        """Start a conversion; returns the ms to wait before read_result()"""
+        if precision is None:
+            precision = self.precision
+        self.i2c.writeto(self.addr, _COMMANDS[precision])
+        return _CONVERSION_MS[precision]
 
-        raw = self.i2c.readfrom(self.addr, 6)
+    def read_result(self):
+        """(temperature C, humidity %RH) of the conversion started last.
+
+        Raises OSError if the sensor NACKs (conversion not finished) or a
+        CRC does not match.
+        """
+        raw = self._buf
+        self.i2c.readfrom_into(self.addr, raw)
+        if crc8(raw, 0, 2) != raw[2] or crc8(raw, 3, 5) != raw[5]:
+            raise OSError("SHT4x CRC mismatch")
         temp_raw = raw[0] << 8 | raw[1]
         hum_raw = raw[3] << 8 | raw[4]
 
-        temperature = -45 + (175 * (temp_raw / 65535))
-        humidity = 100 * (hum_raw / 65535)
+        temperature = -45 + 175 * temp_raw / 65535
+        # Datasheet 4.6: the formula runs past 0..100 %RH at the extremes
+        humidity = -6 + 125 * hum_raw / 65535
+        if humidity < 0:
+            humidity = 0.0
+        elif humidity > 100:
+            humidity = 100.0
 
         return temperature, humidity
+
+    def measure(self, precision=None):
+        """Blocking measurement: start, wait out the conversion, read"""
+        time.sleep_ms(self.start_measurement(precision))
+        return self.read_result()
@@ -0,0 +1,137 @@
+# sht_bus.py
+# Several SHT4x probes (zones) on one or more I2C buses, read as one sensor.
+#
+# The constructor finds every SHT4x at 0x44/0x45 on each bus, both on the
+# bus itself and behind TCA9548A muxes (0x70-0x77, eight channels each).
+# A probe on a mux channel cannot share its address with one wired straight
+# to the same bus: both would answer while the channel is open.
+#
+# SHTBus has the same split-phase interface as sht4x.SHT4x:
+# start_measurement() sends the measure command to every zone back to back,
+# so the conversions overlap and N probes cost about the time of one, and
+# read_result() collects every result in one pass. It returns the weighted
+# mean and leaves the per-zone values in temperatures/humidities/valid.
+import time
+from array import array
+
+import sht4x
+
+SHT_ADDRESSES = (0x44, 0x45)
+MUX_ADDRESSES = range(0x70, 0x78)
+MUX_CHANNELS = 8
+_MUX_SELECT = tuple(bytes((1 << channel,)) for channel in range(MUX_CHANNELS))
+_MUX_OFF = b"\x00"
+
+
+class SHTBus:
+    def __init__(self, buses, precision=sht4x.PRECISION_HIGH, weights=None):
+        """
+        buses: I2C objects to search
+        weights: one per zone in discovery order (bus, then the bus itself
+        before mux channels, then address) for the weighted mean; default
+        equal. A zero weight reports the zone without averaging it in.
+        """
+        self.precision = precision
+        self._buses = buses
+        self._routes = [None] * len(buses)   # (mux, channel) open on each bus
+        self.zones = []                      # (bus index, mux or None, channel, SHT4x)
+        for index in range(len(buses)):
+            self._discover(index)
+        count = len(self.zones)
+        self.count = count
+        if weights is not None and len(weights) != count:
+            print(f"SHT zone weights ignored: {len(weights)} given for {count} zones")
+            weights = None
+        self.weights = array('f', weights if weights is not None else [1] * count)
+        self.temperatures = array('f', [0] * count)
+        self.humidities = array('f', [0] * count)
+        self.valid = bytearray(count)
+
+    def _discover(self, index):
+        i2c = self._buses[index]
+        found = i2c.scan()
+        direct = [addr for addr in found if addr in SHT_ADDRESSES]
+        for addr in direct:
+            self._add(index, None, 0, addr)
+        for mux in found:
+            if mux not in MUX_ADDRESSES:
+                continue
+            for channel in range(MUX_CHANNELS):
+                self._select(index, mux, channel)
+                for addr in i2c.scan():
+                    if addr in SHT_ADDRESSES and addr not in direct:
+                        self._add(index, mux, channel, addr)
+            i2c.writeto(mux, _MUX_OFF)
+            self._routes[index] = None
+
+    def _add(self, index, mux, channel, addr):
+        sensor = sht4x.SHT4x(self._buses[index], addr, self.precision)
+        self.zones.append((index, mux, channel, sensor))
+        where = f"mux 0x{mux:02x} channel {channel}" if mux is not None else "bus"
+        print(f"SHT4x zone {len(self.zones) - 1}: I2C {index} {where} address 0x{addr:02x}")
+
+    def _select(self, index, mux, channel):
+        """Open the zone's mux channel (closing any other mux on the bus)"""
+        if mux is None:
+            return
+        route = self._routes[index]
+        if route is not None and route[0] == mux and route[1] == channel:
+            return
+        i2c = self._buses[index]
+        if route is not None and route[0] != mux:
+            i2c.writeto(route[0], _MUX_OFF)
+        i2c.writeto(mux, _MUX_SELECT[channel])
+        self._routes[index] = (mux, channel)
+
+    def start_measurement(self, precision=None):
+        """Start a conversion on every zone; returns the ms to wait before read_result().
+
+        Raises OSError if no zone took the command.
+        """
+        wait_ms = 0
+        started = 0
+        for i in range(self.count):
+            index, mux, channel, sensor = self.zones[i]
+            try:
+                self._select(index, mux, channel)
+                wait_ms = max(wait_ms, sensor.start_measurement(precision))
+                self.valid[i] = 1
+                started += 1
+            except OSError:
+                self.valid[i] = 0
+        if not started:
+            raise OSError("No SHT4x zone responded")
+        return wait_ms
+
+    def read_result(self):
+        """Weighted (temperature C, humidity %RH) over the zones that read.
+
+        Raises OSError if no zone with a weight read.
+        """
+        temp_sum = 0.0
+        humid_sum = 0.0
+        weight_sum = 0.0
+        for i in range(self.count):
+            if not self.valid[i]:
+                continue
+            index, mux, channel, sensor = self.zones[i]
+            try:
+                self._select(index, mux, channel)
+                temperature, humidity = sensor.read_result()
+            except OSError:
+                self.valid[i] = 0
+                continue
+            self.temperatures[i] = temperature
+            self.humidities[i] = humidity
+            weight = self.weights[i]
+            temp_sum += weight * temperature
+            humid_sum += weight * humidity
+            weight_sum += weight
+        if weight_sum <= 0:
+            raise OSError("No SHT4x zone read")
+        return temp_sum / weight_sum, humid_sum / weight_sum
+
+    def measure(self, precision=None):
+        """Blocking measurement of every zone: start, wait out the conversion, read"""
+        time.sleep_ms(self.start_measurement(precision))
+        return self.read_result()
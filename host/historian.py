@@ -0,0 +1,332 @@
+# historian.py
+# Columnar telemetry store with incrementally maintained rollups.
+#
+# Raw rows are appended to fixed-size NumPy chunks, one column per field.
+# Every append also folds the rows into 1 min / 15 min / 1 h rollups
+# (count, min, max, sum per field), so a range query over months of data
+# reads a few thousand precomputed buckets instead of millions of rows.
+# query() picks the coarsest rollup whose bucket is no wider than the
+# requested resolution, and falls back to the raw rows below one minute.
+#
+#     h = Historian()
+#     h.append("wiredin", ts, {"temperature": t, "humidity": rh, "distance": d}, actuators)
+#     h.query("wiredin", start, end, resolution=900)
+import os
+
+import numpy as np
+
+FIELDS = ("temperature", "humidity", "distance")
+ROLLUP_SECONDS = (60, 900, 3600)
+CHUNK_ROWS = 4096
+
+
+class Chunk:
+    """Fixed-capacity block of raw rows"""
+
+    def __init__(self, rows=CHUNK_ROWS):
+        self.ts = np.empty(rows, np.float64)
+        self.values = np.empty((len(FIELDS), rows), np.float32)
+        self.actuators = np.empty(rows, np.uint8)
+        self.size = 0
+        self.t_min = np.inf
+        self.t_max = -np.inf
+
+    def free(self):
+        return len(self.ts) - self.size
+
+    def extend(self, ts, values, actuators):
+        n = len(ts)
+        end = self.size + n
+        self.ts[self.size:end] = ts
+        self.values[:, self.size:end] = values
+        self.actuators[self.size:end] = actuators
+        self.size = end
+        self.t_min = min(self.t_min, ts.min())
+        self.t_max = max(self.t_max, ts.max())
+
+
+class Rollup:
+    """Per-bucket count/min/max/sum for every field, sorted by bucket start"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.size = 0
+        self._alloc(1024)
+
+    def _alloc(self, capacity):
+        fields = len(FIELDS)
+        self.buckets = np.empty(capacity, np.int64)
+        self.count = np.empty((fields, capacity), np.int32)
+        self.min = np.empty((fields, capacity), np.float32)
+        self.max = np.empty((fields, capacity), np.float32)
+        self.sum = np.empty((fields, capacity), np.float64)
+
+    def _columns(self):
+        return ("buckets", "count", "min", "max", "sum")
+
+    def _grow(self, needed):
+        capacity = len(self.buckets)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        old = [getattr(self, name) for name in self._columns()]
+        self._alloc(capacity)
+        for name, column in zip(self._columns(), old):
+            getattr(self, name)[..., :self.size] = column[..., :self.size]
+
+    def add_one(self, ts, values):
+        """Fold one row (values: per-field floats, NaN = missing) into the buckets"""
+        bucket = int(ts // self.seconds) * self.seconds
+        n = self.size
+        if n and bucket < self.buckets[n - 1]:
+            self.add(np.array([ts]), np.array(values, np.float32).reshape(-1, 1))
+            return
+        if not n or bucket != self.buckets[n - 1]:
+            self._grow(n + 1)
+            self.buckets[n] = bucket
+            self.count[:, n] = 0
+            self.min[:, n] = np.inf
+            self.max[:, n] = -np.inf
+            self.sum[:, n] = 0
+            self.size = n = n + 1
+        i = n - 1
+        for f, v in enumerate(values):
+            if v == v:  # not NaN
+                self.count[f, i] += 1
+                self.sum[f, i] += v
+                if v < self.min[f, i]:
+                    self.min[f, i] = v
+                if v > self.max[f, i]:
+                    self.max[f, i] = v
+
+    def add(self, ts, values):
+        """Fold rows (ts: (n,), values: (fields, n), NaN = missing) into the buckets"""
+        buckets = (ts // self.seconds).astype(np.int64) * self.seconds
+        uniq, inverse = np.unique(buckets, return_inverse=True)
+        k = len(uniq)
+        fields = len(FIELDS)
+        valid = ~np.isnan(values)
+        count = np.zeros((fields, k), np.int32)
+        low = np.full((fields, k), np.inf, np.float32)
+        high = np.full((fields, k), -np.inf, np.float32)
+        total = np.zeros((fields, k), np.float64)
+        for f in range(fields):
+            np.add.at(count[f], inverse, valid[f])
+            np.fmin.at(low[f], inverse, values[f])
+            np.fmax.at(high[f], inverse, values[f])
+            np.add.at(total[f], inverse, np.where(valid[f], values[f], 0))
+
+        n = self.size
+        pos = np.searchsorted(self.buckets[:n], uniq)
+        exists = pos < n
+        exists[exists] = self.buckets[pos[exists]] == uniq[exists]
+        if exists.any():
+            at = pos[exists]
+            self.count[:, at] += count[:, exists]
+            self.min[:, at] = np.fmin(self.min[:, at], low[:, exists])
+            self.max[:, at] = np.fmax(self.max[:, at], high[:, exists])
+            self.sum[:, at] += total[:, exists]
+        new = ~exists
+        m = int(new.sum())
+        if not m:
+            return
+        self._grow(n + m)
+        end = n + m
+        self.buckets[n:end] = uniq[new]
+        self.count[:, n:end] = count[:, new]
+        self.min[:, n:end] = low[:, new]
+        self.max[:, n:end] = high[:, new]
+        self.sum[:, n:end] = total[:, new]
+        self.size = end
+        if n and uniq[new][0] < self.buckets[n - 1]:
+            # Late data (e.g. an offline batch) opened an older bucket
+            order = np.argsort(self.buckets[:end], kind="stable")
+            for name in self._columns():
+                column = getattr(self, name)
+                column[..., :end] = column[..., :end][..., order]
+
+    def range(self, start, end):
+        """Index slice of the buckets that start in [start, end)"""
+        lo = np.searchsorted(self.buckets[:self.size], start, "left")
+        hi = np.searchsorted(self.buckets[:self.size], end, "left")
+        return slice(lo, hi)
+
+
+class TankHistory:
+    """Raw chunks and rollups for one tank"""
+
+    def __init__(self, rollup_seconds=ROLLUP_SECONDS, chunk_rows=CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self.chunks = []
+        self.rollups = [Rollup(s) for s in sorted(rollup_seconds)]
+
+    def append(self, ts, values, actuators):
+        """ts: (n,), values: (fields, n) float, actuators: (n,) uint8"""
+        ts = np.asarray(ts, np.float64)
+        values = np.asarray(values, np.float32)
+        actuators = np.asarray(actuators, np.uint8)
+        done = 0
+        while done < len(ts):
+            if not self.chunks or not self.chunks[-1].free():
+                self.chunks.append(Chunk(self.chunk_rows))
+            chunk = self.chunks[-1]
+            take = min(chunk.free(), len(ts) - done)
+            chunk.extend(ts[done:done + take], values[:, done:done + take],
+                         actuators[done:done + take])
+            done += take
+        for rollup in self.rollups:
+            rollup.add(ts, values)
+
+    def append_one(self, ts, values, actuators):
+        """Single-row append for live messages; values is a list of floats, NaN = missing"""
+        if not self.chunks or not self.chunks[-1].free():
+            self.chunks.append(Chunk(self.chunk_rows))
+        chunk = self.chunks[-1]
+        i = chunk.size
+        chunk.ts[i] = ts
+        chunk.values[:, i] = values
+        chunk.actuators[i] = actuators
+        chunk.size = i + 1
+        chunk.t_min = min(chunk.t_min, ts)
+        chunk.t_max = max(chunk.t_max, ts)
+        for rollup in self.rollups:
+            rollup.add_one(ts, values)
+
+    def raw(self, start, end, fields=FIELDS):
+        ts = []
+        cols = [[] for _ in fields]
+        actuators = []
+        index = [FIELDS.index(name) for name in fields]
+        for chunk in self.chunks:
+            if chunk.t_max < start or chunk.t_min >= end:
+                continue
+            n = chunk.size
+            mask = (chunk.ts[:n] >= start) & (chunk.ts[:n] < end)
+            ts.append(chunk.ts[:n][mask])
+            for out, f in zip(cols, index):
+                out.append(chunk.values[f, :n][mask])
+            actuators.append(chunk.actuators[:n][mask])
+        if not ts:
+            ts = [np.empty(0, np.float64)]
+            cols = [[np.empty(0, np.float32)] for _ in fields]
+            actuators = [np.empty(0, np.uint8)]
+        ts = np.concatenate(ts)
+        # Offline batches are appended after the live rows they precede
+        order = np.argsort(ts, kind="stable")
+        result = {"resolution": 0, "ts": ts[order],
+                  "actuators": np.concatenate(actuators)[order]}
+        for name, out in zip(fields, cols):
+            result[name] = np.concatenate(out)[order]
+        return result
+
+    def query(self, start, end, resolution=0, fields=FIELDS):
+        """Rows or rollup buckets in [start, end).
+
+        resolution is the widest acceptable bucket in seconds. The coarsest
+        rollup no wider than that is used; below the finest rollup the raw
+        rows are returned. Rollup results hold "ts" (bucket start), and for
+        every field a dict of "min", "max", "mean" and "count" arrays.
+        """
+        chosen = None
+        for rollup in self.rollups:
+            if rollup.seconds <= resolution:
+                chosen = rollup
+        if chosen is None:
+            return self.raw(start, end, fields)
+        sl = chosen.range(chosen.seconds * (start // chosen.seconds), end)
+        result = {"resolution": chosen.seconds, "ts": chosen.buckets[sl].copy()}
+        for name in fields:
+            f = FIELDS.index(name)
+            count = chosen.count[f, sl]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = chosen.sum[f, sl] / count
+            empty = count == 0
+            result[name] = {
+                "min": np.where(empty, np.nan, chosen.min[f, sl]),
+                "max": np.where(empty, np.nan, chosen.max[f, sl]),
+                "mean": mean,
+                "count": count.copy(),
+            }
+        return result
+
+    def to_arrays(self):
+        arrays = {}
+        if self.chunks:
+            arrays["ts"] = np.concatenate([c.ts[:c.size] for c in self.chunks])
+            arrays["values"] = np.concatenate([c.values[:, :c.size] for c in self.chunks], axis=1)
+            arrays["actuators"] = np.concatenate([c.actuators[:c.size] for c in self.chunks])
+        for rollup in self.rollups:
+            for name in rollup._columns():
+                arrays["r{}_{}".format(rollup.seconds, name)] = getattr(rollup, name)[..., :rollup.size]
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, rollup_seconds=ROLLUP_SECONDS, chunk_rows=CHUNK_ROWS):
+        tank = cls(rollup_seconds, chunk_rows)
+        if "ts" in arrays:
+            ts = arrays["ts"]
+            values = arrays["values"]
+            actuators = arrays["actuators"]
+            for i in range(0, len(ts), chunk_rows):
+                chunk = Chunk(chunk_rows)
+                chunk.extend(ts[i:i + chunk_rows], values[:, i:i + chunk_rows],
+                             actuators[i:i + chunk_rows])
+                tank.chunks.append(chunk)
+        for rollup in tank.rollups:
+            key = "r{}_buckets".format(rollup.seconds)
+            if key not in arrays:
+                continue
+            n = len(arrays[key])
+            rollup._grow(n)
+            for name in rollup._columns():
+                getattr(rollup, name)[..., :n] = arrays["r{}_{}".format(rollup.seconds, name)]
+            rollup.size = n
+        return tank
+
+
+class Historian:
+    """Histories for any number of tanks, keyed by tank name"""
+
+    def __init__(self, rollup_seconds=ROLLUP_SECONDS, chunk_rows=CHUNK_ROWS):
+        self.rollup_seconds = rollup_seconds
+        self.chunk_rows = chunk_rows
+        self.tanks = {}
+
+    def tank(self, name):
+        history = self.tanks.get(name)
+        if history is None:
+            history = self.tanks[name] = TankHistory(self.rollup_seconds, self.chunk_rows)
+        return history
+
+    def append(self, name, ts, values, actuators=0):
+        """Store one reading; values maps field name to a number or None"""
+        row = [values.get(field) for field in FIELDS]
+        self.tank(name).append_one(ts, [np.nan if v is None else float(v) for v in row], actuators)
+
+    def extend(self, name, ts, values, actuators):
+        """Store many readings at once; values is a (fields, n) array, NaN = missing"""
+        self.tank(name).append(ts, values, actuators)
+
+    def query(self, name, start, end, resolution=0, fields=FIELDS):
+        history = self.tanks.get(name)
+        if history is None:
+            raise KeyError(name)
+        return history.query(start, end, resolution, fields)
+
+    def save(self, directory):
+        """Write one .npz per tank"""
+        os.makedirs(directory, exist_ok=True)
+        for name, history in self.tanks.items():
+            path = os.path.join(directory, name + ".npz")
+            np.savez(path + ".tmp.npz", **history.to_arrays())
+            os.replace(path + ".tmp.npz", path)
+
+    def load(self, directory):
+        if not os.path.isdir(directory):
+            return
+        for filename in os.listdir(directory):
+            if filename.endswith(".npz") and not filename.endswith(".tmp.npz"):
+                with np.load(os.path.join(directory, filename)) as arrays:
+                    self.tanks[filename[:-4]] = TankHistory.from_arrays(
+                        dict(arrays), self.rollup_seconds, self.chunk_rows)
@@ -0,0 +1,220 @@
+# historian_service.py
+# Subscribes to the controllers' state topics and keeps their history.
+#
+#   python3 historian_service.py --broker localhost --data-dir ./history --http-port 8080
+#
+# Topics (one tank per <tank> segment):
+#   environment/<tank>/data         JSON state deltas/keyframes (state_codec)
+#   environment/<tank>/data/bin     the same in the compact struct layout (--compact)
+#   environment/<tank>/data/batch   readings logged while offline (store_forward)
+#
+# Query over HTTP:
+#   GET /query?tank=wiredin&start=<unix s>&end=<unix s>&resolution=<s>
+#   GET /tanks
+# Needs numpy and paho-mqtt.
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "esp32_firmware", "esp32_data"))
+sys.path.insert(0, os.path.join(HERE, "..", "esp32_firmware", "common"))
+import state_codec
+import store_forward
+
+from historian import FIELDS, Historian
+
+# MicroPython on the ESP32 counts seconds from 2000-01-01
+DEVICE_EPOCH_OFFSET = 946684800
+# Device clocks further off than this are replaced by the receive time
+MAX_CLOCK_SKEW = 300
+
+ACTUATOR_BITS = (("heat_lamp", store_forward.ACT_HEAT_LAMP),
+                 ("fan", store_forward.ACT_FAN),
+                 ("humidifier", store_forward.ACT_HUMIDIFIER),
+                 ("servo", store_forward.ACT_SERVO),
+                 ("take_over", store_forward.ACT_TAKE_OVER))
+
+
+class HistorianService:
+
+    def __init__(self, historian, compact=False):
+        self.historian = historian
+        self.compact = compact
+        self.lock = threading.Lock()
+        self.states = {}   # tank -> state rebuilt from deltas
+        self.skew = {}     # tank -> receive time minus device time
+
+    def topics(self):
+        state = "environment/+/data/bin" if self.compact else "environment/+/data"
+        return [(state, 1), ("environment/+/data/batch", 1)]
+
+    def on_message(self, topic, payload, now=None):
+        now = time.time() if now is None else now
+        parts = topic.split("/")
+        if len(parts) < 3 or parts[0] != "environment" or parts[2] != "data":
+            return
+        tank = parts[1]
+        kind = parts[3] if len(parts) > 3 else ""
+        with self.lock:
+            if kind == "batch":
+                self._on_batch(tank, payload)
+            elif kind == ("bin" if self.compact else ""):
+                encoding = state_codec.ENCODING_STRUCT if self.compact else state_codec.ENCODING_JSON
+                state = state_codec.decode_state(payload, self.states.setdefault(tank, {}), encoding)
+                self._on_state(tank, state, now)
+
+    def _device_time(self, tank, device_ts):
+        skew = self.skew.get(tank)
+        if skew is None:
+            return device_ts + DEVICE_EPOCH_OFFSET
+        return device_ts + skew
+
+    def _on_state(self, tank, state, now):
+        ts = state.get("timestamp")
+        if ts is None:
+            ts = now
+        else:
+            ts = ts + DEVICE_EPOCH_OFFSET
+            if abs(ts - now) > MAX_CLOCK_SKEW:
+                # Clock not synced; remember the offset for offline batches
+                self.skew[tank] = now - state["timestamp"]
+                ts = now
+            else:
+                self.skew.pop(tank, None)
+        actuators = 0
+        for name, bit in ACTUATOR_BITS:
+            if state.get(name):
+                actuators |= bit
+        self.historian.append(tank, ts, state, actuators)
+
+    def _on_batch(self, tank, payload):
+        rows = list(store_forward.decode_batch(payload))
+        if not rows:
+            return
+        ts = np.array([self._device_time(tank, row[0]) for row in rows], np.float64)
+        values = np.array([[np.nan if row[1 + f] is None else row[1 + f] for row in rows]
+                           for f in range(len(FIELDS))], np.float32)
+        actuators = np.array([row[4] for row in rows], np.uint8)
+        self.historian.extend(tank, ts, values, actuators)
+
+    def query(self, tank, start, end, resolution):
+        with self.lock:
+            return self.historian.query(tank, start, end, resolution)
+
+
+def to_json(result):
+    """Query result with NumPy arrays turned into lists (NaN -> null)"""
+    out = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            value = to_json(value)
+        elif isinstance(value, np.ndarray):
+            value = [None if isinstance(v, float) and math.isnan(v) else v for v in value.tolist()]
+        out[key] = value
+    return out
+
+
+def make_handler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            args = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == "/tanks":
+                with service.lock:
+                    self._reply(200, sorted(service.historian.tanks))
+                return
+            if url.path != "/query":
+                self._reply(404, {"error": "not found"})
+                return
+            try:
+                end = float(args.get("end", time.time()))
+                start = float(args.get("start", end - 86400))
+                result = service.query(args["tank"], start, end, float(args.get("resolution", 0)))
+            except KeyError as err:
+                self._reply(404, {"error": "unknown tank or missing argument {}".format(err)})
+                return
+            except ValueError as err:
+                self._reply(400, {"error": str(err)})
+                return
+            self._reply(200, to_json(result))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Terrarium telemetry historian")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--data-dir", default="history")
+    parser.add_argument("--save-interval", type=float, default=300, help="seconds between saves")
+    parser.add_argument("--http-port", type=int, default=0, help="serve /query on this port")
+    parser.add_argument("--compact", action="store_true", help="read the binary data/bin topic")
+    args = parser.parse_args()
+
+    historian = Historian()
+    historian.load(args.data_dir)
+    service = HistorianService(historian, args.compact)
+
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    else:
+        client = mqtt.Client()
+
+    def on_connect(client, userdata, *rest):
+        client.subscribe(service.topics())
+        print("Connected to {}:{}".format(args.broker, args.port))
+
+    def on_message(client, userdata, msg):
+        try:
+            service.on_message(msg.topic, msg.payload)
+        except Exception as err:
+            print("Bad message on {}: {}".format(msg.topic, err))
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(args.broker, args.port)
+    client.loop_start()
+
+    if args.http_port:
+        server = ThreadingHTTPServer(("", args.http_port), make_handler(service))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print("Serving queries on port {}".format(args.http_port))
+
+    try:
+        while True:
+            time.sleep(args.save_interval)
+            with service.lock:
+                historian.save(args.data_dir)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        with service.lock:
+            historian.save(args.data_dir)
+
+
+if __name__ == "__main__":
+    main()
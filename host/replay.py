@@ -0,0 +1,296 @@
+# replay.py
+# Replays recorded telemetry through the controller's control law, as NumPy
+# array operations, to compare threshold settings offline.
+#
+# The law is the one update_actuators() and handle_distance_reading() apply
+# on the controller (esp32_data/main.py), reading by reading:
+#   full reading       heat = T < temp_lower
+#                      fan = T > temp_upper or H > humid_upper
+#                      humid = H < humid_lower
+#                      servo = last distance < distance_threshold (100 before any)
+#   distance only      servo = D < distance_threshold, the rest hold
+#   take over          the recorded (manual) states stand; a distance-only
+#                      reading still drives the servo
+# Each actuator depends on its own thresholds only, so a sweep evaluates
+# every candidate value of those once per actuator and broadcasts the
+# results over the whole grid.
+#
+# Recorded data is open loop: the replay says what the relays would have
+# done with these readings, not how the climate would have responded.
+#
+#     rec = load_history("./history", "wiredin")
+#     result = sweep(rec, {"temp_lower": [18, 19, 20], "temp_upper": [24, 26]})
+#     mismatches = verify(rec, DEFAULT_THRESHOLDS)
+import csv
+import os
+import sys
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE = os.path.join(HERE, "..", "esp32_firmware")
+
+THRESHOLD_NAMES = ("temp_lower", "temp_upper", "humid_lower", "humid_upper", "distance_threshold")
+DEFAULT_THRESHOLDS = (20.0, 25.0, 35.0, 65.0, 8.0)
+DEVICES = ("heat", "fan", "humid", "servo")
+# store_forward.ACT_*: bit i is DEVICES[i], then take over
+TAKE_OVER_BIT = 0x10
+# What handle_sensor_reading() uses for the distance before the first one
+NO_DISTANCE = 100.0
+# A reading holds until the next one, but no longer than this (seconds)
+MAX_HOLD = 60.0
+
+
+def _last_defined(defined):
+    """Index of the latest True at or before each position, -1 if none yet"""
+    index = np.where(defined, np.arange(defined.shape[-1]), -1)
+    return np.maximum.accumulate(index, axis=-1)
+
+
+def _hold(values, defined, initial=False):
+    """values where defined, otherwise the last defined value (initial before any)"""
+    index = _last_defined(defined)
+    held = np.take(values, np.maximum(index, 0), axis=-1)
+    return np.where(index >= 0, held, initial)
+
+
+def _thresholds(values):
+    # Tank.thresholds is an array("f"): the controller compares against float32
+    return np.asarray(values, np.float32).astype(np.float64)
+
+
+class Recording:
+    """Readings in time order, as the controller's control task receives them.
+
+    temperature, humidity and distance are float arrays with NaN for
+    missing values; manual holds the recorded actuator bits, which count
+    where take_over is set.
+    """
+
+    def __init__(self, ts, temperature, humidity, distance, take_over=None, manual=None):
+        order = np.argsort(np.asarray(ts, np.float64), kind="stable")
+        self.ts = np.asarray(ts, np.float64)[order]
+        self.temperature = np.asarray(temperature, np.float64)[order]
+        self.humidity = np.asarray(humidity, np.float64)[order]
+        self.distance = np.asarray(distance, np.float64)[order]
+        n = len(self.ts)
+        self.take_over = (np.zeros(n, bool) if take_over is None
+                          else np.asarray(take_over, bool)[order])
+        self.manual = (np.zeros(n, np.uint8) if manual is None
+                       else np.asarray(manual, np.uint8)[order])
+        self.full = ~np.isnan(self.temperature) & ~np.isnan(self.humidity)
+        self.distance_only = ~self.full & ~np.isnan(self.distance)
+        has_distance = ~np.isnan(self.distance)
+        self.last_distance = _hold(np.where(has_distance, self.distance, NO_DISTANCE),
+                                   has_distance, NO_DISTANCE)
+        self.dt = np.minimum(np.diff(self.ts, append=self.ts[-1:] if n else self.ts), MAX_HOLD)
+        self.duration = self.dt.sum()
+
+    def __len__(self):
+        return len(self.ts)
+
+    def manual_state(self, device):
+        return (self.manual & (1 << DEVICES.index(device))) != 0
+
+
+def load_history(directory, tank):
+    """Recording of one tank from the historian's saved .npz files"""
+    from historian import Historian
+    historian = Historian()
+    historian.load(directory)
+    if tank not in historian.tanks:
+        raise KeyError("no history for tank {} in {}".format(tank, directory))
+    rows = historian.tanks[tank].raw(-np.inf, np.inf)
+    actuators = rows["actuators"]
+    return Recording(rows["ts"], rows["temperature"], rows["humidity"], rows["distance"],
+                     (actuators & TAKE_OVER_BIT) != 0, actuators & 0x0F)
+
+
+def load_csv(path):
+    """Recording from a CSV with ts,temperature,humidity,distance[,take_over,actuators]"""
+    columns = {"ts": [], "temperature": [], "humidity": [], "distance": [],
+               "take_over": [], "actuators": []}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            for name, values in columns.items():
+                value = (row.get(name) or "").strip()
+                if name in ("take_over", "actuators"):
+                    values.append(int(value) if value else 0)
+                else:
+                    values.append(float(value) if value else np.nan)
+    return Recording(columns["ts"], columns["temperature"], columns["humidity"],
+                     columns["distance"], columns["take_over"], columns["actuators"])
+
+
+def synthetic(days=1.0, interval=2.0, seed=0, thresholds=DEFAULT_THRESHOLDS):
+    """Random-walk readings that keep crossing thresholds, with gaps,
+    distance-only readings, values exactly on a threshold and take-over spells"""
+    rng = np.random.default_rng(seed)
+    n = int(days * 86400 / interval)
+    ts = np.arange(n) * interval + rng.uniform(0, interval / 4, n)
+    temp_lower, temp_upper, humid_lower, humid_upper, distance_threshold = thresholds
+    temperature = np.clip((temp_lower + temp_upper) / 2 + np.cumsum(rng.normal(0, 0.05, n)),
+                          temp_lower - 4, temp_upper + 4)
+    humidity = np.clip(50 + np.cumsum(rng.normal(0, 0.3, n)), humid_lower - 10, humid_upper + 10)
+    distance = np.where(rng.random(n) < 0.1, distance_threshold / 2, 30.0)
+    # Readings land on the thresholds themselves: the comparisons are strict
+    on_edge = rng.random(n) < 0.01
+    temperature[on_edge] = np.round(temperature[on_edge]).clip(temp_lower, temp_upper)
+    temperature = np.round(temperature, 2)
+    humidity = np.round(humidity, 2)
+    missing = rng.random(n) < 0.05
+    temperature[missing] = np.nan
+    humidity[missing] = np.nan
+    distance[rng.random(n) < 0.05] = np.nan
+    take_over = (np.sin(np.arange(n) / 900.0) > 0.9)
+    manual = rng.integers(0, 16, n).astype(np.uint8)
+    manual = _hold(manual, np.r_[True, np.diff(take_over.astype(np.int8)) > 0])
+    return Recording(ts, temperature, humidity, distance, take_over, manual)
+
+
+# ----- the control law, vectorized -----
+def heat(rec, temp_lower):
+    """(k, n) heat lamp states for k values of temp_lower"""
+    on = rec.temperature < _thresholds(temp_lower)[:, None]
+    return _decide(rec, on, "heat")
+
+
+def fan(rec, temp_upper, humid_upper):
+    """(k1, k2, n) fan states for every temp_upper x humid_upper pair"""
+    on = ((rec.temperature > _thresholds(temp_upper)[:, None, None]) |
+          (rec.humidity > _thresholds(humid_upper)[None, :, None]))
+    return _decide(rec, on, "fan")
+
+
+def humidifier(rec, humid_lower):
+    on = rec.humidity < _thresholds(humid_lower)[:, None]
+    return _decide(rec, on, "humid")
+
+
+def servo(rec, distance_threshold):
+    """(k, n) servo states (True = closed); full and distance-only readings both drive it"""
+    close = rec.last_distance < _thresholds(distance_threshold)[:, None]
+    manual = rec.take_over & ~rec.distance_only
+    decided = np.where(manual, rec.manual_state("servo"), close)
+    return _hold(decided, rec.full | rec.distance_only | rec.take_over)
+
+
+def _decide(rec, on, device):
+    decided = np.where(rec.take_over, rec.manual_state(device), on)
+    return _hold(decided, rec.full | rec.take_over)
+
+
+def decide(rec, thresholds=DEFAULT_THRESHOLDS):
+    """(n,) actuator bits (bit i = DEVICES[i]) after each reading, for one setting"""
+    temp_lower, temp_upper, humid_lower, humid_upper, distance_threshold = thresholds
+    states = (heat(rec, [temp_lower])[0], fan(rec, [temp_upper], [humid_upper])[0, 0],
+              humidifier(rec, [humid_lower])[0], servo(rec, [distance_threshold])[0])
+    bits = np.zeros(len(rec), np.uint8)
+    for i, state in enumerate(states):
+        bits |= state.astype(np.uint8) << i
+    return bits
+
+
+# ----- metrics -----
+def switches(states):
+    """Relay switches along the last axis, starting from off"""
+    first = states[..., :1].astype(np.int64)
+    return first[..., 0] + np.count_nonzero(states[..., 1:] != states[..., :-1], axis=-1)
+
+
+def duty(rec, states):
+    """Fraction of the recorded time each state is on"""
+    return (states * rec.dt).sum(axis=-1) / (rec.duration or 1)
+
+
+def out_of_band(rec, values, lower, upper):
+    """(k1, k2) fraction of the time with a full reading outside [lower, upper]"""
+    outside = ((values < _thresholds(lower)[:, None, None]) |
+               (values > _thresholds(upper)[None, :, None]))
+    weight = rec.dt * rec.full
+    return (outside * weight).sum(axis=-1) / (weight.sum() or 1)
+
+
+def sweep(rec, grid):
+    """Evaluate every combination of the threshold values in grid.
+
+    grid maps THRESHOLD_NAMES to lists of values; missing names keep their
+    DEFAULT_THRESHOLDS value. Returns a dict of flat arrays, one entry per
+    combination: the five thresholds, <device>_switches, <device>_duty,
+    temp_out_of_band and humid_out_of_band.
+    """
+    axes = [np.atleast_1d(np.asarray(grid.get(name, [default]), np.float64))
+            for name, default in zip(THRESHOLD_NAMES, DEFAULT_THRESHOLDS)]
+    temp_lower, temp_upper, humid_lower, humid_upper, distance_threshold = axes
+    shape = tuple(len(axis) for axis in axes)
+
+    def spread(values, dims):
+        # Place per-threshold results on their axes of the 5-D grid
+        index = [None] * len(shape)
+        for dim in dims:
+            index[dim] = slice(None)
+        return np.broadcast_to(values[tuple(index)], shape).ravel()
+
+    result = {}
+    for dim, (name, axis) in enumerate(zip(THRESHOLD_NAMES, axes)):
+        result[name] = spread(axis, (dim,))
+    per_device = (("heat", heat(rec, temp_lower), (0,)),
+                  ("fan", fan(rec, temp_upper, humid_upper), (1, 3)),
+                  ("humid", humidifier(rec, humid_lower), (2,)),
+                  ("servo", servo(rec, distance_threshold), (4,)))
+    for device, states, dims in per_device:
+        result[device + "_switches"] = spread(switches(states), dims)
+        result[device + "_duty"] = spread(duty(rec, states), dims)
+    result["temp_out_of_band"] = spread(out_of_band(rec, rec.temperature, temp_lower, temp_upper), (0, 1))
+    result["humid_out_of_band"] = spread(out_of_band(rec, rec.humidity, humid_lower, humid_upper), (2, 3))
+    result["switches"] = sum(result[device + "_switches"] for device in DEVICES)
+    return result
+
+
+# ----- the firmware's own implementation, for verification -----
+def firmware_decisions(rec, thresholds=DEFAULT_THRESHOLDS):
+    """(n,) actuator bits from the controller's update_actuators(), run reading by reading"""
+    sys.path.insert(0, os.path.join(FIRMWARE, "esp32_data"))
+    sys.path.insert(0, os.path.join(FIRMWARE, "bench"))
+    sys.path.insert(0, os.path.join(FIRMWARE, "common"))
+    import firmware
+    import log
+    import tanks
+
+    def sink(*args, **kwargs):
+        pass
+    env = firmware.load("esp32_data", ("set_actuator", "update_actuators",
+                                       "handle_sensor_reading", "handle_distance_reading"), {
+        "tanks": tanks, "log": log, "send_command": sink, "publish_data": sink,
+        "publish_interval": 5, "request_fast_reporting": sink,
+    })
+    log.configure(log.OFF, log.OFF)
+    handle_sensor_reading = env["handle_sensor_reading"]
+    handle_distance_reading = env["handle_distance_reading"]
+    tank = tanks.Tank("replay", None, b"\0" * 6, thresholds)
+
+    def value(x):
+        return None if x != x else float(x)
+    bits = np.zeros(len(rec), np.uint8)
+    for i in range(len(rec)):
+        tank.take_over = bool(rec.take_over[i])
+        if tank.take_over:
+            # Manual control from the app, applied before this reading arrives
+            for index in range(len(DEVICES)):
+                tank.actuators[index] = (int(rec.manual[i]) >> index) & 1
+        if rec.full[i]:
+            handle_sensor_reading(tank, value(rec.temperature[i]), value(rec.humidity[i]),
+                                  value(rec.distance[i]), rec.ts[i])
+        elif rec.distance_only[i]:
+            handle_distance_reading(tank, value(rec.distance[i]), rec.ts[i])
+        state = 0
+        for index in range(len(DEVICES)):
+            if tank.actuators[index]:
+                state |= 1 << index
+        bits[i] = state
+    return bits
+
+
+def verify(rec, thresholds=DEFAULT_THRESHOLDS):
+    """Indices where the vectorized and on-device decisions differ (empty if none)"""
+    return np.flatnonzero(decide(rec, thresholds) != firmware_decisions(rec, thresholds))
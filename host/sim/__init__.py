@@ -0,0 +1,4 @@
+# Host-side simulator: the firmware of all three nodes on a virtual clock.
+# See simulation.py for the entry point and ../simulate.py for the CLI.
+from .kernel import Kernel, SimulationError
+from .simulation import Simulation, format_report
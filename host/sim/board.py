@@ -0,0 +1,561 @@
+# board.py
+# One simulated ESP32: its firmware thread, RAM (module namespace) and flash.
+#
+# The board's main.py and everything it imports from the board's source
+# directories are executed in a private module table whose __import__
+# hands out this board's fake MicroPython modules (time, machine, network,
+# espnow, aioespnow, uasyncio, os, gc, ...), so three boards can run the
+# unmodified firmware side by side in one process. Absolute file paths are
+# mapped into a per-board flash directory that survives resets.
+import asyncio
+import builtins
+import collections
+import importlib
+import json
+import math
+import os
+import selectors
+import shutil
+import tempfile
+import threading
+import time as host_time
+import traceback
+import types
+
+from .kernel import Halt
+
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD >> 1
+
+# MicroPython counts seconds from 2000-01-01
+DEVICE_EPOCH_OFFSET = 946684800
+
+# A board that reads the clock this many times without waiting is busy
+# polling; its clock then moves on by a millisecond so the loop progresses
+SPIN_READS = 200
+
+# Modules every board gets from the host interpreter as they are
+HOST_MODULES = ("array", "binascii", "collections", "errno", "math", "random",
+                "re", "struct", "sys", "io", "select")
+
+# MicroPython's u-prefixed aliases
+ALIASES = {"ubinascii": "binascii", "ucollections": "collections", "uerrno": "errno",
+           "uio": "io", "ure": "re", "ustruct": "struct", "urandom": "random",
+           "uselect": "select", "utime": "time", "uos": "os", "ujson": "json",
+           "usocket": "socket", "asyncio": "uasyncio"}
+
+
+class Reset(BaseException):
+    """machine.reset() and friends: reboot the board, keeping its flash"""
+
+    def __init__(self, cause):
+        BaseException.__init__(self, cause)
+        self.cause = cause
+
+
+class Board:
+
+    def __init__(self, sim, name, mac, paths, boot_at_us=0, wifi_connected=False,
+                 boot_us=300000, rtc_base=0, ticks_offset_ms=0):
+        self.sim = sim
+        self.kernel = sim.kernel
+        self.name = name
+        self.mac = bytes(mac)
+        self.paths = list(paths)
+        self.boot_us = boot_us
+        self.rtc_base = rtc_base          # device seconds at kernel time 0
+        self.ticks_offset_ms = ticks_offset_ms
+        self.flash_dir = tempfile.mkdtemp(prefix="sim-" + name + "-")
+        self.console = collections.deque(maxlen=200)
+        self.log_file = None
+        self.resets = 0
+        self.reset_cause = 1              # machine.PWRON_RESET
+        self.rtc_memory = b""
+        self.error = None
+        self.alive = True
+        self.wake_us = None
+        self.devices = {}                 # set by the hardware models: i2c buses, pins
+        self.wifi_connected = wifi_connected
+        self.wlan_active = wifi_connected
+        self.wifi_channel = 1
+        self.ip = "0.0.0.0"
+        # gc.mem_free()/mem_alloc() report these; CPython cannot measure the
+        # board's MicroPython heap. heap_live is what survives a collection;
+        # alloc_per_rx is charged for every ESP-NOW frame the firmware takes
+        # from the radio (its receive path's churn, 0: a static heap). A
+        # collection frees back to heap_live, and gc.collect() holds the
+        # board for gc_pause_us.
+        self.heap_bytes = 113 * 1024
+        self.heap_live = 40 * 1024
+        self.heap_used = self.heap_live
+        self.alloc_per_rx = 0
+        self.gc_pause_us = 0
+        self.gc_threshold = -1
+        self.gc_collections = 0
+        self.module_factories = {}        # name -> fn(board) for extra fake modules
+        self._go = threading.Lock()
+        self._go.acquire()
+        self._interruptible = False
+        self._posted = []
+        self._spin = 0
+        self.modules = {}
+        self.fakes = {}
+        self.kernel.boards.append(self)
+        self._thread = threading.Thread(target=self._run, name="sim-" + name, daemon=True)
+        self._thread.start()
+        self.wake_us = boot_at_us
+
+    # ----- scheduling (called from the board's own thread) -----
+    def _yield(self):
+        kernel = self.kernel
+        if kernel.halted:
+            raise Halt()
+        self._spin = 0
+        kernel._back.release()
+        self._go.acquire()
+        if kernel.halted:
+            raise Halt()
+
+    def wait(self, until_us=None, interruptible=False):
+        """Block until until_us (None: forever); an interruptible wait also
+        ends at notify(). Posted callbacks run in this thread on the way."""
+        while True:
+            if not self._posted:
+                self.wake_us = until_us
+                self._interruptible = interruptible
+                self._yield()
+                self._interruptible = False
+            if self._posted:
+                self._run_posted()
+                if interruptible:
+                    return
+            if interruptible or (until_us is not None and self.kernel.now_us >= until_us):
+                return
+
+    def sleep_us(self, us):
+        if us > 0:
+            self.wait(self.kernel.now_us + int(us))
+
+    def allocate(self, n):
+        """Firmware allocated n bytes; the VM collects as MicroPython's would
+        (heap full, or gc.threshold() passed since the last collection)"""
+        self.heap_used += n
+        if (self.heap_used > self.heap_bytes or
+                (self.gc_threshold >= 0 and self.heap_used - self.heap_live >= self.gc_threshold)):
+            self.collect()
+
+    def collect(self):
+        self.heap_used = self.heap_live
+        self.gc_collections += 1
+
+    def tick(self):
+        """Count a clock read; see SPIN_READS"""
+        self._spin += 1
+        if self._spin >= SPIN_READS:
+            self.sleep_us(1000)
+
+    def _run_posted(self):
+        posted, self._posted = self._posted, []
+        for fn in posted:
+            fn()
+
+    # ----- called from the kernel side -----
+    def notify(self):
+        """Something arrived: end an interruptible wait now"""
+        if self._interruptible:
+            self.wake_us = self.kernel.now_us
+
+    def post(self, fn):
+        """Run fn in the board's thread as soon as it is waiting (an IRQ, a stream write)"""
+        self._posted.append(fn)
+        if self.alive:
+            self.wake_us = self.kernel.now_us
+
+    # ----- time -----
+    def ticks_ms(self):
+        self.tick()
+        return (self.kernel.now_us // 1000 + self.ticks_offset_ms) & TICKS_MAX
+
+    def ticks_us(self):
+        self.tick()
+        return (self.kernel.now_us + self.ticks_offset_ms * 1000) & TICKS_MAX
+
+    def device_time(self):
+        return self.rtc_base + self.kernel.now_us / 1000000
+
+    # ----- firmware -----
+    def _run(self):
+        self._go.acquire()
+        try:
+            while True:
+                self.sleep_us(self.boot_us)
+                try:
+                    self._boot()
+                    return
+                except Reset as reset:
+                    self.resets += 1
+                    self.reset_cause = reset.cause
+                    self.write_console("*** reset (cause {}) ***".format(reset.cause))
+        except Halt:
+            pass
+        except BaseException:
+            self.error = traceback.format_exc()
+            self.write_console(self.error)
+        finally:
+            self.alive = False
+            self.wake_us = None
+            self.kernel._back.release()
+
+    def _boot(self):
+        """Fresh RAM: new module table, new fakes, then run main.py"""
+        self.modules = {}
+        self.fakes = {}
+        self._posted = []
+        self.builtins = dict(vars(builtins))
+        self.builtins["__import__"] = self._import
+        self.builtins["open"] = self._open
+        self.builtins["print"] = self._print
+        self.on_boot()
+        self._exec_file("__main__", self._find("main")[0], None)
+
+    def on_boot(self):
+        """Hook for the hardware models to reset their per-boot state"""
+        for hook in self.devices.get("boot_hooks", ()):
+            hook()
+
+    _code_cache = {}
+
+    def _exec_file(self, name, path, package_dir):
+        module = types.ModuleType(name)
+        module.__file__ = path
+        module.__builtins__ = self.builtins
+        if package_dir is not None:
+            module.__path__ = [package_dir]
+            module.__package__ = name
+        else:
+            module.__package__ = name.rpartition(".")[0]
+        self.modules[name] = module
+        if path is None:
+            return module
+        code = self._code_cache.get(path)
+        if code is None:
+            with open(path) as f:
+                code = compile(f.read(), path, "exec")
+            self._code_cache[path] = code
+        try:
+            exec(code, module.__dict__)
+        except BaseException:
+            self.modules.pop(name, None)
+            raise
+        return module
+
+    def _find(self, name, search=None):
+        """(file, package dir or None) of a firmware module, or None"""
+        for directory in search if search is not None else self.paths:
+            package_dir = os.path.join(directory, name)
+            if os.path.isfile(os.path.join(package_dir, "__init__.py")):
+                return os.path.join(package_dir, "__init__.py"), package_dir
+            path = os.path.join(directory, name + ".py")
+            if os.path.isfile(path):
+                return path, None
+            if os.path.isdir(package_dir):
+                return None, package_dir   # MicroPython packages need no __init__.py
+        return None
+
+    def _load(self, name):
+        module = self.modules.get(name)
+        if module is not None:
+            return module
+        name = ALIASES.get(name, name)
+        module = self.fakes.get(name)
+        if module is not None:
+            return module
+        factory = self.module_factories.get(name) or FACTORIES.get(name)
+        if factory is not None:
+            module = self.fakes[name] = factory(self)
+            return module
+        parent, _, child = name.rpartition(".")
+        if parent:
+            parent_module = self._load(parent)
+            found = self._find(child, getattr(parent_module, "__path__", ()))
+        else:
+            parent_module = None
+            found = self._find(name)
+        if found is not None:
+            module = self._exec_file(name, found[0], found[1])
+            if parent_module is not None:
+                setattr(parent_module, child, module)
+            return module
+        if name.partition(".")[0] in HOST_MODULES or name in HOST_MODULES:
+            return importlib.import_module(name)
+        raise ImportError("no module named '{}'".format(name))
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level:
+            package = globals.get("__package__") or ""
+            for _ in range(level - 1):
+                package = package.rpartition(".")[0]
+            name = package + "." + name if name else package
+        module = self._load(name)
+        if fromlist:
+            for item in fromlist:
+                if not hasattr(module, item) and hasattr(module, "__path__"):
+                    self._load(name + "." + item)
+            return module
+        return self._load(name.partition(".")[0]) if "." in name else module
+
+    def flash_path(self, path):
+        path = os.path.normpath("/" + str(path)).lstrip("/")
+        return os.path.join(self.flash_dir, path)
+
+    def _open(self, file, mode="r", *args, **kwargs):
+        return open(self.flash_path(file), mode, *args, **kwargs)
+
+    def _print(self, *args, sep=" ", end="\n", file=None):
+        if file is not None:
+            print(*args, sep=sep, end=end, file=file)
+            return
+        self.write_console(sep.join(str(arg) for arg in args) + ("" if end == "\n" else end))
+
+    def write_console(self, text):
+        t = self.kernel.now_us / 1000000
+        line = "[{:02d}:{:02d}:{:06.3f} {}] {}".format(int(t // 3600), int(t // 60 % 60), t % 60,
+                                                      self.name, text)
+        self.console.append(line)
+        if self.log_file is not None:
+            self.log_file.write(line + "\n")
+        if self.sim.verbose:
+            print(line)
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file, log_file = None, self.log_file
+            log_file.close()
+        shutil.rmtree(self.flash_dir, ignore_errors=True)
+
+
+# ===== fake modules =====
+def make_time(board):
+    m = types.ModuleType("time")
+
+    def ticks_add(ticks, delta):
+        return (ticks + delta) & TICKS_MAX
+
+    def ticks_diff(end, start):
+        return ((end - start + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+    def gmtime(secs=None):
+        if secs is None:
+            secs = board.device_time()
+        tm = host_time.gmtime(int(secs) + DEVICE_EPOCH_OFFSET)
+        return (tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec,
+                tm.tm_wday, tm.tm_yday)
+
+    def mktime(t):
+        return int(host_time.mktime(tuple(t[:6]) + (0, 0, 0)) - host_time.timezone) - DEVICE_EPOCH_OFFSET
+
+    m.ticks_ms = board.ticks_ms
+    m.ticks_us = board.ticks_us
+    m.ticks_cpu = board.ticks_us
+    m.ticks_add = ticks_add
+    m.ticks_diff = ticks_diff
+    m.time = lambda: int(board.device_time())
+    m.time_ns = lambda: int(board.device_time() * 1000000000)
+    m.sleep = lambda seconds: board.sleep_us(int(seconds * 1000000))
+    m.sleep_ms = lambda ms: board.sleep_us(int(ms) * 1000)
+    m.sleep_us = board.sleep_us
+    m.gmtime = gmtime
+    m.localtime = gmtime
+    m.mktime = mktime
+    return m
+
+
+def make_os(board):
+    m = types.ModuleType("os")
+
+    def stat(path):
+        st = os.stat(board.flash_path(path))
+        return (st.st_mode, 0, 0, 0, 0, 0, st.st_size, int(st.st_atime), int(st.st_mtime),
+                int(st.st_ctime))
+
+    def statvfs(path):
+        used = sum(os.path.getsize(os.path.join(d, f))
+                   for d, _, files in os.walk(board.flash_dir) for f in files)
+        blocks = board.sim.flash_bytes // 4096
+        free = max(blocks - (used + 4095) // 4096, 0)
+        return (4096, 4096, blocks, free, free, 0, 0, 0, 0, 255)
+
+    m.sep = "/"
+    m.mkdir = lambda path: os.mkdir(board.flash_path(path))
+    m.rmdir = lambda path: os.rmdir(board.flash_path(path))
+    m.remove = lambda path: os.remove(board.flash_path(path))
+    m.rename = lambda old, new: os.rename(board.flash_path(old), board.flash_path(new))
+    m.listdir = lambda path="/": sorted(os.listdir(board.flash_path(path)))
+    m.ilistdir = lambda path="/": iter([(name, 0x4000 if os.path.isdir(os.path.join(board.flash_path(path), name))
+                                         else 0x8000, 0) for name in sorted(os.listdir(board.flash_path(path)))])
+    m.stat = stat
+    m.statvfs = statvfs
+    m.getcwd = lambda: "/"
+    m.sync = lambda: None
+    m.urandom = lambda n: bytes(board.kernel.random.getrandbits(8) for _ in range(n))
+    m.uname = lambda: ("esp32", board.name, "1.23.0", "v1.23.0 (simulated)", "ESP32 module with ESP32")
+    return m
+
+
+def make_gc(board):
+    m = types.ModuleType("gc")
+    state = {"enabled": True}
+
+    def collect():
+        board.collect()
+        board.sleep_us(board.gc_pause_us)
+    m.collect = collect
+    m.enable = lambda: state.update(enabled=True)
+    m.disable = lambda: state.update(enabled=False)
+    m.isenabled = lambda: state["enabled"]
+    m.mem_free = lambda: board.heap_bytes - board.heap_used
+    m.mem_alloc = lambda: board.heap_used
+
+    def threshold(amount=None):
+        if amount is None:
+            return board.gc_threshold
+        board.gc_threshold = amount
+    m.threshold = threshold
+    return m
+
+
+def make_micropython(board):
+    m = types.ModuleType("micropython")
+    m.const = lambda value: value
+    m.native = m.viper = lambda fn: fn
+    m.opt_level = lambda level=None: 0
+    m.alloc_emergency_exception_buf = lambda size: None
+    m.mem_info = m.qstr_info = lambda *args: None
+    m.stack_use = lambda: 0
+    m.heap_lock = m.heap_unlock = lambda: 0
+    m.schedule = lambda fn, arg: board.post(lambda: fn(arg))
+    return m
+
+
+def make_json(board):
+    # MicroPython's json.loads takes any buffer, CPython's only str/bytes
+    m = types.ModuleType("json")
+    m.dumps = lambda obj, separators=None: json.dumps(obj, separators=separators)
+    m.loads = lambda data: json.loads(bytes(data) if isinstance(data, (memoryview, bytearray)) else data)
+    m.dump = json.dump
+    m.load = json.load
+    return m
+
+
+def make_esp(board):
+    m = types.ModuleType("esp")
+    m.osdebug = lambda *args: None
+    m.flash_size = lambda: board.sim.flash_bytes
+    return m
+
+
+class _Selector(selectors.BaseSelector):
+    """Nothing is ever ready: select() just sleeps the board on the virtual clock"""
+
+    def __init__(self, board):
+        self.board = board
+        self._map = {}
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        key = selectors.SelectorKey(fileobj, fd, events, data)
+        self._map[fileobj] = key
+        return key
+
+    def unregister(self, fileobj):
+        return self._map.pop(fileobj)
+
+    def select(self, timeout=None):
+        board = self.board
+        if board._posted:
+            board._run_posted()
+        elif timeout is None:
+            board.wait(None, True)
+        elif timeout > 0:
+            board.wait(board.kernel.now_us + max(1, math.ceil(timeout * 1000000)), True)
+        return []
+
+    def get_map(self):
+        return self._map
+
+    def close(self):
+        self._map.clear()
+
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+
+    def __init__(self, board):
+        self._board = board
+        asyncio.SelectorEventLoop.__init__(self, _Selector(board))
+
+    def time(self):
+        return self._board.kernel.now_us / 1000000
+
+
+def make_uasyncio(board):
+    m = types.ModuleType("uasyncio")
+    for name in ("CancelledError", "Event", "Lock", "Task", "TimeoutError", "create_task",
+                 "current_task", "gather", "sleep", "wait_for"):
+        setattr(m, name, getattr(asyncio, name))
+
+    def run(coro):
+        loop = VirtualLoop(board)
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        except BaseException:
+            # Reset or end of the simulation: the tasks die with the board
+            for task in asyncio.all_tasks(loop):
+                task._log_destroy_pending = False
+                try:
+                    task.get_coro().close()
+                except BaseException:
+                    pass
+            raise
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    m.run = run
+    m.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+    m.get_event_loop = asyncio.get_event_loop
+    m.new_event_loop = lambda: VirtualLoop(board)
+    m.open_connection = lambda host, port, ssl=None: board.sim.broker.open_connection(board, host, port)
+    return m
+
+
+def make_socket(board):
+    m = types.ModuleType("socket")
+    m.AF_INET = 2
+    m.SOCK_STREAM = 1
+    m.SOCK_DGRAM = 2
+
+    def getaddrinfo(host, port, *args):
+        if not board.wifi_connected:
+            raise OSError(-202)   # MicroPython's lwIP "host not found"
+        return [(m.AF_INET, m.SOCK_STREAM, 0, "", (board.sim.broker.address, port))]
+
+    m.getaddrinfo = getaddrinfo
+    return m
+
+
+FACTORIES = {
+    "time": make_time,
+    "os": make_os,
+    "gc": make_gc,
+    "micropython": make_micropython,
+    "json": make_json,
+    "esp": make_esp,
+    "uasyncio": make_uasyncio,
+    "socket": make_socket,
+}
+
+
+def register(name, factory):
+    FACTORIES[name] = factory
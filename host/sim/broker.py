@@ -0,0 +1,322 @@
+# broker.py
+# In-process MQTT 3.1.1 broker stand-in.
+#
+# Boards reach it through uasyncio.open_connection(): bytes travel over a
+# simulated TCP stream with per-direction ordering and network latency,
+# and the broker speaks enough MQTT for the firmware's clients (CONNECT
+# with persistent sessions, QoS 0/1 PUBLISH, SUBSCRIBE with wildcards,
+# retained messages, PINGREQ). Host code publishes and subscribes directly
+# with publish()/subscribe(). set_online(False) drops every connection and
+# refuses new ones until it is back.
+import asyncio
+import collections
+
+
+def topic_matches(pattern, topic):
+    pattern = pattern.split("/")
+    topic = topic.split("/")
+    for i, part in enumerate(pattern):
+        if part == "#":
+            return True
+        if i >= len(topic) or (part != "+" and part != topic[i]):
+            return False
+    return len(pattern) == len(topic)
+
+
+def _encode_len(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def _str(data):
+    return len(data).to_bytes(2, "big") + data
+
+
+class Session:
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.subscriptions = {}   # topic filter -> qos
+        self.queue = collections.deque(maxlen=1000)   # QoS1 messages while offline
+        self.connection = None
+        self.clean = False
+        self.pid = 0
+
+
+class Connection:
+    """One TCP connection; the board side is an asyncio StreamReader/writer pair"""
+
+    def __init__(self, broker, board, reader):
+        self.broker = broker
+        self.board = board
+        self.reader = reader
+        self.session = None
+        self.open = True
+        self._rx = bytearray()
+        self._up_free_us = 0     # FIFO delivery in each direction
+        self._down_free_us = 0
+
+    def _latency(self):
+        return self.broker.kernel.random.randint(*self.broker.latency_us)
+
+    # board -> broker
+    def write(self, data):
+        if not self.open:
+            return
+        kernel = self.broker.kernel
+        self._up_free_us = max(kernel.now_us + self._latency(), self._up_free_us)
+        kernel.call_at(self._up_free_us, self._receive, bytes(data))
+
+    def close(self):
+        if self.open:
+            self.broker.kernel.call_later(self._latency(), self.broker._drop, self)
+
+    # broker -> board
+    def send(self, data):
+        if not self.open:
+            return
+        kernel = self.broker.kernel
+        self._down_free_us = max(kernel.now_us + self._latency(), self._down_free_us)
+        kernel.call_at(self._down_free_us, self._feed, bytes(data))
+
+    def _feed(self, data):
+        if self.open:
+            self.board.post(lambda: self.reader.feed_data(data))
+
+    def hang_up(self):
+        """Broker side close: the board reads EOF"""
+        if self.open:
+            self.open = False
+            self.board.post(self.reader.feed_eof)
+
+    def _receive(self, data):
+        if not self.open:
+            return
+        self._rx += data
+        while len(self._rx) >= 2:
+            size = 0
+            shift = 0
+            i = 1
+            while True:
+                if i >= len(self._rx):
+                    return
+                byte = self._rx[i]
+                size |= (byte & 0x7F) << shift
+                shift += 7
+                i += 1
+                if not byte & 0x80:
+                    break
+            if len(self._rx) < i + size:
+                return
+            op = self._rx[0]
+            body = bytes(self._rx[i:i + size])
+            del self._rx[:i + size]
+            self.broker._packet(self, op, body)
+            if not self.open:
+                return
+
+
+class _Writer:
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def write(self, data):
+        self._connection.write(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self._connection.close()
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+class Broker:
+
+    def __init__(self, kernel, address="10.0.0.2", latency_us=(5000, 25000), history=100):
+        self.kernel = kernel
+        self.address = address
+        self.latency_us = latency_us
+        self.online = True
+        self.sessions = {}
+        self.connections = []
+        self.retained = {}
+        self.counts = collections.Counter()   # topic -> publishes received
+        self.bytes = collections.Counter()
+        self.history = collections.defaultdict(lambda: collections.deque(maxlen=history))
+        self._watchers = []                    # (topic filter, fn(topic, payload))
+        self.connects = 0
+
+    # ----- host side -----
+    def subscribe(self, pattern, fn):
+        """fn(topic, payload) for every publish matching pattern"""
+        self._watchers.append((pattern, fn))
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self._route(topic, bytes(payload), qos, retain)
+
+    def messages(self, pattern):
+        """Recent (time_us, topic, payload) on topics matching pattern, oldest first"""
+        out = []
+        for topic, entries in self.history.items():
+            if topic_matches(pattern, topic):
+                out.extend(entries)
+        out.sort(key=lambda entry: entry[0])
+        return out
+
+    def set_online(self, online):
+        self.online = online
+        if not online:
+            for connection in list(self.connections):
+                self._drop(connection)
+
+    def drop_board(self, board):
+        """The board lost its network: its connections die without a DISCONNECT"""
+        for connection in list(self.connections):
+            if connection.board is board:
+                self._drop(connection)
+
+    # ----- board side -----
+    async def open_connection(self, board, host, port):
+        if not board.wifi_connected:
+            raise OSError(113)   # EHOSTUNREACH
+        # TCP handshake
+        await asyncio.sleep((self.latency_us[0] + self.latency_us[1]) / 1000000)
+        if not self.online or host != self.address or not board.wifi_connected:
+            raise OSError(104 if host == self.address else 113)   # ECONNRESET/EHOSTUNREACH
+        reader = asyncio.StreamReader()
+        connection = Connection(self, board, reader)
+        self.connections.append(connection)
+        return reader, _Writer(connection)
+
+    def _drop(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+        if connection.session is not None and connection.session.connection is connection:
+            connection.session.connection = None
+            if connection.session.clean:
+                self.sessions.pop(connection.session.client_id, None)
+        connection.hang_up()
+
+    def _packet(self, connection, op, body):
+        kind = op & 0xF0
+        if connection.session is None and kind != 0x10:
+            self._drop(connection)
+            return
+        if kind == 0x10:
+            self._connect(connection, body)
+        elif kind == 0x30:
+            qos = (op >> 1) & 3
+            n = int.from_bytes(body[:2], "big")
+            topic = body[2:2 + n].decode()
+            pos = 2 + n
+            if qos:
+                pid = body[pos:pos + 2]
+                pos += 2
+                connection.send(b"\x40\x02" + pid)
+            self._route(topic, body[pos:], min(qos, 1), bool(op & 1))
+        elif kind == 0x80:
+            pid = body[:2]
+            pos = 2
+            granted = bytearray()
+            session = connection.session
+            new = []
+            while pos < len(body):
+                n = int.from_bytes(body[pos:pos + 2], "big")
+                pattern = body[pos + 2:pos + 2 + n].decode()
+                qos = min(body[pos + 2 + n], 1)
+                pos += 3 + n
+                session.subscriptions[pattern] = qos
+                granted.append(qos)
+                new.append(pattern)
+            connection.send(b"\x90" + _encode_len(2 + len(granted)) + pid + bytes(granted))
+            for topic, payload in self.retained.items():
+                for pattern in new:
+                    if topic_matches(pattern, topic):
+                        self._deliver(session, topic, payload, session.subscriptions[pattern], True)
+                        break
+        elif kind == 0xA0:
+            pos = 2
+            while pos < len(body):
+                n = int.from_bytes(body[pos:pos + 2], "big")
+                connection.session.subscriptions.pop(body[pos + 2:pos + 2 + n].decode(), None)
+                pos += 2 + n
+            connection.send(b"\xb0\x02" + body[:2])
+        elif kind == 0xC0:
+            connection.send(b"\xd0\x00")
+        elif kind == 0xE0:
+            connection.open = False
+            self._drop(connection)
+        # PUBACKs from the client need no action: nothing is retransmitted
+
+    def _connect(self, connection, body):
+        n = int.from_bytes(body[:2], "big")
+        flags = body[2 + n + 1]
+        pos = 2 + n + 4
+        n = int.from_bytes(body[pos:pos + 2], "big")
+        client_id = body[pos + 2:pos + 2 + n].decode()
+        clean = bool(flags & 0x02)
+        if clean:
+            # A clean session starts empty and ends with the connection
+            self.sessions.pop(client_id, None)
+        session = self.sessions.get(client_id)
+        present = session is not None
+        if session is None:
+            session = self.sessions[client_id] = Session(client_id)
+        if session.connection is not None:
+            self._drop(session.connection)   # Session takeover
+        session.connection = connection
+        session.clean = clean
+        connection.session = session
+        self.connects += 1
+        connection.send(bytes((0x20, 0x02, 1 if present else 0, 0)))
+        while session.queue:
+            topic, payload = session.queue.popleft()
+            self._deliver(session, topic, payload, 1, False)
+
+    def _route(self, topic, payload, qos, retain):
+        self.counts[topic] += 1
+        self.bytes[topic] += len(payload)
+        self.history[topic].append((self.kernel.now_us, topic, payload))
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for pattern, fn in self._watchers:
+            if topic_matches(pattern, topic):
+                fn(topic, payload)
+        for session in list(self.sessions.values()):
+            granted = None
+            for pattern, sub_qos in session.subscriptions.items():
+                if topic_matches(pattern, topic):
+                    granted = max(granted or 0, min(qos, sub_qos))
+            if granted is not None:
+                self._deliver(session, topic, payload, granted, False)
+
+    def _deliver(self, session, topic, payload, qos, retain):
+        connection = session.connection
+        if connection is None:
+            if qos:
+                session.queue.append((topic, payload))
+            return
+        header = 0x30 | (qos << 1) | (1 if retain else 0)
+        body = _str(topic.encode())
+        if qos:
+            session.pid = session.pid % 65535 + 1
+            body += session.pid.to_bytes(2, "big")
+        body += payload
+        connection.send(bytes((header,)) + _encode_len(len(body)) + body)
@@ -0,0 +1,419 @@
+# hardware.py
+# The board's `machine` module and the devices wired to its pins and buses.
+#
+# Pins keep their level in the board's pin table; device models watch
+# output pins (relays, the HC-SR04 trigger) and drive input pins from
+# kernel events (the echo line), which also fires Pin.irq() handlers in
+# the board's thread. I2C transfers take their bit time on the virtual
+# clock at the bus frequency and go to the model at the addressed slot.
+import types
+
+from .board import Reset, register
+
+PWRON_RESET = 1
+HARD_RESET = 2
+WDT_RESET = 3
+DEEPSLEEP_RESET = 4
+SOFT_RESET = 5
+
+ENODEV = 19
+I2C_TIMEOUT = 116
+
+
+class PinState:
+    __slots__ = ("level", "mode", "irq", "trigger", "watchers")
+
+    def __init__(self):
+        self.level = 0
+        self.mode = -1
+        self.irq = None
+        self.trigger = 0
+        self.watchers = []
+
+
+def pin_state(board, pin_id):
+    pins = board.devices.setdefault("pins", {})
+    state = pins.get(pin_id)
+    if state is None:
+        state = pins[pin_id] = PinState()
+    return state
+
+
+def watch_pin(board, pin_id, fn):
+    """fn(level) runs (in the board's thread) whenever the firmware drives the pin"""
+    pin_state(board, pin_id).watchers.append(fn)
+
+
+def set_input(board, pin_id, level):
+    """Drive an input pin from a device model (kernel side)"""
+    state = pin_state(board, pin_id)
+    if state.level == level:
+        return
+    state.level = level
+    if state.irq is not None and state.trigger & (1 if level else 2):
+        board.post(state.irq)
+    board.notify()
+
+
+def pwm_state(board, pin_id):
+    return board.devices.setdefault("pwm", {}).setdefault(pin_id, {"freq": 0, "duty": 0, "watchers": []})
+
+
+def watch_pwm(board, pin_id, fn):
+    """fn(duty_u16) runs whenever the firmware changes the pin's PWM duty"""
+    pwm_state(board, pin_id)["watchers"].append(fn)
+
+
+def attach_i2c(board, bus_id, address, device):
+    board.devices.setdefault("i2c", {}).setdefault(bus_id, {})[address] = device
+
+
+def _boot_hook(board):
+    def reset_pins():
+        # GPIOs come out of reset as inputs, so relays drop out
+        for state in board.devices.get("pins", {}).values():
+            state.irq = None
+            if state.mode == Pin.OUT and state.level:
+                state.level = 0
+                for fn in state.watchers:
+                    fn(0)
+            state.mode = -1
+        for pwm in board.devices.get("pwm", {}).values():
+            pwm["duty"] = 0
+            for fn in pwm["watchers"]:
+                fn(0)
+    return reset_pins
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+    _board = None
+
+    def __init__(self, id, mode=-1, pull=-1, *, value=None, **kwargs):
+        self.id = id
+        self._state = pin_state(self._board, id)
+        self.init(mode, pull, value=value)
+
+    def init(self, mode=-1, pull=-1, *, value=None, **kwargs):
+        if mode != -1:
+            self._state.mode = mode
+        if value is not None:
+            self.value(value)
+
+    def value(self, x=None):
+        state = self._state
+        if x is None:
+            return state.level
+        level = 1 if x else 0
+        if state.level != level or state.mode in (Pin.OUT, Pin.OPEN_DRAIN):
+            state.level = level
+            for fn in state.watchers:
+                fn(level)
+
+    __call__ = value
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def irq(self, handler=None, trigger=IRQ_RISING | IRQ_FALLING, **kwargs):
+        self._state.irq = (lambda: handler(self)) if handler is not None else None
+        self._state.trigger = trigger if handler is not None else 0
+
+
+class PWM:
+    _board = None
+
+    def __init__(self, dest, freq=None, duty=None, duty_u16=None, **kwargs):
+        pin_id = dest.id if isinstance(dest, Pin) else dest
+        self._state = pwm_state(self._board, pin_id)
+        if freq is not None:
+            self._state["freq"] = freq
+        if duty is not None:
+            self.duty(duty)
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+
+    def freq(self, value=None):
+        if value is None:
+            return self._state["freq"]
+        self._state["freq"] = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._state["duty"]
+        self._state["duty"] = max(0, min(65535, int(value)))
+        for fn in self._state["watchers"]:
+            fn(self._state["duty"])
+
+    def duty(self, value=None):
+        """10-bit duty, as on the ESP32 port"""
+        if value is None:
+            return self._state["duty"] >> 6
+        self.duty_u16(int(value) << 6)
+
+    def duty_ns(self, value=None):
+        period_ns = 1000000000 // (self._state["freq"] or 1)
+        if value is None:
+            return self._state["duty"] * period_ns // 65535
+        self.duty_u16(value * 65535 // period_ns)
+
+    def deinit(self):
+        self.duty_u16(0)
+
+
+class I2C:
+    _board = None
+
+    def __init__(self, id=0, *, scl=None, sda=None, freq=400000, timeout=50000):
+        self._bus = self._board.devices.setdefault("i2c", {}).setdefault(id, {})
+        self._freq = freq
+
+    def init(self, *, scl=None, sda=None, freq=400000, **kwargs):
+        self._freq = freq
+
+    def _transfer(self, address, nbytes):
+        # Address byte plus data, 9 clocks each
+        self._board.sleep_us((nbytes + 1) * 9 * 1000000 // self._freq)
+        device = self._bus.get(address)
+        if device is None:
+            raise OSError(ENODEV)
+        return device
+
+    def scan(self):
+        self._board.sleep_us(112 * 9 * 1000000 // self._freq)
+        return sorted(self._bus)
+
+    def writeto(self, addr, buf, stop=True):
+        self._transfer(addr, len(buf)).write(bytes(buf))
+        return len(buf)
+
+    def writevto(self, addr, vector, stop=True):
+        return self.writeto(addr, b"".join(bytes(buf) for buf in vector), stop)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        return bytes(self._transfer(addr, nbytes).read(nbytes))
+
+    def readfrom_into(self, addr, buf, stop=True):
+        data = self._transfer(addr, len(buf)).read(len(buf))
+        buf[:len(data)] = data
+
+    def writeto_mem(self, addr, memaddr, buf, *, addrsize=8):
+        self.writeto(addr, memaddr.to_bytes(addrsize // 8, "big") + bytes(buf))
+
+    def readfrom_mem(self, addr, memaddr, nbytes, *, addrsize=8):
+        self.writeto(addr, memaddr.to_bytes(addrsize // 8, "big"), False)
+        return self.readfrom(addr, nbytes)
+
+    def readfrom_mem_into(self, addr, memaddr, buf, *, addrsize=8):
+        self.writeto(addr, memaddr.to_bytes(addrsize // 8, "big"), False)
+        self.readfrom_into(addr, buf)
+
+
+class RTC:
+    _board = None
+
+    def datetime(self, t=None):
+        board = self._board
+        time = board.fakes.get("time") or board._load("time")
+        if t is None:
+            secs = board.device_time()
+            tm = time.gmtime(secs)
+            return (tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5],
+                    int(secs % 1 * 1000000))
+        secs = time.mktime((t[0], t[1], t[2], t[4], t[5], t[6], 0, 0))
+        board.rtc_base = secs + t[7] / 1000000 - board.kernel.now_us / 1000000
+
+    def init(self, t):
+        self.datetime(t)
+
+    def memory(self, data=None):
+        """Survives resets and deep sleep, but not a power cycle"""
+        if data is None:
+            return self._board.rtc_memory
+        if len(data) > 2048:
+            raise ValueError("buffer too long")
+        self._board.rtc_memory = bytes(data)
+
+
+def make_machine(board):
+    m = types.ModuleType("machine")
+    m.Pin = type("Pin", (Pin,), {"_board": board})
+    m.PWM = type("PWM", (PWM,), {"_board": board})
+    m.I2C = type("I2C", (I2C,), {"_board": board})
+    m.SoftI2C = m.I2C
+    m.RTC = type("RTC", (RTC,), {"_board": board})
+    m.PWRON_RESET = PWRON_RESET
+    m.HARD_RESET = HARD_RESET
+    m.WDT_RESET = WDT_RESET
+    m.DEEPSLEEP_RESET = DEEPSLEEP_RESET
+    m.SOFT_RESET = SOFT_RESET
+
+    def time_pulse_us(pin, pulse_level, timeout_us=1000000):
+        state = pin._state
+        deadline = board.kernel.now_us + timeout_us
+        while state.level != pulse_level:
+            if board.kernel.now_us >= deadline:
+                return -2
+            board.wait(deadline, True)
+        start = board.kernel.now_us
+        deadline = start + timeout_us
+        while state.level == pulse_level:
+            if board.kernel.now_us >= deadline:
+                return -1
+            board.wait(deadline, True)
+        return board.kernel.now_us - start
+
+    def reset():
+        raise Reset(SOFT_RESET)
+
+    def deepsleep(time_ms=None):
+        board.wait(None if time_ms is None else board.kernel.now_us + time_ms * 1000)
+        raise Reset(DEEPSLEEP_RESET)
+
+    def lightsleep(time_ms=None):
+        board.wait(None if time_ms is None else board.kernel.now_us + time_ms * 1000)
+
+    def idle():
+        board.wait(board.kernel.now_us + 1000, True)
+
+    m.time_pulse_us = time_pulse_us
+    m.reset = reset
+    m.soft_reset = reset
+    m.deepsleep = deepsleep
+    m.lightsleep = lightsleep
+    m.idle = idle
+    m.reset_cause = lambda: board.reset_cause
+    m.unique_id = lambda: board.mac
+    m.freq = lambda hz=None: 240000000 if hz is None else None
+    m.disable_irq = lambda: 0
+    m.enable_irq = lambda state=0: None
+    return m
+
+
+register("machine", make_machine)
+
+
+# ===== device models =====
+def crc8(data):
+    """Sensirion CRC-8 (polynomial 0x31, init 0xFF)"""
+    crc = 0xFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x31 if crc & 0x80 else crc << 1
+        crc &= 0xFF
+    return crc
+
+
+class SHT4x:
+    """Sensirion SHT4x at the I2C command level.
+
+    A measure command samples read_env() -> (temperature, humidity) and the
+    result can be read once the conversion time has passed; reading earlier
+    is NACKed, as on the real part.
+    """
+    CONVERSION_US = {0xFD: 8300, 0xF6: 4500, 0xE0: 1700,
+                     # heater on, then a high precision measurement
+                     0x39: 1100000, 0x32: 110000, 0x2F: 1100000,
+                     0x24: 110000, 0x1E: 1100000, 0x15: 110000}
+    NOISE = {0xFD: (0.04, 0.08), 0xF6: (0.07, 0.15), 0xE0: (0.1, 0.25)}
+
+    def __init__(self, kernel, read_env, serial=0x0D3A5B71):
+        self.kernel = kernel
+        self.read_env = read_env
+        self.serial = serial
+        self.measurements = 0
+        self._result = None
+        self._ready_us = 0
+
+    @staticmethod
+    def _word(value):
+        raw = bytes((value >> 8, value & 0xFF))
+        return raw + bytes((crc8(raw),))
+
+    def write(self, data):
+        if not data:
+            return
+        command = data[0]
+        now = self.kernel.now_us
+        if command in self.CONVERSION_US:
+            temperature, humidity = self.read_env()
+            sigma_t, sigma_h = self.NOISE.get(command, self.NOISE[0xFD])
+            rng = self.kernel.random
+            temperature += rng.gauss(0, sigma_t)
+            humidity += rng.gauss(0, sigma_h)
+            t_raw = max(0, min(65535, round((temperature + 45) * 65535 / 175)))
+            rh_raw = max(0, min(65535, round((humidity + 6) * 65535 / 125)))
+            self._result = self._word(t_raw) + self._word(rh_raw)
+            self._ready_us = now + self.CONVERSION_US[command]
+            self.measurements += 1
+        elif command in (0x89, 0x8F):
+            self._result = self._word(self.serial >> 16) + self._word(self.serial & 0xFFFF)
+            self._ready_us = now
+        elif command == 0x94:
+            self._result = None
+            self._ready_us = now + 1000
+
+    def read(self, n):
+        if self._result is None or self.kernel.now_us < self._ready_us:
+            raise OSError(ENODEV)
+        result, self._result = self._result, None
+        return result[:n]
+
+
+class HCSR04:
+    """HC-SR04 ultrasonic ranger on a trigger/echo pin pair.
+
+    A trigger pulse of at least 10 us starts a burst; about 460 us later
+    the echo pin goes high for the round trip time (58.2 us per cm) of
+    distance(t) -> cm, or for 38 ms when nothing is in range (None).
+    """
+    BURST_US = 460
+    NO_ECHO_US = 38000
+
+    def __init__(self, board, trigger_pin, echo_pin, distance, noise_cm=0.3, dropout=0.0):
+        self.board = board
+        self.kernel = board.kernel
+        self.echo_pin = echo_pin
+        self.distance = distance
+        self.noise_cm = noise_cm
+        self.dropout = dropout
+        self.pings = 0
+        self._high_since = None
+        self._busy_until = 0
+        watch_pin(board, trigger_pin, self._on_trigger)
+
+    def _on_trigger(self, level):
+        now = self.kernel.now_us
+        if level:
+            self._high_since = now
+            return
+        high_since, self._high_since = self._high_since, None
+        if high_since is None or now - high_since < 10 or now < self._busy_until:
+            return
+        rng = self.kernel.random
+        distance = self.distance(now / 1000000)
+        if distance is None or distance > 400 or rng.random() < self.dropout:
+            width = self.NO_ECHO_US
+        else:
+            distance = max(distance + rng.gauss(0, self.noise_cm), 2)
+            width = int(distance * 58.2)
+        rise = now + self.BURST_US
+        self._busy_until = rise + width
+        self.pings += 1
+        self.kernel.call_at(rise, set_input, self.board, self.echo_pin, 1)
+        self.kernel.call_at(rise + width, set_input, self.board, self.echo_pin, 0)
+
+
+def install(board):
+    """Per-boot pin reset for a board with hardware attached"""
+    board.devices.setdefault("boot_hooks", []).append(_boot_hook(board))
@@ -0,0 +1,88 @@
+# kernel.py
+# Deterministic virtual clock shared by every simulated board.
+#
+# Each board's firmware runs in its own thread, but only one thread - a
+# board or the kernel - ever runs at a time: a board runs until it waits
+# (sleep, receive timeout, event loop select) and then hands control back.
+# The kernel then jumps the clock straight to the next due event or board
+# wake-up, so idle time costs nothing and a given seed always replays the
+# same run. Firmware code itself takes no virtual time.
+import heapq
+import random
+import threading
+
+
+class Halt(BaseException):
+    """Raised in a board's thread to unwind it when the simulation ends"""
+
+
+class SimulationError(Exception):
+    pass
+
+
+class Kernel:
+
+    def __init__(self, seed=0, strict=True):
+        """strict: a board whose firmware dies with an exception stops the run"""
+        self.now_us = 0
+        self.random = random.Random(seed)
+        self.strict = strict
+        self.boards = []
+        self.halted = False
+        self.switches = 0
+        self._events = []   # (time_us, seq, fn, args)
+        self._seq = 0
+        self._back = threading.Lock()
+        self._back.acquire()
+
+    def call_at(self, at_us, fn, *args):
+        self._seq += 1
+        heapq.heappush(self._events, (max(int(at_us), self.now_us), self._seq, fn, args))
+
+    def call_later(self, delay_us, fn, *args):
+        self.call_at(self.now_us + delay_us, fn, *args)
+
+    def _next_board(self):
+        best = None
+        for board in self.boards:
+            if board.wake_us is not None and (best is None or board.wake_us < best.wake_us):
+                best = board
+        return best
+
+    def switch(self, board):
+        """Run board until it waits again"""
+        board.wake_us = None
+        self.switches += 1
+        board._go.release()
+        self._back.acquire()
+        if board.error is not None and self.strict:
+            raise SimulationError("{} crashed:\n{}".format(board.name, board.error))
+
+    def run_until(self, until_us):
+        if self.halted:
+            raise SimulationError("simulation has been shut down")
+        while True:
+            board = self._next_board()
+            t_board = board.wake_us if board is not None else None
+            t_event = self._events[0][0] if self._events else None
+            if t_event is not None and (t_board is None or t_event <= t_board):
+                if t_event > until_us:
+                    break
+                at, _, fn, args = heapq.heappop(self._events)
+                self.now_us = at
+                fn(*args)
+            elif t_board is not None and t_board <= until_us:
+                self.now_us = max(self.now_us, t_board)
+                self.switch(board)
+            else:
+                break
+        self.now_us = max(self.now_us, until_us)
+
+    def shutdown(self):
+        """Unwind every board thread"""
+        self.halted = True
+        for board in self.boards:
+            if board.alive:
+                board.wake_us = None
+                board._go.release()
+                self._back.acquire()
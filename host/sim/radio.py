@@ -0,0 +1,287 @@
+# radio.py
+# ESP-NOW over a simulated 2.4 GHz channel, and the boards' WiFi station.
+#
+# Every frame is lost with the link's loss probability and otherwise
+# arrives after a random latency drawn from the link's range. A send with
+# sync=True reports whether the receiver's MAC acknowledged the frame.
+# Receivers keep at most RX_QUEUE frames (the ESP32 port's default ring
+# buffer holds about that many small frames); more are dropped.
+import asyncio
+import types
+
+from .board import register
+
+MAX_DATA_LEN = 250
+MAX_PEERS = 20
+RX_QUEUE = 8
+
+
+def _espnow_error(name):
+    codes = {"ESP_ERR_ESPNOW_NOT_INIT": -12391, "ESP_ERR_ESPNOW_FULL": -12394,
+             "ESP_ERR_ESPNOW_NOT_FOUND": -12395, "ESP_ERR_ESPNOW_EXIST": -12397}
+    return OSError(codes[name], name)
+
+
+class Radio:
+
+    def __init__(self, kernel, loss=0.0, latency_us=(300, 1500)):
+        self.kernel = kernel
+        self.loss = loss
+        self.latency_us = latency_us
+        self.boards = {}    # mac -> board
+        self._links = {}    # (src mac, dst mac) -> (loss, latency_us)
+        self.sent = 0
+        self.lost = 0
+        self.overflows = 0
+
+    def attach(self, board):
+        self.boards[board.mac] = board
+
+    def set_link(self, src, dst, loss=None, latency_us=None):
+        """Override loss/latency for frames from board src to board dst"""
+        old_loss, old_latency = self._links.get((src.mac, dst.mac), (self.loss, self.latency_us))
+        self._links[(src.mac, dst.mac)] = (old_loss if loss is None else loss,
+                                           old_latency if latency_us is None else latency_us)
+
+    def transmit(self, src, dst_mac, msg):
+        """Queue msg for delivery; returns True if it will arrive (the MAC-layer ack)"""
+        self.sent += 1
+        dst = self.boards.get(dst_mac)
+        loss, latency = self._links.get((src.mac, dst_mac), (self.loss, self.latency_us))
+        endpoint = dst.fakes.get("espnow") if dst is not None and dst.alive else None
+        endpoint = endpoint and endpoint._instance
+        if (endpoint is None or not endpoint._active
+                or dst.wifi_channel != src.wifi_channel
+                or self.kernel.random.random() < loss):
+            self.lost += 1
+            return False
+        self.kernel.call_later(self.kernel.random.randint(*latency), endpoint._deliver, src.mac, msg)
+        return True
+
+
+class ESPNow:
+    """espnow.ESPNow; one instance per board, as on the device"""
+    _board = None
+    _instance = None
+
+    def __new__(cls):
+        module = cls._board.fakes["espnow"]
+        if module._instance is None:
+            module._instance = object.__new__(cls)
+            module._instance._init()
+        return module._instance
+
+    def _init(self):
+        self._active = False
+        self._peers = {}
+        self._inbox = []
+        self._event = None
+        self.stats_tx = 0
+        self.stats_tx_failed = 0
+        self.stats_rx = 0
+        self.stats_rx_dropped = 0
+
+    def active(self, flag=None):
+        if flag is None:
+            return self._active
+        self._active = bool(flag)
+        if not flag:
+            self._peers.clear()
+            self._inbox.clear()
+
+    def config(self, *args, **kwargs):
+        if args:
+            return {"rxbuf": 526, "timeout_ms": 300000, "rate": 0}.get(args[0])
+
+    def add_peer(self, mac, lmk=None, channel=0, ifidx=0, encrypt=False):
+        self._check()
+        mac = bytes(mac)
+        if mac in self._peers:
+            raise _espnow_error("ESP_ERR_ESPNOW_EXIST")
+        if len(self._peers) >= MAX_PEERS:
+            raise _espnow_error("ESP_ERR_ESPNOW_FULL")
+        self._peers[mac] = (lmk, channel, ifidx, encrypt)
+
+    def del_peer(self, mac):
+        self._check()
+        if self._peers.pop(bytes(mac), None) is None:
+            raise _espnow_error("ESP_ERR_ESPNOW_NOT_FOUND")
+
+    def get_peers(self):
+        return tuple((mac,) + peer for mac, peer in self._peers.items())
+
+    def peer_count(self):
+        return (len(self._peers), 0)
+
+    def _check(self):
+        if not self._active:
+            raise _espnow_error("ESP_ERR_ESPNOW_NOT_INIT")
+
+    def send(self, mac, msg=None, sync=True):
+        if msg is None:
+            mac, msg = None, mac
+        self._check()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        msg = bytes(msg)
+        if len(msg) > MAX_DATA_LEN:
+            raise ValueError("msg too long")
+        board = self._board
+        targets = list(self._peers) if mac is None else [bytes(mac)]
+        ok = True
+        for target in targets:
+            if target not in self._peers:
+                raise _espnow_error("ESP_ERR_ESPNOW_NOT_FOUND")
+            self.stats_tx += 1
+            if not board.sim.radio.transmit(board, target, msg):
+                self.stats_tx_failed += 1
+                ok = False
+        return ok if sync else True
+
+    def _deliver(self, mac, msg):
+        """Kernel side: a frame arrived"""
+        if not self._active or len(self._inbox) >= RX_QUEUE:
+            self.stats_rx_dropped += 1
+            self._board.sim.radio.overflows += 1
+            return
+        self.stats_rx += 1
+        self._inbox.append((mac, msg))
+        if self._event is not None:
+            self._board.post(self._event.set)
+        self._board.notify()
+
+    def any(self):
+        return bool(self._inbox)
+
+    def irecv(self, timeout_ms=None):
+        self._check()
+        board = self._board
+        if timeout_ms is None:
+            timeout_ms = 300000
+        deadline = None if timeout_ms < 0 else board.kernel.now_us + timeout_ms * 1000
+        while not self._inbox:
+            if deadline is not None and board.kernel.now_us >= deadline:
+                return (None, None)
+            board.wait(deadline, True)
+        mac, msg = self._inbox.pop(0)
+        board.allocate(board.alloc_per_rx)
+        return (mac, bytearray(msg))
+
+    def recv(self, timeout_ms=None):
+        mac, msg = self.irecv(timeout_ms)
+        return [mac, None if msg is None else bytes(msg)]
+
+    def stats(self):
+        return (self.stats_tx, self.stats_tx_failed, 0, self.stats_rx, self.stats_rx_dropped)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.irecv()
+
+
+class AIOESPNow(ESPNow):
+    """aioespnow.AIOESPNow: awaitable receive on the board's event loop"""
+
+    async def airecv(self):
+        if self._event is None:
+            self._event = asyncio.Event()
+        while not self._inbox:
+            self._event.clear()
+            await self._event.wait()
+        mac, msg = self._inbox.pop(0)
+        self._board.allocate(self._board.alloc_per_rx)
+        return (mac, bytes(msg))
+
+    async def arecv(self):
+        mac, msg = await self.airecv()
+        return [mac, msg]
+
+    async def asend(self, mac, msg=None, sync=True):
+        return self.send(mac, msg, sync)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.airecv()
+
+
+def make_espnow(board):
+    m = types.ModuleType("espnow")
+    m._instance = None
+    m.ESPNow = type("ESPNow", (ESPNow,), {"_board": board})
+    m.MAX_DATA_LEN = MAX_DATA_LEN
+    m.KEY_LEN = 16
+    m.MAX_TOTAL_PEER_NUM = MAX_PEERS
+    return m
+
+
+def make_aioespnow(board):
+    espnow = board._load("espnow")
+    m = types.ModuleType("aioespnow")
+    m.AIOESPNow = type("AIOESPNow", (AIOESPNow, espnow.ESPNow), {"_board": board})
+    return m
+
+
+class WLAN:
+    """network.WLAN station interface; the access point is the simulation's"""
+    _board = None
+
+    def __init__(self, interface_id=0):
+        self._id = interface_id
+
+    def active(self, flag=None):
+        board = self._board
+        if flag is None:
+            return board.wlan_active
+        board.wlan_active = bool(flag)
+        if not flag:
+            board.sim.set_wifi(board, False)
+
+    def connect(self, ssid=None, key=None, **kwargs):
+        board = self._board
+        if not board.wlan_active:
+            raise OSError("STA must be active")
+        board.sim.join_wifi(board)
+
+    def disconnect(self):
+        self._board.sim.set_wifi(self._board, False)
+
+    def isconnected(self):
+        return self._board.wifi_connected
+
+    def status(self, param=None):
+        if param == "rssi":
+            return -60
+        return 1010 if self._board.wifi_connected else 1000
+
+    def ifconfig(self, config=None):
+        board = self._board
+        return (board.ip if board.wifi_connected else "0.0.0.0",
+                "255.255.255.0", "192.168.1.1", "192.168.1.1")
+
+    def config(self, *args, **kwargs):
+        board = self._board
+        if "channel" in kwargs:
+            board.wifi_channel = kwargs["channel"]
+        if args:
+            return {"mac": board.mac, "channel": board.wifi_channel,
+                    "essid": board.sim.ssid if board.wifi_connected else ""}[args[0]]
+
+
+def make_network(board):
+    m = types.ModuleType("network")
+    m.STA_IF = 0
+    m.AP_IF = 1
+    m.STAT_IDLE = 1000
+    m.STAT_CONNECTING = 1001
+    m.STAT_GOT_IP = 1010
+    m.WLAN = type("WLAN", (WLAN,), {"_board": board})
+    return m
+
+
+register("espnow", make_espnow)
+register("aioespnow", make_aioespnow)
+register("network", make_network)
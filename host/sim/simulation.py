@@ -0,0 +1,258 @@
+# simulation.py
+# The three-node terrarium (sensor, controller, actuator) with its world.
+#
+#   sim = Simulation(seed=1, loss=0.02)   # heap_churn=2048: GC under load
+#   sim.broker_outage(3600, 600)
+#   sim.run(hours=24)
+#   print(format_report(sim.report()))
+#   sim.close()
+#
+# The unmodified firmware from esp32_firmware/ runs on each board. The
+# MACs are the ones hard-coded there, so the nodes find each other as
+# they would on the bench.
+import json
+import os
+import time
+
+from . import hardware
+from .board import Board
+from .broker import Broker
+from .kernel import Kernel
+from .radio import Radio
+from .world import Terrarium
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE = os.path.join(HERE, "..", "..", "esp32_firmware")
+
+CONTROLLER_MAC = "14:2b:2f:af:e4:98"
+ACTUATOR_MAC = "14:2b:2f:af:79:c4"
+SENSOR_MAC = "24:6f:28:5a:10:01"
+
+# Device clock at the start of a run: 2025-01-01 00:00 UTC in seconds since 2000
+START_TIME = 788918400
+WIFI_JOIN_US = 1500000
+FLASH_BYTES = 2 * 1024 * 1024
+
+# The actuator's relay and servo pins
+RELAY_PINS = (("heat", 27), ("fan", 15), ("humid", 32))
+SERVO_PIN = 13
+SHT_BUS = 0
+SHT_ADDRESS = 0x44
+TRIGGER_PIN = 32
+ECHO_PIN = 33
+
+
+def mac_bytes(mac):
+    return bytes(int(part, 16) for part in mac.split(":"))
+
+
+class Simulation:
+
+    def __init__(self, seed=0, loss=0.0, radio_latency_us=(300, 1500),
+                 broker_latency_us=(5000, 25000), strict=True, verbose=False, log_dir=None,
+                 start_time=START_TIME, terrarium=None, heap_churn=0, gc_pause_us=0):
+        self.kernel = Kernel(seed, strict)
+        self.verbose = verbose
+        self.ssid = "terrarium-sim"
+        self.ap_up = True
+        self.ap_channel = 1
+        self.flash_bytes = FLASH_BYTES
+        self.wall_s = 0.0
+        self.radio = Radio(self.kernel, loss, radio_latency_us)
+        self.broker = Broker(self.kernel, latency_us=broker_latency_us)
+        self.tank = Terrarium(self.kernel, **(terrarium or {}))
+        self.boards = []
+        self._log_dir = log_dir
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        self._start_time = start_time
+        # Heap model (see Board): bytes allocated per received ESP-NOW frame,
+        # and how long gc.collect() takes
+        self.heap_churn = heap_churn
+        self.gc_pause_us = gc_pause_us
+        self.diagnostics = []
+        self.broker.subscribe("environment/controller/diagnostics", self._on_diagnostics)
+
+        # The controller boots with WiFi already up (boot.py), the nodes after it
+        self.controller = self.add_board("controller", CONTROLLER_MAC, "esp32_data",
+                                         wifi_connected=True)
+        self.actuator = self.add_board("actuator", ACTUATOR_MAC, "esp32_actuator",
+                                       boot_at_us=200000)
+        self.sensor = self.add_board("sensor", SENSOR_MAC, "esp32_sensor", boot_at_us=500000)
+
+        for name, pin in RELAY_PINS:
+            hardware.watch_pin(self.actuator, pin, self.tank.relay(name))
+        hardware.watch_pwm(self.actuator, SERVO_PIN, self.tank.servo)
+        self.sht = hardware.SHT4x(self.kernel, self.tank.read_env)
+        hardware.attach_i2c(self.sensor, SHT_BUS, SHT_ADDRESS, self.sht)
+        self.ranger = hardware.HCSR04(self.sensor, TRIGGER_PIN, ECHO_PIN, self.tank.distance)
+
+    def add_board(self, name, mac, directory, boot_at_us=0, wifi_connected=False):
+        board = Board(self, name, mac_bytes(mac),
+                      [os.path.join(FIRMWARE, directory), os.path.join(FIRMWARE, "common")],
+                      boot_at_us=boot_at_us, wifi_connected=wifi_connected,
+                      rtc_base=self._start_time)
+        if wifi_connected:
+            self._joined(board)
+        board.alloc_per_rx = self.heap_churn
+        board.gc_pause_us = self.gc_pause_us
+        if self._log_dir:
+            board.log_file = open(os.path.join(self._log_dir, name + ".log"), "w")
+        hardware.install(board)
+        self.radio.attach(board)
+        self.boards.append(board)
+        return board
+
+    # ----- WiFi -----
+    def join_wifi(self, board):
+        if not board.wifi_connected and self.ap_up:
+            self.kernel.call_later(WIFI_JOIN_US, self._joined, board)
+
+    def _joined(self, board):
+        if self.ap_up and board.wlan_active and not board.wifi_connected:
+            board.wifi_connected = True
+            board.wifi_channel = self.ap_channel
+            board.ip = "192.168.1.{}".format(100 + self.boards.index(board) if board in self.boards else 100)
+
+    def set_wifi(self, board, connected):
+        if not connected and board.wifi_connected:
+            board.wifi_connected = False
+            self.broker.drop_board(board)
+
+    # ----- scripted events -----
+    def at(self, seconds, fn, *args):
+        """Call fn(*args) at simulation time seconds"""
+        self.kernel.call_at(int(seconds * 1000000), fn, *args)
+
+    def wifi_outage(self, start_s, duration_s):
+        def down():
+            self.ap_up = False
+            for board in self.boards:
+                self.set_wifi(board, False)
+
+        def up():
+            self.ap_up = True
+        self.at(start_s, down)
+        self.at(start_s + duration_s, up)
+
+    def broker_outage(self, start_s, duration_s):
+        self.at(start_s, self.broker.set_online, False)
+        self.at(start_s + duration_s, self.broker.set_online, True)
+
+    def control(self, seconds, tank="wiredin", **settings):
+        """Publish a control message the way the app does, at simulation time seconds"""
+        self.at(seconds, self.broker.publish, "environment/{}/control".format(tank),
+                json.dumps(settings), 1)
+
+    def _on_diagnostics(self, topic, payload):
+        try:
+            self.diagnostics.append((self.kernel.now_us, json.loads(payload)))
+        except ValueError:
+            pass
+
+    # ----- running -----
+    @property
+    def now_s(self):
+        return self.kernel.now_us / 1000000
+
+    def run(self, seconds=0, minutes=0, hours=0, days=0):
+        until = self.kernel.now_us + int((seconds + 60 * minutes + 3600 * hours + 86400 * days) * 1000000)
+        start = time.perf_counter()
+        try:
+            self.kernel.run_until(until)
+        finally:
+            self.wall_s += time.perf_counter() - start
+            self.tank.advance()
+
+    def report(self):
+        stats = self.tank.stats
+        span = stats["time"] or 1
+        boards = {}
+        for board in self.boards:
+            espnow = board.fakes.get("espnow")
+            endpoint = espnow._instance if espnow is not None else None
+            boards[board.name] = {
+                "alive": board.alive,
+                "resets": board.resets,
+                "error": board.error.strip().splitlines()[-1] if board.error else None,
+                "espnow_tx": endpoint.stats_tx if endpoint else 0,
+                "espnow_tx_failed": endpoint.stats_tx_failed if endpoint else 0,
+                "espnow_rx": endpoint.stats_rx if endpoint else 0,
+                "espnow_rx_dropped": endpoint.stats_rx_dropped if endpoint else 0,
+                "gc_collections": board.gc_collections,
+            }
+        return {
+            "sim_s": self.now_s,
+            "wall_s": self.wall_s,
+            "speedup": self.now_s / self.wall_s if self.wall_s else None,
+            "context_switches": self.kernel.switches,
+            "boards": boards,
+            "radio": {"sent": self.radio.sent, "lost": self.radio.lost,
+                      "overflows": self.radio.overflows},
+            "mqtt": {"connects": self.broker.connects,
+                     "publishes": dict(self.broker.counts),
+                     "bytes": dict(self.broker.bytes)},
+            "tank": {
+                "temperature": {"min": stats["t_min"], "mean": stats["t_sum"] / span,
+                                "max": stats["t_max"]},
+                "humidity": {"min": stats["h_min"], "mean": stats["h_sum"] / span,
+                             "max": stats["h_max"]},
+                "switches": dict(self.tank.switches),
+                "on_time_s": dict(self.tank.on_time_s),
+                "sht_measurements": self.sht.measurements,
+                "ranger_pings": self.ranger.pings,
+            },
+            "latency_us": self.diagnostics[-1][1].get("latency_us") if self.diagnostics else None,
+            "heap": self.diagnostics[-1][1].get("heap") if self.diagnostics else None,
+        }
+
+    def close(self):
+        self.kernel.shutdown()
+        for board in self.boards:
+            board.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def format_report(report):
+    lines = ["Simulated {:.0f} s in {:.1f} s wall ({:.0f}x real time, {} context switches)".format(
+        report["sim_s"], report["wall_s"], report["speedup"] or 0, report["context_switches"])]
+    for name, board in report["boards"].items():
+        lines.append("  {:<10} {} resets {}  ESP-NOW tx {} (failed {})  rx {} (dropped {}){}".format(
+            name, "up  " if board["alive"] else "DEAD", board["resets"], board["espnow_tx"],
+            board["espnow_tx_failed"], board["espnow_rx"], board["espnow_rx_dropped"],
+            "  error: " + board["error"] if board["error"] else ""))
+    radio = report["radio"]
+    lines.append("  radio      {} frames, {} lost, {} receive overflows".format(
+        radio["sent"], radio["lost"], radio["overflows"]))
+    mqtt = report["mqtt"]
+    lines.append("  mqtt       {} connects".format(mqtt["connects"]))
+    for topic in sorted(mqtt["publishes"]):
+        lines.append("    {:<45} {:>7} msgs {:>10} bytes".format(
+            topic, mqtt["publishes"][topic], mqtt["bytes"][topic]))
+    tank = report["tank"]
+    lines.append("  tank       temperature {min:.1f}/{mean:.1f}/{max:.1f} C, ".format(**tank["temperature"])
+                 + "humidity {min:.1f}/{mean:.1f}/{max:.1f} % (min/mean/max)".format(**tank["humidity"]))
+    lines.append("    switches " + ", ".join("{} {} ({:.0f}% on)".format(
+        name, count, 100 * tank["on_time_s"][name] / (report["sim_s"] or 1))
+        for name, count in tank["switches"].items()))
+    if report["latency_us"]:
+        lines.append("  latency (last diagnostics window, us)")
+        for stage, values in report["latency_us"].items():
+            lines.append("    {:<8} n {n:>5}  p50 {p50:>7}  p95 {p95:>7}  p99 {p99:>7}  max {max:>7}".format(
+                stage, **values))
+    if report["heap"]:
+        lines.append("  heap (last diagnostics window, bytes)")
+        nodes = [("controller", report["heap"]["controller"])]
+        nodes += sorted(report["heap"]["actuators"].items())
+        for name, heap in nodes:
+            pause = heap.get("pause_us")
+            lines.append("    {:<10} free {free:>7}  min {min_free:>7}  threshold {threshold:>6}  "
+                         "collections {collections}{}".format(
+                             name, "  pause mean/max {mean}/{max} us".format(**pause) if pause else "",
+                             **heap))
+    return "\n".join(lines)
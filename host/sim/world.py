@@ -0,0 +1,116 @@
+# world.py
+# Physical model of one terrarium, driven by the actuator node's relays.
+#
+# Air temperature and humidity are first-order lags towards the room
+# (which follows a day/night cycle), pushed up by the heat lamp and the
+# humidifier and pulled back towards the room faster while the fan runs.
+# The state is integrated lazily whenever a sensor samples it or a relay
+# switches, so the inputs are exactly piecewise constant between events.
+# distance(t) is the HC-SR04's view: a resting level with occasional
+# visits by the animal, drawn up front from the kernel's random stream.
+import math
+
+DAY_S = 86400
+
+
+class Terrarium:
+
+    def __init__(self, kernel, temperature=22.0, humidity=50.0, room_temperature=22.0,
+                 room_swing=4.0, room_humidity=50.0, temperature_tau_s=1800.0,
+                 humidity_tau_s=2400.0, heat_lamp_rise=9.0, humidifier_rise=40.0,
+                 fan_tau_s=400.0, lamp_drying=6.0, distance_cm=30.0, visit_every_s=3600.0,
+                 visit_s=300.0, visit_distance_cm=5.0, step_s=5.0):
+        self.kernel = kernel
+        self.temperature = temperature
+        self.humidity = humidity
+        self.room_temperature = room_temperature
+        self.room_swing = room_swing
+        self.room_humidity = room_humidity
+        self.temperature_tau_s = temperature_tau_s
+        self.humidity_tau_s = humidity_tau_s
+        self.heat_lamp_rise = heat_lamp_rise        # steady state rise with the lamp on
+        self.humidifier_rise = humidifier_rise
+        self.fan_tau_s = fan_tau_s
+        self.lamp_drying = lamp_drying
+        self.distance_cm = distance_cm
+        self.visit_every_s = visit_every_s
+        self.visit_s = visit_s
+        self.visit_distance_cm = visit_distance_cm
+        self.step_s = step_s
+        self.relays = {"heat": False, "fan": False, "humid": False, "servo": False}
+        self.switches = {name: 0 for name in self.relays}
+        self.on_time_s = {name: 0.0 for name in self.relays}
+        self._t = 0.0
+        self._visits = []
+        self._visits_until = 0.0
+        # Running statistics for the report
+        self.stats = {"t_min": temperature, "t_max": temperature, "h_min": humidity,
+                      "h_max": humidity, "t_sum": 0.0, "h_sum": 0.0, "time": 0.0}
+
+    def room(self, t):
+        """Room temperature at t seconds: warmest mid-afternoon, coolest before dawn"""
+        return self.room_temperature + self.room_swing * math.sin(2 * math.pi * (t / DAY_S - 0.375))
+
+    def advance(self):
+        now = self.kernel.now_us / 1000000
+        while self._t < now:
+            dt = min(self.step_s, now - self._t)
+            t_room = self.room(self._t)
+            t_target = t_room + (self.heat_lamp_rise if self.relays["heat"] else 0.0)
+            h_target = self.room_humidity + (self.humidifier_rise if self.relays["humid"] else 0.0)
+            h_target -= self.lamp_drying if self.relays["heat"] else 0.0
+            t_rate = 1 / self.temperature_tau_s
+            h_rate = 1 / self.humidity_tau_s
+            if self.relays["fan"]:
+                # Forced exchange with the room: faster, and towards the room
+                t_target = (t_target * t_rate + t_room / self.fan_tau_s) / (t_rate + 1 / self.fan_tau_s)
+                h_target = (h_target * h_rate + self.room_humidity / self.fan_tau_s) / (h_rate + 1 / self.fan_tau_s)
+                t_rate += 1 / self.fan_tau_s
+                h_rate += 1 / self.fan_tau_s
+            self.temperature = t_target + (self.temperature - t_target) * math.exp(-dt * t_rate)
+            self.humidity = h_target + (self.humidity - h_target) * math.exp(-dt * h_rate)
+            self.humidity = max(0.0, min(100.0, self.humidity))
+            for name, on in self.relays.items():
+                if on:
+                    self.on_time_s[name] += dt
+            stats = self.stats
+            stats["t_min"] = min(stats["t_min"], self.temperature)
+            stats["t_max"] = max(stats["t_max"], self.temperature)
+            stats["h_min"] = min(stats["h_min"], self.humidity)
+            stats["h_max"] = max(stats["h_max"], self.humidity)
+            stats["t_sum"] += self.temperature * dt
+            stats["h_sum"] += self.humidity * dt
+            stats["time"] += dt
+            self._t += dt
+
+    def read_env(self):
+        """(temperature, humidity) now, for the SHT4x model"""
+        self.advance()
+        return self.temperature, self.humidity
+
+    def relay(self, name):
+        """Watcher for the relay output pin of actuator name"""
+        def switch(level):
+            on = bool(level)
+            if on != self.relays[name]:
+                self.advance()
+                self.relays[name] = on
+                self.switches[name] += 1
+        return switch
+
+    def servo(self, duty_u16):
+        # 50 Hz PWM: the actuator's "on" position is duty 123/1023, "off" 77/1023
+        self.relay("servo")(duty_u16 > 100 << 6)
+
+    def distance(self, t):
+        while self._visits_until < t + self.visit_s:
+            rng = self.kernel.random
+            start = self._visits_until + rng.expovariate(1 / self.visit_every_s)
+            self._visits.append((start, start + rng.uniform(0.5, 1.5) * self.visit_s))
+            self._visits_until = start
+        while self._visits and self._visits[0][1] < t:
+            self._visits.pop(0)
+        for start, end in self._visits:
+            if start <= t <= end:
+                return self.visit_distance_cm
+        return self.distance_cm
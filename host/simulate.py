@@ -0,0 +1,61 @@
+# simulate.py
+# Runs the sensor, controller and actuator firmware together on a virtual
+# clock, against a simulated terrarium, radio and MQTT broker.
+#
+#   python3 simulate.py --hours 24 --seed 1 --loss 0.02 --broker-outage 3600:600
+#   python3 simulate.py --hours 2 --heap-churn 2048 --gc-pause-us 4000
+#
+# Prints a summary (ESP-NOW and MQTT traffic, tank climate, relay duty,
+# the controller's latency and heap diagnostics); --json prints it as JSON.
+# --heap-churn makes every received ESP-NOW frame allocate that many bytes on
+# the receiving board, so the firmware's GC policy has something to collect.
+# Only needs the standard library.
+import argparse
+import json
+import sys
+
+from sim import Simulation, SimulationError, format_report
+
+
+def outage(value):
+    start, _, duration = value.partition(":")
+    return float(start), float(duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Terrarium node simulator")
+    parser.add_argument("--hours", type=float, default=1.0, help="simulated time to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--loss", type=float, default=0.0, help="ESP-NOW frame loss probability")
+    parser.add_argument("--broker-outage", type=outage, action="append", default=[],
+                        metavar="START:SECONDS", help="take the MQTT broker down")
+    parser.add_argument("--wifi-outage", type=outage, action="append", default=[],
+                        metavar="START:SECONDS", help="take the WiFi access point down")
+    parser.add_argument("--heap-churn", type=int, default=0, metavar="BYTES",
+                        help="heap allocated per received ESP-NOW frame")
+    parser.add_argument("--gc-pause-us", type=int, default=0, metavar="US",
+                        help="how long gc.collect() holds a board")
+    parser.add_argument("--verbose", action="store_true", help="echo every board's console")
+    parser.add_argument("--log-dir", help="write each board's console to <dir>/<board>.log")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    sim = Simulation(seed=args.seed, loss=args.loss, verbose=args.verbose, log_dir=args.log_dir,
+                     heap_churn=args.heap_churn, gc_pause_us=args.gc_pause_us)
+    for start, duration in args.broker_outage:
+        sim.broker_outage(start, duration)
+    for start, duration in args.wifi_outage:
+        sim.wifi_outage(start, duration)
+    try:
+        sim.run(hours=args.hours)
+    except SimulationError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        report = sim.report()
+        sim.close()
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
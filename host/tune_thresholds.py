@@ -0,0 +1,120 @@
+# tune_thresholds.py
+# Sweeps controller threshold settings over recorded telemetry.
+#
+#   python3 tune_thresholds.py --history ./history --tank wiredin \
+#       --temp-lower 18:22:0.5 --temp-upper 24,25,26 --sort switches --top 20
+#
+# Each threshold takes a single value, a comma list or start:stop:step
+# (stop included); unset ones stay at the controller's defaults. Prints,
+# per combination, relay switch counts, duty cycles and the share of time
+# the recorded climate sat outside the temperature/humidity bands.
+# --verify also replays the recording (and a synthetic stress set) through
+# the controller's own update_actuators() and fails on any decision that
+# differs from the vectorized replay. Needs numpy.
+import argparse
+import csv
+import sys
+import time
+
+import numpy as np
+
+import replay
+
+SORT_KEYS = ("switches", "temp_out_of_band", "humid_out_of_band", "heat_duty", "fan_duty",
+             "humid_duty", "servo_duty")
+
+
+def values(text):
+    if ":" in text:
+        start, stop, step = (float(part) for part in text.split(":"))
+        return list(np.round(np.arange(start, stop + step / 2, step), 6))
+    return [float(part) for part in text.split(",")]
+
+
+def verify(rec, settings, label):
+    ok = True
+    for thresholds in settings:
+        start = time.perf_counter()
+        mismatches = replay.verify(rec, thresholds)
+        elapsed = time.perf_counter() - start
+        if len(mismatches):
+            ok = False
+            i = mismatches[0]
+            print("MISMATCH {} thresholds {}: {} of {} readings differ, first at #{} "
+                  "(T {} H {} D {})".format(label, thresholds, len(mismatches), len(rec), i,
+                                            rec.temperature[i], rec.humidity[i], rec.distance[i]))
+        else:
+            print("verified {} thresholds {}: {} readings identical ({:.1f} s)".format(
+                label, thresholds, len(rec), elapsed))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded telemetry against threshold settings")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--history", help="historian data directory (.npz per tank)")
+    source.add_argument("--csv", help="CSV with ts,temperature,humidity,distance[,take_over,actuators]")
+    source.add_argument("--synthetic", type=float, metavar="DAYS", help="generated readings")
+    parser.add_argument("--tank", default="wiredin")
+    for name, default in zip(replay.THRESHOLD_NAMES, replay.DEFAULT_THRESHOLDS):
+        parser.add_argument("--" + name.replace("_", "-"), type=values, default=[default],
+                            metavar="VALUES")
+    parser.add_argument("--sort", choices=SORT_KEYS, default="switches")
+    parser.add_argument("--top", type=int, default=20, help="rows to print (0 = all)")
+    parser.add_argument("--out", help="write every combination to this CSV")
+    parser.add_argument("--verify", action="store_true",
+                        help="check the vectorized law against the firmware's update_actuators()")
+    args = parser.parse_args()
+
+    if args.history:
+        rec = replay.load_history(args.history, args.tank)
+    elif args.csv:
+        rec = replay.load_csv(args.csv)
+    else:
+        rec = replay.synthetic(args.synthetic)
+    if not len(rec):
+        print("no readings", file=sys.stderr)
+        sys.exit(1)
+
+    grid = {name: getattr(args, name) for name in replay.THRESHOLD_NAMES}
+    start = time.perf_counter()
+    result = replay.sweep(rec, grid)
+    elapsed = time.perf_counter() - start
+    combinations = len(result["switches"])
+    print("{} readings over {:.1f} h, {} combinations in {:.1f} ms".format(
+        len(rec), rec.duration / 3600, combinations, elapsed * 1000))
+
+    order = np.lexsort((result["switches"], result[args.sort]))
+    if args.top:
+        order = order[:args.top]
+    header = ("T low", "T high", "H low", "H high", "dist", "heat", "fan", "humid", "servo",
+              "heat%", "fan%", "humid%", "servo%", "T out%", "H out%")
+    print(("{:>6} " * 5 + "{:>6} " * 4 + "{:>6} " * 6).format(*header))
+    for i in order:
+        print(("{:>6.2f} " * 5 + "{:>6} " * 4 + "{:>6.1f} " * 6).format(
+            *[result[name][i] for name in replay.THRESHOLD_NAMES],
+            *[result[device + "_switches"][i] for device in replay.DEVICES],
+            *[100 * result[device + "_duty"][i] for device in replay.DEVICES],
+            100 * result["temp_out_of_band"][i], 100 * result["humid_out_of_band"][i]))
+
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            writer = csv.writer(f)
+            columns = [name for name in result]
+            writer.writerow(columns)
+            for i in range(combinations):
+                writer.writerow([result[name][i] for name in columns])
+
+    if args.verify:
+        # The defaults plus the grid's two corners; reading-by-reading Python is slow
+        settings = [replay.DEFAULT_THRESHOLDS,
+                    tuple(float(result[name][0]) for name in replay.THRESHOLD_NAMES),
+                    tuple(float(result[name][-1]) for name in replay.THRESHOLD_NAMES)]
+        ok = verify(rec, settings, "recording")
+        ok = verify(replay.synthetic(0.5, seed=1), [replay.DEFAULT_THRESHOLDS], "synthetic") and ok
+        if not ok:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()